@@ -0,0 +1,50 @@
+#!/bin/sh
+#
+# Measure how long snf-mkimage takes to start and check that the heavy modules
+# are only loaded when they are needed.
+#
+# Usage: ci/startup_benchmark.sh [RUNS]
+
+set -e
+
+RUNS="${1:-10}"
+PYTHON="${PYTHON:-python}"
+
+"$PYTHON" - "$RUNS" <<'EOF'
+import sys
+import time
+import subprocess
+
+runs = int(sys.argv[1])
+python = sys.executable
+
+# None of these should be loaded just by importing the main module
+HEAVY = ['guestfs', 'kamaki', 'parted', 'hivex']
+
+out = subprocess.check_output(
+    [python, '-c', 'import sys, image_creator.main; '
+     'print("\\n".join(sys.modules))'])
+loaded = [m for m in out.split() if m.split('.')[0] in HEAVY]
+if len(loaded):
+    sys.stderr.write("Heavy modules loaded at import time: %s\n" %
+                     ", ".join(sorted(loaded)))
+    sys.exit(1)
+
+cases = [
+    ('import', [python, '-c', 'import image_creator.main']),
+    ('--help', [python, '-m', 'image_creator.main', '--help']),
+    ('bad args', [python, '-m', 'image_creator.main', '--tmpdir',
+                  '/nonexistent', '/']),
+]
+
+devnull = open('/dev/null', 'w')
+for name, cmd in cases:
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.call(cmd, stdout=devnull, stderr=devnull)
+        times.append((time.time() - start) * 1000)
+    times.sort()
+    print("%-10s min: %7.1fms  median: %7.1fms" %
+          (name, times[0], times[len(times) // 2]))
+EOF
@@ -0,0 +1,3 @@
+#!/bin/sh
+
+python -m unittest discover -s tests -t .
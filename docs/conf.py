@@ -246,6 +246,12 @@ man_pages = [
      'Synnefo development team <synnefo-devel@googlegroups.com>', 1),
     ('man/snf-mkimage', 'snf-mkimage',
      'Command line image creator for Synnefo',
+     'Synnefo development team <synnefo-devel@googlegroups.com>', 1),
+    ('man/snf-mkimage-batch', 'snf-mkimage-batch',
+     'Batch mode of the command line image creator for Synnefo',
+     'Synnefo development team <synnefo-devel@googlegroups.com>', 1),
+    ('man/snf-mkimage-daemon', 'snf-mkimage-daemon',
+     'Daemon mode of the command line image creator for Synnefo',
      'Synnefo development team <synnefo-devel@googlegroups.com>', 1)
 ]
 
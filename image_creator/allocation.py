@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2017 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides the code for finding the regions of a disk that are
+not used by the file systems hosted on it, by reading their block allocation
+bitmaps. All regions are represented as sorted lists of (offset, length)
+tuples measured in bytes.
+"""
+
+import re
+import sys
+import struct
+import array
+
+FREE_BYTES = re.compile('\x00+')
+
+# ext2/3/4 feature flags
+EXT_COMPAT_SPARSE_SUPER2 = 0x200
+EXT_INCOMPAT_RECOVER = 0x4
+EXT_INCOMPAT_JOURNAL_DEV = 0x8
+EXT_INCOMPAT_META_BG = 0x10
+EXT_INCOMPAT_64BIT = 0x80
+EXT_RO_COMPAT_SPARSE_SUPER = 0x1
+EXT_RO_COMPAT_GDT_CSUM = 0x10
+EXT_RO_COMPAT_BIGALLOC = 0x200
+EXT_RO_COMPAT_METADATA_CSUM = 0x400
+EXT_BG_BLOCK_UNINIT = 0x2
+
+
+def merge(extents):
+    """Sort a list of extents and merge the overlapping and adjacent ones"""
+
+    result = []
+    for start, length in sorted(extents):
+        if len(result) and sum(result[-1]) >= start:
+            end = max(sum(result[-1]), start + length)
+            result[-1] = (result[-1][0], end - result[-1][0])
+        else:
+            result.append((start, length))
+    return result
+
+
+def subtract(extents, holes):
+    """Remove the regions described by holes from a sorted list of extents"""
+
+    holes = merge(holes)
+    result = []
+    i = 0
+    for start, length in extents:
+        end = start + length
+        while i < len(holes) and sum(holes[i]) <= start:
+            i += 1
+        j = i
+        while start < end:
+            if j == len(holes) or holes[j][0] >= end:
+                result.append((start, end - start))
+                break
+            if holes[j][0] > start:
+                result.append((start, holes[j][0] - start))
+            start = max(start, sum(holes[j]))
+            j += 1
+    return result
+
+
+def _bitmap_holes(bitmap, unit, offset, count):
+    """Returns the regions described by the zero bytes of an allocation
+    bitmap. Each bit accounts for a unit of bytes and the first one starts at
+    offset. Only the first count bits of the bitmap are valid.
+    """
+    holes = []
+    for match in FREE_BYTES.finditer(bitmap):
+        start = match.start() * 8
+        end = min(match.end() * 8, count)
+        if end > start:
+            holes.append((offset + start * unit, (end - start) * unit))
+    return holes
+
+
+def ext_holes(f, offset):
+    """Returns the unused regions of an ext2/3/4 file system found at offset
+    or None if they cannot be determined.
+    """
+
+    f.seek(offset + 1024)
+    sb = f.read(1024)
+    if len(sb) < 1024 or struct.unpack_from('<H', sb, 0x38)[0] != 0xef53:
+        return None
+
+    (_, blocks_count, _, _, _, first_data_block, log_block_size, _,
+     blocks_per_group, _, inodes_per_group) = struct.unpack_from('<11I', sb)
+    rev_level = struct.unpack_from('<I', sb, 0x4c)[0]
+    inode_size = struct.unpack_from('<H', sb, 0x58)[0] if rev_level else 128
+    compat, incompat, ro_compat = struct.unpack_from('<III', sb, 0x5c)
+    reserved_gdt = struct.unpack_from('<H', sb, 0xce)[0]
+
+    if compat & EXT_COMPAT_SPARSE_SUPER2 or \
+            incompat & (EXT_INCOMPAT_RECOVER | EXT_INCOMPAT_JOURNAL_DEV |
+                        EXT_INCOMPAT_META_BG) or \
+            ro_compat & EXT_RO_COMPAT_BIGALLOC:
+        # Don't bother with the exotic layouts or with file systems that
+        # need journal recovery. Their bitmaps cannot be trusted as is.
+        return None
+
+    desc_size = 32
+    if incompat & EXT_INCOMPAT_64BIT:
+        desc_size = struct.unpack_from('<H', sb, 0xfe)[0]
+        blocks_count |= struct.unpack_from('<I', sb, 0x150)[0] << 32
+
+    block_size = 1024 << log_block_size
+    if blocks_per_group == 0 or desc_size < 32:
+        return None
+
+    # The flags of the group descriptors are only valid if they are
+    # protected by checksums. Otherwise, the kernel ignores them.
+    uninit_bg = ro_compat & (EXT_RO_COMPAT_GDT_CSUM |
+                             EXT_RO_COMPAT_METADATA_CSUM)
+
+    groups = (blocks_count - first_data_block + blocks_per_group - 1) // \
+        blocks_per_group
+    gdt_blocks = (groups * desc_size + block_size - 1) // block_size
+    itable_blocks = (inodes_per_group * inode_size + block_size - 1) // \
+        block_size
+
+    def has_super(group):
+        """Check if a group hosts a backup of the superblock"""
+        if not ro_compat & EXT_RO_COMPAT_SPARSE_SUPER or group <= 1:
+            return True
+        for base in (3, 5, 7):
+            power = base
+            while power < group:
+                power *= base
+            if power == group:
+                return True
+        return False
+
+    def block(desc, lo, hi):
+        """Read a block number from a group descriptor"""
+        num = struct.unpack_from('<I', desc, lo)[0]
+        if desc_size >= 64:
+            num |= struct.unpack_from('<I', desc, hi)[0] << 32
+        return num
+
+    f.seek(offset + (first_data_block + 1) * block_size)
+    gdt = f.read(groups * desc_size)
+    if len(gdt) < groups * desc_size:
+        return None
+
+    holes = []
+    metadata = []
+    for group in xrange(groups):
+        desc = gdt[group * desc_size:(group + 1) * desc_size]
+        block_bitmap = block(desc, 0x0, 0x20)
+        inode_bitmap = block(desc, 0x4, 0x24)
+        inode_table = block(desc, 0x8, 0x28)
+        flags = struct.unpack_from('<H', desc, 0x12)[0]
+
+        metadata.append((offset + block_bitmap * block_size, block_size))
+        metadata.append((offset + inode_bitmap * block_size, block_size))
+        metadata.append((offset + inode_table * block_size,
+                         itable_blocks * block_size))
+
+        start = first_data_block + group * blocks_per_group
+        count = min(blocks_per_group, blocks_count - start)
+
+        if uninit_bg and flags & EXT_BG_BLOCK_UNINIT:
+            # The bitmap of the group is not initialized. All blocks are free
+            # except for the superblock and group descriptor backups and any
+            # bitmaps or inode tables hosted here.
+            used = 1 + gdt_blocks + reserved_gdt if has_super(group) else 0
+            if count > used:
+                holes.append((offset + (start + used) * block_size,
+                              (count - used) * block_size))
+            continue
+
+        f.seek(offset + block_bitmap * block_size)
+        bitmap = f.read(block_size)
+        holes.extend(_bitmap_holes(bitmap, block_size,
+                                   offset + start * block_size, count))
+
+    return subtract(merge(holes), metadata)
+
+
+def fat_holes(f, offset):
+    """Returns the unused regions of a FAT16 or FAT32 file system found at
+    offset or None if they cannot be determined.
+    """
+
+    f.seek(offset)
+    boot = f.read(512)
+    if len(boot) < 512 or boot[510:512] != '\x55\xaa':
+        return None
+
+    (sector_size, cluster_sectors, reserved, fats, root_entries, total,
+     _, fat_size) = struct.unpack_from('<HBHBHHBH', boot, 0x0b)
+
+    if sector_size not in (512, 1024, 2048, 4096) or cluster_sectors == 0 or \
+            cluster_sectors & (cluster_sectors - 1) or fats == 0:
+        return None
+
+    if total == 0:
+        total = struct.unpack_from('<I', boot, 0x20)[0]
+    if fat_size == 0:
+        fat_size = struct.unpack_from('<I', boot, 0x24)[0]
+
+    root_sectors = (root_entries * 32 + sector_size - 1) // sector_size
+    data_start = reserved + fats * fat_size + root_sectors
+    if total <= data_start:
+        return None
+    clusters = (total - data_start) // cluster_sectors
+
+    if clusters < 4085:
+        # FAT12 file systems are tiny. Not worth the trouble.
+        return None
+    elif clusters < 65525:
+        entries, mask = array.array('H'), 0xffff
+    else:
+        entries, mask = array.array('I'), 0x0fffffff
+
+    needed = (clusters + 2) * entries.itemsize
+    f.seek(offset + reserved * sector_size)
+    table = f.read(needed)
+    if len(table) < needed or needed > fat_size * sector_size:
+        return None
+    entries.fromstring(table)
+    if sys.byteorder == 'big':
+        # The table is little-endian on disk
+        entries.byteswap()
+
+    cluster_size = cluster_sectors * sector_size
+    data_offset = offset + data_start * sector_size
+
+    holes = []
+    run = None
+    for cluster in xrange(2, clusters + 2):
+        if entries[cluster] & mask == 0:
+            if run is None:
+                run = cluster
+        elif run is not None:
+            holes.append((data_offset + (run - 2) * cluster_size,
+                          (cluster - run) * cluster_size))
+            run = None
+    if run is not None:
+        holes.append((data_offset + (run - 2) * cluster_size,
+                      (clusters + 2 - run) * cluster_size))
+
+    return holes
+
+
+def ntfs_holes(f, offset):
+    """Returns the unused regions of an NTFS file system found at offset or
+    None if they cannot be determined.
+    """
+
+    f.seek(offset)
+    boot = f.read(512)
+    if len(boot) < 512 or boot[3:11] != 'NTFS    ':
+        return None
+
+    sector_size, cluster_sectors = struct.unpack_from('<HB', boot, 0x0b)
+    if cluster_sectors > 0x80:
+        cluster_sectors = 1 << (256 - cluster_sectors)
+    total_sectors, mft_lcn = struct.unpack_from('<QQ', boot, 0x28)
+    record_clusters = struct.unpack_from('<b', boot, 0x40)[0]
+
+    if sector_size == 0 or cluster_sectors == 0:
+        return None
+
+    cluster_size = sector_size * cluster_sectors
+    record_size = 1 << -record_clusters if record_clusters < 0 else \
+        record_clusters * cluster_size
+
+    # $Bitmap is MFT record 6. The first MFT records are always contiguous.
+    f.seek(offset + mft_lcn * cluster_size + 6 * record_size)
+    record = f.read(record_size)
+    if len(record) < record_size or record[:4] != 'FILE':
+        return None
+
+    # Apply the update sequence fixups
+    usa_offset, usa_count = struct.unpack_from('<HH', record, 4)
+    usa = record[usa_offset:usa_offset + 2 * usa_count]
+    for i in xrange(1, usa_count):
+        end = i * 512
+        if end > len(record) or record[end - 2:end] != usa[0:2]:
+            return None
+        record = record[:end - 2] + usa[2 * i:2 * i + 2] + record[end:]
+
+    bitmap = None
+    attr = struct.unpack_from('<H', record, 0x14)[0]
+    while attr + 16 <= len(record):
+        attr_type, attr_len = struct.unpack_from('<II', record, attr)
+        if attr_type == 0xffffffff or attr_len == 0:
+            break
+        nonresident, name_len = struct.unpack_from('<BB', record, attr + 8)
+        if attr_type != 0x80 or name_len != 0:  # Unnamed $DATA attribute
+            attr += attr_len
+            continue
+
+        if not nonresident:
+            value_len, value_offset = \
+                struct.unpack_from('<IH', record, attr + 0x10)
+            bitmap = record[attr + value_offset:
+                            attr + value_offset + value_len]
+            break
+
+        runs_offset = struct.unpack_from('<H', record, attr + 0x20)[0]
+        data_size = struct.unpack_from('<Q', record, attr + 0x30)[0]
+
+        chunks = []
+        pos = attr + runs_offset
+        lcn = 0
+        while pos < attr + attr_len and record[pos] != '\x00':
+            header = ord(record[pos])
+            len_size, off_size = header & 0xf, header >> 4
+            if off_size == 0:  # Sparse run. Not expected here.
+                return None
+            length = int(record[pos + 1:pos + 1 + len_size][::-1]
+                         .encode('hex'), 16)
+            delta = int(record[pos + 1 + len_size:
+                               pos + 1 + len_size + off_size][::-1]
+                        .encode('hex'), 16)
+            if delta >> (8 * off_size - 1):  # negative offset
+                delta -= 1 << (8 * off_size)
+            pos += 1 + len_size + off_size
+            lcn += delta
+
+            f.seek(offset + lcn * cluster_size)
+            chunks.append(f.read(length * cluster_size))
+        bitmap = ''.join(chunks)[:data_size]
+        break
+
+    if bitmap is None:
+        return None
+
+    clusters = total_sectors // cluster_sectors
+    return _bitmap_holes(bitmap, cluster_size, offset, clusters)
+
+
+FS_HOLES = {
+    'ext2': ext_holes,
+    'ext3': ext_holes,
+    'ext4': ext_holes,
+    'vfat': fat_holes,
+    'ntfs': ntfs_holes,
+}
+
+
+def unused_extents(f, partitions):
+    """Returns the regions of a disk that are not used by the file systems
+    of the partitions. The partitions are (start, end, fstype) tuples, where
+    end is the last byte of the partition. File systems of unknown types are
+    considered fully used.
+    """
+
+    holes = []
+    for start, end, fstype in partitions:
+        if fstype not in FS_HOLES:
+            continue
+        try:
+            found = FS_HOLES[fstype](f, start)
+        except (struct.error, ValueError):
+            found = None
+        if found is None:
+            continue
+        # Never trust a file system that claims space outside its partition
+        holes.extend(subtract(found, [(0, start), (end + 1, 2 ** 64)]))
+
+    return merge(holes)
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
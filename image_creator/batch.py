@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2017 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module implements the batch mode of snf-mkimage. A manifest lists the
+images to be created and the jobs run in a pool of worker processes. The
+workers share one authenticated cloud client, and the snapshots of all the
+jobs share the space of the temporary directory.
+"""
+
+import sys
+import os
+import time
+import json
+import argparse
+import traceback
+import multiprocessing
+import StringIO
+
+import yaml
+
+from image_creator import __version__ as version
+from image_creator.util import FatalError
+from image_creator.output.cli import SimpleOutput
+from image_creator.main import parse_options, get_kamaki, image_creator, \
+    account_key
+
+# The authenticated Kamaki instances, by account, that the workers inherit
+_kamaki = {}
+
+
+def parse_batch_options():
+    """Parse the batch mode command line parameters"""
+    description = "Create many OS images described in a manifest file"
+    parser = argparse.ArgumentParser(version=version, description=description)
+
+    parser.add_argument(
+        "manifest", metavar="MANIFEST",
+        help="YAML or JSON file with the list of the images to create")
+
+    parser.add_argument(
+        "-a", "--authentication-url", dest="url", default=None,
+        metavar="URL", help="use this authentication URL when "
+        "uploading/registering images")
+
+    parser.add_argument(
+        "-c", "--cloud", dest="cloud", default=None, metavar="CLOUD",
+        help="use this saved cloud account to authenticate against a cloud "
+             "when uploading/registering images")
+
+    parser.add_argument(
+        "-f", "--force", dest="force", default=False, action="store_true",
+        help="overwrite output files if they exist")
+
+    parser.add_argument(
+        "-j", "--jobs", dest="jobs", default=2, type=int, metavar="N",
+        help="run up to N jobs in parallel")
+
+    parser.add_argument(
+        "--logdir", dest="logdir", default='.', metavar="DIR",
+        help="write the output of each job in a log file under DIR")
+
+    parser.add_argument(
+        "--summary", dest="summary", default=None, metavar="FILE",
+        help="write a summary of the results of the jobs in FILE (JSON)")
+
+    parser.add_argument(
+        "-t", "--token", dest="token", default=None,
+        help="use this authentication token when uploading/registering "
+             "images")
+
+    parser.add_argument(
+        "--tmpdir", dest="tmp", default=None, metavar="DIR",
+        help="create large temporary image files under DIR")
+
+    options = parser.parse_args()
+
+    if options.jobs < 1:
+        parser.error("The number of jobs must be a positive integer")
+
+    if not os.path.isdir(options.logdir):
+        parser.error("The directory `%s' specified with --logdir is not valid"
+                     % options.logdir)
+
+    return options
+
+
+def _arg(value):
+    """Convert a manifest value to a command line argument"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def job_arguments(job, batch):
+    """Returns the snf-mkimage command line arguments of a manifest job"""
+    if 'source' not in job:
+        raise FatalError("No source defined")
+
+    args = [_arg(job['source'])]
+
+    for key, option in (('outfile', '--outfile'), ('upload', '--upload'),
+                        ('register', '--register'),
+                        ('container', '--container'),
+                        ('virtio', '--install-virtio')):
+        if key in job:
+            args.extend([option, _arg(job[key])])
+
+    for key, option in (('enable_syspreps', '--enable-sysprep'),
+                        ('disable_syspreps', '--disable-sysprep')):
+        for sysprep in job.get(key, []):
+            args.extend([option, _arg(sysprep)])
+
+    for key, option in (('sysprep_params', '--sysprep-param'),
+                        ('metadata', '--metadata')):
+        for name, value in job.get(key, {}).items():
+            args.extend([option, "%s=%s" % (_arg(name), _arg(value))])
+
+    if job.get('public', False):
+        args.append('--public')
+
+    args.extend(_arg(a) for a in job.get('args', []))
+
+    # Options that apply to all the jobs
+    for key, option in (('url', '--authentication-url'), ('token', '--token'),
+                        ('cloud', '--cloud'), ('tmp', '--tmpdir')):
+        if getattr(batch, key) is not None:
+            args.extend([option, _arg(getattr(batch, key))])
+    if batch.force:
+        args.append('--force')
+
+    # Jobs that don't fit in the temporary space wait for the others
+    args.append('--wait-for-space')
+
+    return args
+
+
+def load_manifest(filename):
+    """Returns a list of (name, job) tuples with the jobs of a manifest. The
+    manifest is either a list of jobs or a dictionary with a list of jobs
+    under `jobs' and default job values under `defaults'.
+    """
+    try:
+        with open(filename) as f:
+            manifest = yaml.safe_load(f)
+    except (IOError, yaml.YAMLError) as e:
+        raise FatalError("Unable to load manifest `%s': %s" % (filename, e))
+
+    defaults = {}
+    if isinstance(manifest, dict):
+        defaults = manifest.get('defaults', {})
+        manifest = manifest.get('jobs', [])
+
+    if not isinstance(manifest, list) or \
+            not all(isinstance(j, dict) for j in manifest):
+        raise FatalError("Manifest `%s' is not a list of jobs" % filename)
+
+    jobs = []
+    names = set()
+    for i, entry in enumerate(manifest):
+        job = dict(defaults)
+        job.update(entry)
+        name = job.get('name') or os.path.basename(
+            job.get('outfile') or job.get('upload') or
+            job.get('source') or 'job')
+        name = _arg(name)
+        if name in names:
+            name = "%s-%d" % (name, i + 1)
+        names.add(name)
+        jobs.append((name, job))
+
+    return jobs
+
+
+def run_job(job):
+    """Run a job in a worker process and return its result"""
+    name, options, logfile = job
+
+    # Send everything the job prints to its log file
+    sys.stdout.flush()
+    sys.stderr.flush()
+    log = os.open(logfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    os.close(log)
+
+    out = SimpleOutput(colored=False, timestamp=True)
+    out.start = time.time()
+    kamaki = _kamaki.get(account_key(options))
+    if kamaki is not None:
+        kamaki.out = out
+
+    result = {'name': name, 'source': options.source,
+              'outfile': options.outfile, 'upload': options.upload,
+              'log': logfile, 'error': None}
+    start = time.time()
+    try:
+        image_creator(options, out, kamaki)
+        result['status'] = 'success'
+    except FatalError as e:
+        out.error(e)
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    except Exception as e:  # pylint: disable=broad-except
+        traceback.print_exc()
+        result['status'] = 'failed'
+        result['error'] = "%s: %s" % (type(e).__name__, e)
+    finally:
+        result['elapsed'] = round(time.time() - start, 1)
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    return result
+
+
+def batch(options, out):
+    """snf-mkimage batch mode main function"""
+
+    if os.geteuid() != 0:
+        raise FatalError("You must run %s as root"
+                         % os.path.basename(sys.argv[0]))
+
+    start = time.time()
+    results = []
+    jobs = []
+    for name, job in load_manifest(options.manifest):
+        logfile = os.path.join(options.logdir, "%s.log" % name)
+        errors = StringIO.StringIO()
+        try:
+            job_options = parse_options(job_arguments(job, options),
+                                        stderr=errors)
+        except (FatalError, SystemExit) as e:
+            msg = str(e)
+            if isinstance(e, SystemExit):
+                # The last line printed by the parser is the error message
+                lines = errors.getvalue().strip().splitlines()
+                msg = "Invalid job definition: %s" % lines[-1] \
+                    if len(lines) else "Invalid job definition"
+            out.warn("Job `%s': %s" % (name, msg))
+            results.append({'name': name, 'source': job.get('source'),
+                            'outfile': job.get('outfile'),
+                            'upload': job.get('upload'), 'log': None,
+                            'status': 'invalid', 'error': msg,
+                            'elapsed': 0})
+            continue
+        jobs.append((name, job_options, logfile))
+
+    # Authenticate once per account. The workers inherit the clients.
+    for _, job_options, _ in jobs:
+        key = account_key(job_options)
+        if not job_options.upload or key is None or key in _kamaki:
+            continue
+        out.info("Authenticating with the cloud ...", False)
+        _kamaki[key] = get_kamaki(job_options, out)
+        out.success('done')
+
+    out.info("Running %d jobs, up to %d in parallel" %
+             (len(jobs), options.jobs))
+
+    # Each job runs in a fresh process
+    pool = multiprocessing.Pool(options.jobs, maxtasksperchild=1)
+    try:
+        for result in pool.imap_unordered(run_job, jobs):
+            report = out.success if result['status'] == 'success' \
+                else out.warn
+            report("Job `%s' %s in %ds%s" % (
+                result['name'], result['status'], result['elapsed'],
+                ": %s" % result['error'] if result['error'] else ""))
+            results.append(result)
+        pool.close()
+    except (Exception, KeyboardInterrupt):
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    failed = [r for r in results if r['status'] != 'success']
+    summary = {'jobs': results, 'succeeded': len(results) - len(failed),
+               'failed': len(failed), 'elapsed': round(time.time() - start, 1)}
+
+    out.info()
+    out.info("Summary:")
+    for result in sorted(results, key=lambda r: r['name']):
+        out.info("  %-30s %-8s %8.1fs" % (result['name'], result['status'],
+                                          result['elapsed']))
+    out.info("%d succeeded, %d failed in %ds" % (
+        summary['succeeded'], summary['failed'], summary['elapsed']))
+
+    if options.summary is not None:
+        with open(options.summary, 'w') as f:
+            json.dump(summary, f, indent=4)
+
+    return 1 if len(failed) else 0
+
+
+def main():
+    """Entry point of the batch mode"""
+    options = parse_batch_options()
+    out = SimpleOutput(colored=sys.stderr.isatty(), timestamp=True)
+
+    title = 'snf-image-creator %s (batch mode)' % version
+    sys.stderr.write(title + '\n')
+    sys.stderr.write(('=' * len(title)) + '\n')
+
+    try:
+        sys.exit(batch(options, out))
+    except FatalError as e:
+        out.error(e)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2017 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides a hashing engine that computes multiple digests of a
+data stream at once. Each digest is computed by a separate worker thread.
+hashlib releases the GIL while hashing large buffers, so the digests are
+computed in parallel while the stream is being read.
+"""
+
+import hashlib
+import ctypes
+import threading
+import Queue
+
+from image_creator.util import FatalError
+
+# The default block size and block hash algorithm of the Pithos+ storage
+# service.
+PITHOS_BLOCK_SIZE = 4 * 2 ** 20
+PITHOS_BLOCK_HASH = 'sha256'
+
+# Zeros to compare the data against and to hash without copying them
+ZEROS = memoryview('\0' * 2 ** 16)
+
+
+def aligned_buffer(size, alignment):
+    """Returns a writable memoryview of size bytes, whose address is a
+    multiple of alignment.
+    """
+    buf = bytearray(size + alignment)
+    address = ctypes.addressof(ctypes.c_char.from_buffer(buf))
+    offset = -address % alignment
+    return memoryview(buf)[offset:offset + size]
+
+
+def file_digests(filename, buffer_size=PITHOS_BLOCK_SIZE):
+    """Returns a dictionary with the MD5 and SHA-256 checksums of a file"""
+    checksum = Checksum({'md5': hashlib.md5(), 'sha256': hashlib.sha256()},
+                        buffer_size=buffer_size)
+    try:
+        with open(filename, 'rb') as f:
+            while True:
+                buf = checksum.buffer()
+                size = f.readinto(buf[:buffer_size])
+                if size == 0:
+                    checksum.release(buf)
+                    break
+                checksum.update(buf[:size], buf)
+    except Exception:
+        checksum.cancel()
+        raise
+
+    return checksum.finish()
+
+
+class BlockHash(object):
+    """Computes the hashes of the fixed size blocks of a stream, the way the
+    Pithos+ storage service does. The trailing zeros of each block are not
+    taken into account.
+    """
+
+    def __init__(self, block_size=PITHOS_BLOCK_SIZE,
+                 block_hash=PITHOS_BLOCK_HASH):
+        """Create a new BlockHash instance"""
+        self.block_size = block_size
+        self.block_hash = block_hash
+        self.hashes = []
+        self.bytes = 0
+        self._hash = hashlib.new(block_hash)
+        self._zeros = 0
+        self._pending = 0
+
+    @staticmethod
+    def _strip(data):
+        """Returns the length of a memoryview without its trailing zeros"""
+        window = 4096
+        end = len(data)
+        while end > 0:
+            start = max(0, end - window)
+            if data[start:end] != ZEROS[:end - start]:
+                # Only this window needs to be copied
+                return start + len(data[start:end].tobytes().rstrip('\0'))
+            end = start
+        return 0
+
+    def _hash_zeros(self):
+        """Hash the zeros that turned out not to be trailing ones"""
+        while self._zeros:
+            size = min(self._zeros, len(ZEROS))
+            self._hash.update(ZEROS[:size])
+            self._zeros -= size
+
+    def _flush(self):
+        """Hash the pending block"""
+        self.hashes.append(self._hash.hexdigest())
+        self._hash = hashlib.new(self.block_hash)
+        self._zeros = 0
+        self._pending = 0
+
+    def update(self, data):
+        """Update the hashes with the data. The trailing zeros of the data
+        are only hashed if more data follows in the same block.
+        """
+        data = memoryview(data)
+        self.bytes += len(data)
+        while len(data):
+            size = min(len(data), self.block_size - self._pending)
+            length = self._strip(data[:size])
+            if length:
+                self._hash_zeros()
+                self._hash.update(data[:length])
+            self._zeros += size - length
+            self._pending += size
+            data = data[size:]
+            if self._pending == self.block_size:
+                self._flush()
+
+    def hexdigest(self):
+        """Return the hashmap of the stream in the format used by Pithos+"""
+        if self._pending:
+            self._flush()
+        return {'block_size': self.block_size, 'block_hash': self.block_hash,
+                'bytes': self.bytes, 'hashes': self.hashes}
+
+
+class Checksum(object):
+    """Computes multiple digests of a data stream in parallel.
+
+    The stream is read into a ring of reusable buffers. Each buffer is handed
+    to all the digest workers and returns to the ring when they are done with
+    it.
+    """
+
+    def __init__(self, digests, buffer_size=PITHOS_BLOCK_SIZE, buffers=4,
+                 alignment=1):
+        """Create a new Checksum instance. The digests is a dictionary of
+        objects having an update and a hexdigest method, like the ones
+        provided by the hashlib module.
+
+        The buffers of the ring are writable memoryview objects whose address
+        is a multiple of alignment. They have room for buffer_size bytes plus
+        an extra alignment unit, so that unaligned regions can be read with
+        aligned requests.
+        """
+        self.digests = digests
+        self.buffer_size = buffer_size
+        self.alignment = alignment
+
+        self._ring = Queue.Queue()
+        for _ in xrange(buffers):
+            self._ring.put(aligned_buffer(buffer_size + alignment, alignment))
+
+        self._lock = threading.Lock()
+        self._refs = {}
+        self._error = None
+        self._workers = []
+        for name, digest in digests.items():
+            queue = Queue.Queue(buffers)
+            worker = threading.Thread(target=self._work, args=(digest, queue),
+                                      name="checksum-%s" % name)
+            worker.daemon = True
+            worker.queue = queue
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self, digest, queue):
+        """The main loop of a digest worker"""
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            data, buf = item
+            try:
+                if self._error is None:
+                    digest.update(data)
+            except Exception as e:  # pylint: disable=broad-except
+                self._error = e
+            finally:
+                if buf is not None:
+                    self._unref(buf)
+
+    def _unref(self, buf):
+        """Drop a reference to a ring buffer"""
+        with self._lock:
+            self._refs[id(buf)] -= 1
+            if self._refs[id(buf)] == 0:
+                del self._refs[id(buf)]
+                self._ring.put(buf)
+
+    def buffer(self):
+        """Get a free buffer from the ring. The buffer needs to be passed to
+        update or release when it is no longer used by the caller.
+        """
+        return self._ring.get()
+
+    def release(self, buf):
+        """Return an unused buffer back to the ring"""
+        self._ring.put(buf)
+
+    def update(self, data, buf=None):
+        """Update all the digests with the data. If data is a view of a ring
+        buffer, the buffer should also be passed. The caller must not modify
+        the buffer after this call.
+        """
+        if self._error is not None:
+            raise self._error
+
+        if buf is not None:
+            if len(self._workers) == 0:
+                self.release(buf)
+                return
+            with self._lock:
+                self._refs[id(buf)] = len(self._workers)
+
+        for worker in self._workers:
+            worker.queue.put((data, buf))
+
+    def cancel(self):
+        """Stop the workers without waiting for the digests"""
+        self._error = self._error or FatalError("Checksum cancelled")
+        for worker in self._workers:
+            worker.queue.put(None)
+
+    def finish(self):
+        """Wait for the workers to complete and return a dictionary with the
+        computed digests.
+        """
+        for worker in self._workers:
+            worker.queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+        if self._error is not None:
+            raise self._error
+
+        return dict((name, digest.hexdigest())
+                    for name, digest in self.digests.items())
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2017 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module implements snf-mkimage-client, which submits an image creation
+job to the snf-mkimage daemon and prints the output of the job. It is kept
+light, so that it starts fast.
+"""
+
+import sys
+import os
+import json
+import socket
+import argparse
+
+from image_creator import __version__ as version
+from image_creator.devices import LOCK_DIR
+from image_creator.output.cli import SilentOutput, SimpleOutput, \
+    OutputWthProgress
+from image_creator.output.stream import replay
+
+# The socket the daemon listens on by default
+SOCKET = os.path.join(LOCK_DIR, 'daemon.sock')
+
+
+def submit(path, args, start):
+    """Submit a job with the specified snf-mkimage arguments to the daemon
+    listening on a UNIX socket and replay its output. Returns the exit status
+    of the job.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        sys.stderr.write("Unable to connect to the daemon at `%s': %s\n" %
+                         (path, e.strerror))
+        return 1
+
+    try:
+        request = {'args': [a.decode('utf-8') for a in args],
+                   'cwd': os.getcwd().decode('utf-8')}
+        sock.sendall(json.dumps(request) + '\n')
+        exit_event = replay(sock.makefile('rb'), SimpleOutput(colored=False),
+                            start)
+    finally:
+        sock.close()
+
+    if exit_event is None:
+        sys.stderr.write("Lost the connection to the daemon\n")
+        return 1
+    return exit_event['status']
+
+
+def main():
+    """Entry point of the client"""
+    parser = argparse.ArgumentParser(
+        add_help=False, usage="%(prog)s [--socket PATH] <snf-mkimage args>",
+        description="Submit an image creation job to the snf-mkimage daemon")
+    parser.add_argument("--socket", dest="socket", default=SOCKET,
+                        metavar="PATH")
+
+    # All the other arguments are passed to the daemon, including --help
+    options, args = parser.parse_known_args()
+
+    def start(event):
+        """Create the output of the job"""
+        if event['silent']:
+            return SilentOutput(colored=sys.stderr.isatty(),
+                                timestamp=event['timestamp'])
+        elif sys.stderr.isatty():
+            return OutputWthProgress(timestamp=event['timestamp'])
+        return SimpleOutput(colored=False, timestamp=event['timestamp'])
+
+    title = 'snf-image-creator %s' % version
+    sys.stderr.write(title + '\n')
+    sys.stderr.write(('=' * len(title)) + '\n')
+
+    try:
+        sys.exit(submit(options.socket, args, start))
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2017 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides the compressed output formats of the image dumps. The
+compression is performed by external multi-threaded compressors, while the
+digests of the compressed stream are computed on the fly.
+"""
+
+import os
+import hashlib
+import subprocess
+import threading
+from distutils.spawn import find_executable
+
+from image_creator.util import FatalError
+
+# For each format: the file extension and the candidate compressor commands
+# in order of preference. Multi-threaded compressors come first.
+COMPRESSION_FORMATS = {
+    'gzip': ('.gz', (('pigz', '-c'), ('gzip', '-c'))),
+    'zstd': ('.zst', (('zstd', '-T0', '-q', '-c'),))}
+
+# The size of the reads from the compressor
+CHUNK_SIZE = 2 ** 20
+
+
+def compression_format(filename):
+    """Returns the compression format implied by the extension of filename or
+    None if the file is not compressed.
+    """
+    for fmt, (extension, _) in COMPRESSION_FORMATS.items():
+        if filename.endswith(extension):
+            return fmt
+    return None
+
+
+def decompressed_name(filename, fmt):
+    """Returns the name of the file that decompressing filename produces"""
+    extension = COMPRESSION_FORMATS[fmt][0]
+    if filename.endswith(extension) and len(filename) > len(extension):
+        return filename[:-len(extension)]
+    return "%s.raw" % filename
+
+
+def compressor_command(fmt):
+    """Returns the command line of the best available compressor for a
+    format.
+    """
+    if fmt not in COMPRESSION_FORMATS:
+        raise FatalError("Unknown compression format: `%s'" % fmt)
+
+    for command in COMPRESSION_FORMATS[fmt][1]:
+        binary = find_executable(command[0])
+        if binary is not None:
+            return (binary,) + command[1:]
+
+    raise FatalError("No compressor found for the `%s' format. Install %s." %
+                     (fmt, " or ".join(c[0] for c in
+                                       COMPRESSION_FORMATS[fmt][1])))
+
+
+class Compressor(object):
+    """File-like object that compresses the data written to it and stores the
+    result in a file. The MD5 and SHA-256 checksums of the compressed stream
+    are computed by a separate thread while the compressor output is written
+    to the file.
+    """
+
+    def __init__(self, fmt, outfile):
+        """Create a new Compressor instance"""
+        self.format = fmt
+        self.name = outfile
+        self.digests = None
+        self._hashes = {'md5': hashlib.md5(), 'sha256': hashlib.sha256()}
+        self._size = 0
+        self._error = None
+
+        command = compressor_command(fmt)
+        self._dst = open(outfile, 'wb')
+        try:
+            self._proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          close_fds=True)
+        except OSError as e:
+            self._dst.close()
+            raise FatalError("Unable to run `%s': %s" % (command[0], e))
+
+        self._reader = threading.Thread(target=self._read,
+                                        name="compressor-%s" % fmt)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _read(self):
+        """Store and hash the output of the compressor"""
+        try:
+            while True:
+                data = self._proc.stdout.read(CHUNK_SIZE)
+                if not data:
+                    return
+                self._dst.write(data)
+                for digest in self._hashes.values():
+                    digest.update(data)
+                self._size += len(data)
+        except Exception as e:  # pylint: disable=broad-except
+            self._error = e
+            # Make sure the compressor does not block writing to us
+            self._proc.stdout.close()
+
+    def write(self, data):
+        """Compress the data"""
+        try:
+            self._proc.stdin.write(data)
+        except IOError as e:
+            raise FatalError("Compressing with `%s' failed: %s" %
+                             (self.format, self._error or e))
+
+    def flush(self):
+        """Flush the input of the compressor"""
+        self._proc.stdin.flush()
+
+    def close(self):
+        """Wait for the compressor to finish and return the digests of the
+        compressed stream.
+        """
+        self._proc.stdin.close()
+        self._reader.join()
+        ret = self._proc.wait()
+        self._dst.close()
+
+        if self._error is not None:
+            raise FatalError("Unable to write `%s': %s" %
+                             (self.name, self._error))
+        if ret != 0:
+            raise FatalError("Compressing with `%s' failed with exit code %d"
+                             % (self.format, ret))
+
+        self.digests = dict((name, digest.hexdigest())
+                            for name, digest in self._hashes.items())
+        self.digests['format'] = self.format
+        self.digests['size'] = self._size
+        return self.digests
+
+    def abort(self):
+        """Kill the compressor"""
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.stdin.close()
+        self._reader.join()
+        self._proc.wait()
+        self._dst.close()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
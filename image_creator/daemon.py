@@ -0,0 +1,599 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2017 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module implements the snf-mkimage daemon. The daemon listens on a
+UNIX socket for image creation jobs, that take the same arguments as
+snf-mkimage. The jobs run in processes that are forked by a spawner process,
+which the daemon forks before it starts any thread. The spawner keeps a number
+of worker processes forked in advance, each of which launches a libguestfs
+appliance of its own and waits for a job to run with it. The output of a job
+is streamed back to the client as it is produced.
+
+A client sends a single JSON encoded line with the job:
+
+    {"args": [<snf-mkimage arguments>], "cwd": <working directory>}
+
+and receives the events of a StreamOutput, one per line. A `start' event
+carries the output options of the job and the last event is always an `exit'
+event with the exit status of the job.
+"""
+
+import sys
+import os
+import json
+import errno
+import fcntl
+import signal
+import select
+import socket
+import argparse
+import StringIO
+import threading
+import traceback
+import itertools
+import SocketServer
+import multiprocessing
+from multiprocessing.reduction import send_handle, recv_handle
+
+from image_creator import __version__ as version
+from image_creator.util import FatalError
+from image_creator.output.cli import SimpleOutput
+from image_creator.output.composite import CompositeOutput
+from image_creator.output.syslog import SyslogOutput
+from image_creator.output.stream import StreamOutput
+from image_creator.appliance import launch_appliance, hotplug_supported
+from image_creator.main import parse_options, image_creator
+from image_creator.client import SOCKET
+
+
+def _reset_signals():
+    """Restore the default signal handlers in a forked process"""
+    signal.set_wakeup_fd(-1)
+    for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+        signal.signal(signum, signal.SIG_DFL)
+
+
+def _run_job(options, cwd, fd, appliance):
+    """Run a job in a worker process, writing its output to the connection
+    of the client. Returns the exit status of the job.
+    """
+    status = 1
+    try:
+        os.chdir(cwd)
+        conn = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        os.close(fd)
+        stream = StreamOutput(conn.makefile('wb', 0))
+        out = CompositeOutput([stream, SyslogOutput()]) \
+            if options.syslog else stream
+        try:
+            status = image_creator(options, out, None, appliance)
+        except FatalError as e:
+            out.error(e)
+        except Exception:  # pylint: disable=broad-except
+            out.error(traceback.format_exc())
+    finally:
+        if appliance is not None:
+            appliance.close()
+    return status
+
+
+class Worker(object):
+    """A process forked by the spawner that runs a single job"""
+
+    def __init__(self, pid, conn=None):
+        """Create a new Worker instance for a forked process. Workers forked
+        in advance wait for their job on a connection.
+        """
+        self.pid = pid
+        self.conn = conn
+        self.ready = False
+        self.job = None
+
+
+class Spawner(object):
+    """Forks the worker processes that run the jobs. The spawner runs in a
+    single-threaded process of its own, so that the workers inherit no locks
+    held by other threads and no connections used by other processes.
+    """
+
+    def __init__(self, size, output):
+        """Create a new Spawner instance and fork its process. The spawner
+        keeps size workers, each with a launched appliance, ready to run a
+        job. If hot-plugging is not supported, no workers are forked in
+        advance and each job launches its own appliance.
+        """
+        self.out = output
+        self.size = size if hotplug_supported() else 0
+        if size and not self.size:
+            self.out.warn("This build of libguestfs cannot hot-plug drives. "
+                          "No appliances will be launched in advance.")
+
+        self.conn, conn = multiprocessing.Pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            status = 1
+            try:
+                self.conn.close()
+                self.conn = conn
+                self._serve()
+                status = 0
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc()
+            finally:
+                os._exit(status)  # pylint: disable=protected-access
+        conn.close()
+
+        # Used by the threads of the daemon
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._ids = itertools.count()
+        self._results = {}
+        self._reader = threading.Thread(target=self._read, name="spawner")
+        self._reader.daemon = True
+        self._reader.start()
+
+    # Methods called in the daemon process
+
+    def _read(self):
+        """Collect the exit statuses of the jobs reported by the spawner"""
+        while True:
+            try:
+                _, job, status = self.conn.recv()
+            except (EOFError, IOError):
+                break
+            with self._cond:
+                self._results[job] = status
+                self._cond.notify_all()
+
+        # The spawner has gone away. The jobs still running have failed.
+        with self._cond:
+            self._results = None
+            self._cond.notify_all()
+
+    def submit(self, options, cwd, fd):
+        """Submit a job that writes its output to the file descriptor of a
+        client connection. Returns the id of the job.
+        """
+        job = next(self._ids)
+        self._send(('run', job, options, cwd), fd)
+        return job
+
+    def abort(self, job):
+        """Terminate a job"""
+        self._send(('kill', job))
+
+    def _send(self, msg, fd=None):
+        """Send a message and optionally a file descriptor to the spawner.
+        If the spawner has gone away, wait() reports the jobs as failed.
+        """
+        with self._lock:
+            try:
+                self.conn.send(msg)
+                if fd is not None:
+                    send_handle(self.conn, fd, self.pid)
+            except (IOError, OSError):
+                pass
+
+    def wait(self, job, timeout=None):
+        """Wait for a job to finish and return its exit status. Returns None
+        if the timeout expires first.
+        """
+        with self._cond:
+            if self._results is not None and job not in self._results:
+                self._cond.wait(timeout)
+            if self._results is None:
+                return 1
+            return self._results.pop(job, None)
+
+    def close(self):
+        """Terminate the spawner and its workers"""
+        self._send(('stop',))
+        os.waitpid(self.pid, 0)
+
+    # Methods called in the spawner process
+
+    def _fork(self):
+        """Fork a worker process and return its pid in the parent. Returns
+        None in the worker, after closing the connections of the spawner.
+        """
+        pid = os.fork()
+        if pid != 0:
+            return pid
+
+        _reset_signals()
+        self.conn.close()
+        os.close(self._wakeup[0])
+        os.close(self._wakeup[1])
+        for worker in self._workers.values():
+            if worker.conn is not None:
+                worker.conn.close()
+        return None
+
+    def _prefork(self):
+        """Fork a worker that launches an appliance and waits for a job"""
+        conn, worker_conn = multiprocessing.Pipe()
+        pid = self._fork()
+        if pid is not None:
+            worker_conn.close()
+            self._workers[pid] = Worker(pid, conn)
+            return
+
+        status = 1
+        try:
+            conn.close()
+            try:
+                appliance = launch_appliance()
+            except RuntimeError as e:
+                self.out.warn("Launching a helper VM failed: %s" % e)
+                appliance = None
+            try:
+                worker_conn.send(
+                    ('ready', None if appliance is None else
+                     appliance.launch_time))
+                _, _, options, cwd = worker_conn.recv()
+                fd = recv_handle(worker_conn)
+            except (EOFError, IOError):
+                # The spawner is shutting down
+                if appliance is not None:
+                    appliance.close()
+                status = 0
+            else:
+                worker_conn.close()
+                status = _run_job(options, cwd, fd, appliance)
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+        finally:
+            os._exit(status)  # pylint: disable=protected-access
+
+    def _start(self, job, options, cwd, fd):
+        """Hand a job to a worker with a launched appliance or, if there is
+        none, to a newly forked worker.
+        """
+        ready = [w for w in self._workers.values() if w.job is None and
+                 w.ready]
+        if len(ready):
+            worker = ready[0]
+            worker.conn.send(('run', job, options, cwd))
+            send_handle(worker.conn, fd, worker.pid)
+            worker.conn.close()
+            worker.conn = None
+        else:
+            pid = self._fork()
+            if pid is None:
+                status = 1
+                try:
+                    status = _run_job(options, cwd, fd, None)
+                except Exception:  # pylint: disable=broad-except
+                    traceback.print_exc()
+                finally:
+                    os._exit(status)  # pylint: disable=protected-access
+            worker = Worker(pid)
+            self._workers[pid] = worker
+        worker.job = job
+        os.close(fd)
+
+    def _refill(self):
+        """Fork workers in advance until there are enough of them"""
+        idle = [w for w in self._workers.values() if w.job is None]
+        for _ in range(self.size - len(idle)):
+            self._prefork()
+
+    def _reap(self):
+        """Reap the workers that exited and report the jobs that finished"""
+        while len(self._workers):
+            try:
+                pid, code = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if pid == 0:
+                break
+            worker = self._workers.pop(pid, None)
+            if worker is None:
+                continue
+            if worker.conn is not None:
+                worker.conn.close()
+            if worker.job is not None:
+                status = os.WEXITSTATUS(code) if os.WIFEXITED(code) else 1
+                self.conn.send(('exit', worker.job, status))
+
+    def _serve(self):
+        """The main loop of the spawner process"""
+        # The daemon shuts the spawner down by closing the connection
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        # Wake up select when a worker exits
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.set_wakeup_fd(self._wakeup[1])
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        self._workers = {}
+        launch_times = []
+        try:
+            while True:
+                self._refill()
+                conns = dict((w.conn.fileno(), w) for w in
+                             self._workers.values() if w.conn is not None)
+                try:
+                    readable = select.select(
+                        [self.conn.fileno(), self._wakeup[0]] + conns.keys(),
+                        [], [])[0]
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                if self._wakeup[0] in readable:
+                    try:
+                        os.read(self._wakeup[0], 4096)
+                    except OSError:
+                        pass
+                    self._reap()
+
+                for fd in readable:
+                    if fd not in conns:
+                        continue
+                    worker = conns[fd]
+                    try:
+                        _, launch_time = worker.conn.recv()
+                    except EOFError:
+                        # The worker died. It will be reaped.
+                        worker.conn.close()
+                        worker.conn = None
+                        continue
+                    worker.ready = True
+                    if launch_time is not None:
+                        launch_times.append(launch_time)
+
+                if self.conn.fileno() in readable:
+                    try:
+                        msg = self.conn.recv()
+                    except EOFError:
+                        break
+                    if msg[0] == 'stop':
+                        break
+                    elif msg[0] == 'run':
+                        fd = recv_handle(self.conn)
+                        self._start(msg[1], msg[2], msg[3], fd)
+                    elif msg[0] == 'kill':
+                        for worker in self._workers.values():
+                            if worker.job == msg[1]:
+                                os.kill(worker.pid, signal.SIGTERM)
+        finally:
+            self._shutdown()
+
+        if len(launch_times):
+            self.out.info("Launched %d helper VMs in %.1fs on average "
+                          "(min: %.1fs, max: %.1fs)" %
+                          (len(launch_times),
+                           sum(launch_times) / len(launch_times),
+                           min(launch_times), max(launch_times)))
+
+    def _shutdown(self):
+        """Terminate the running jobs and the idle workers"""
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for worker in self._workers.values():
+            if worker.conn is not None:
+                # An idle worker exits when its connection gets closed
+                worker.conn.close()
+                worker.conn = None
+            else:
+                try:
+                    os.kill(worker.pid, signal.SIGTERM)
+                except OSError as e:
+                    if e.errno != errno.ESRCH:
+                        raise
+        for pid in self._workers.keys():
+            os.waitpid(pid, 0)
+        self._workers = {}
+
+
+class JobHandler(SocketServer.StreamRequestHandler):
+    """Handle a job request"""
+
+    def _parse(self, job, out):
+        """Parse the arguments of a job relative to its working directory.
+        Returns the options or None if the arguments are not valid.
+        """
+        stdout, stderr = StringIO.StringIO(), StringIO.StringIO()
+        cwd = job['cwd'].encode('utf-8')
+        if not os.path.isabs(cwd) or not os.path.isdir(cwd):
+            stderr.write("Invalid working directory `%s'\n" % cwd)
+            options = None
+            status = 1
+        else:
+            try:
+                options = parse_options([a.encode('utf-8')
+                                         for a in job['args']],
+                                        cwd=cwd, stdout=stdout, stderr=stderr)
+                status = None
+            except SystemExit as e:
+                options = None
+                status = e.code if isinstance(e.code, int) else 1
+        captured = {'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+        for name, data in captured.items():
+            if len(data):
+                out.send('write', stream=name, data=data.decode('utf-8',
+                                                                'replace'))
+        if options is None:
+            out.send('exit', status=status)
+        return options
+
+    def _run(self, options, cwd):
+        """Run the job in a worker process and return its exit status"""
+        spawner = self.server.spawner
+        job = spawner.submit(options, cwd, self.connection.fileno())
+
+        # The client never writes after the request. If the socket gets
+        # readable, the client has gone away and the job is aborted.
+        aborted = False
+        while True:
+            status = spawner.wait(job, 1)
+            if status is not None:
+                return status
+            if aborted:
+                continue
+            readable = select.select([self.connection], [], [], 0)[0]
+            if not len(readable):
+                continue
+            try:
+                gone = not self.connection.recv(1)
+            except socket.error:
+                gone = True
+            if gone:
+                spawner.abort(job)
+                aborted = True
+
+    def handle(self):
+        out = StreamOutput(self.wfile)
+        try:
+            job = json.loads(self.rfile.readline())
+        except ValueError:
+            job = None
+        if not isinstance(job, dict) or \
+                not isinstance(job.get('cwd'), basestring) or \
+                not isinstance(job.get('args'), list) or \
+                not all(isinstance(a, basestring) for a in job['args']):
+            out.error("Invalid job request")
+            out.send('exit', status=1)
+            return
+
+        options = self._parse(job, out)
+        if options is None:
+            return
+
+        out.send('start', silent=options.silent, timestamp=options.timestamp)
+
+        if not self.server.slots.acquire(False):
+            out.info("Waiting for a running job to finish ...")
+            self.server.slots.acquire()
+        try:
+            status = self._run(options, job['cwd'].encode('utf-8'))
+        finally:
+            self.server.slots.release()
+
+        out.send('exit', status=status)
+
+    def finish(self):
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass  # The client has gone away
+
+
+class Daemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """The snf-mkimage daemon"""
+
+    daemon_threads = True
+
+    def __init__(self, path, jobs, spawner):
+        """Create a new Daemon instance listening on a UNIX socket. The jobs
+        are run by the processes of a spawner, up to the specified number in
+        parallel.
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        elif not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0o755)
+
+        umask = os.umask(0o077)  # Only root may submit jobs
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, JobHandler)
+        finally:
+            os.umask(umask)
+
+        self.path = path
+        self.slots = threading.Semaphore(jobs)
+        self.spawner = spawner
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.spawner.close()
+
+
+def parse_daemon_options():
+    """Parse the daemon command line parameters"""
+    description = "Serve image creation jobs submitted with snf-mkimage-client"
+    parser = argparse.ArgumentParser(version=version, description=description)
+
+    parser.add_argument(
+        "-j", "--jobs", dest="jobs", default=2, type=int, metavar="N",
+        help="run up to N jobs in parallel")
+
+    parser.add_argument(
+        "--appliances", dest="appliances", default=1, type=int, metavar="N",
+        help="keep N helper VMs launched and ready to be used by the jobs")
+
+    parser.add_argument(
+        "--socket", dest="socket", default=SOCKET, metavar="PATH",
+        help="listen for jobs on the UNIX socket PATH")
+
+    options = parser.parse_args()
+
+    if options.jobs < 1:
+        parser.error("The number of jobs must be a positive integer")
+
+    if options.appliances < 0:
+        parser.error("The number of helper VMs must not be negative")
+
+    return options
+
+
+def main():
+    """Entry point of the daemon"""
+    options = parse_daemon_options()
+    out = SimpleOutput(colored=False, timestamp=True)
+
+    if os.geteuid() != 0:
+        out.error("You must run %s as root" % os.path.basename(sys.argv[0]))
+        sys.exit(1)
+
+    # The spawner must be forked before any thread is started
+    spawner = Spawner(options.appliances, out)
+    daemon = Daemon(options.socket, options.jobs, spawner)
+
+    # pylint: disable=unused-argument
+    def signal_handler(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    out.info("snf-image-creator %s daemon listening on `%s'" %
+             (version, options.socket))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        out.info("Shutting down ...")
+        daemon.server_close()
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2017 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module allocates the loop, NBD and device-mapper devices used by
+snf-image-creator. The processes that run on the same host serialize their
+allocations with a lock under /run. Each process records the devices it owns
+in files that it keeps locked for as long as it uses them, so that the devices
+of processes that died without cleaning up can be found and reaped.
+"""
+
+import os
+import re
+import time
+import errno
+import fcntl
+import threading
+
+import sh
+
+from image_creator.util import FatalError, try_fail_repeat, LazyCommand, \
+    static_vars
+
+RUN_DIR = '/run' if os.path.isdir('/run') else '/var/run'
+LOCK_DIR = os.path.join(RUN_DIR, 'snf-image-creator')
+
+# All the device-mapper devices of snf-image-creator are named like this
+DM_PREFIX = 'snf-image-creator-'
+
+dmsetup = LazyCommand('dmsetup')
+losetup = LazyCommand('losetup')
+modprobe = LazyCommand('modprobe')
+qemu_nbd = LazyCommand('qemu-nbd')
+
+_lock = threading.RLock()
+_lock_state = {'depth': 0, 'file': None}
+
+
+def _lock_dir():
+    """Returns the directory of the lock files, after creating it"""
+    try:
+        os.makedirs(LOCK_DIR, 0o755)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return LOCK_DIR
+
+
+def _flock(fileobj):
+    """Lock a file without blocking. Returns False if it is already locked"""
+    try:
+        fcntl.flock(fileobj.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return False
+        raise
+    return True
+
+
+class AllocationLock(object):
+    """Context manager that serializes the device allocations of all the
+    snf-image-creator processes of the host. It may be nested.
+    """
+
+    def __enter__(self):
+        _lock.acquire()
+        try:
+            if _lock_state['depth'] == 0:
+                lock = open(os.path.join(_lock_dir(), 'lock'), 'a')
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                _lock_state['file'] = lock
+        except (IOError, OSError):
+            _lock.release()
+            raise
+        _lock_state['depth'] += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _lock_state['depth'] -= 1
+        if _lock_state['depth'] == 0:
+            _lock_state['file'].close()
+            _lock_state['file'] = None
+        _lock.release()
+
+
+class Claim(object):
+    """A device owned by this process. The ownership is recorded in a file
+    that stays locked until the claim is released or the process exits.
+    """
+
+    def __init__(self, kind, name):
+        """Create a new Claim instance for a device of a kind (dm, loop or
+        nbd) with the specified name.
+        """
+        self.kind = kind
+        self.name = name
+        self.path = os.path.join(_lock_dir(), "%s.%s" % (kind, name))
+        self._file = None
+
+    def acquire(self, data=''):
+        """Claim the device and record some data about it. Returns False if
+        the device is owned by another process.
+        """
+        with AllocationLock():
+            record = open(self.path, 'a+')
+            if not _flock(record):
+                record.close()
+                return False
+            record.truncate(0)
+            record.write(data)
+            record.flush()
+            self._file = record
+        return True
+
+    def release(self):
+        """Release the device"""
+        if self._file is None:
+            return
+        with AllocationLock():
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self._file.close()
+            self._file = None
+
+
+def _claim(kind, name, data=''):
+    """Claim a device or fail"""
+    claim = Claim(kind, name)
+    if not claim.acquire(data):
+        raise FatalError("Device `%s' is in use by another process" % name)
+    return claim
+
+
+def attach_loop(fname):
+    """Attach a file to a free loop device. Returns the loop device and its
+    claim.
+    """
+    with AllocationLock():
+        loop = str(losetup('-f', '--show', fname)).strip()
+        try:
+            claim = _claim('loop', os.path.basename(loop),
+                           os.path.realpath(fname))
+        except (FatalError, IOError, OSError):
+            try_fail_repeat(losetup, '-d', loop)
+            raise
+    return loop, claim
+
+
+def detach_loop(loop, claim):
+    """Detach a loop device and release it"""
+    with AllocationLock():
+        try_fail_repeat(losetup, '-d', loop)
+        claim.release()
+
+
+def create_dm(name, tablefile):
+    """Create a device-mapper device out of a table file. Returns the claim of
+    the device.
+    """
+    with AllocationLock():
+        claim = _claim('dm', name)
+        try:
+            dmsetup('create', name, tablefile)
+        except (sh.ErrorReturnCode, sh.CommandNotFound, OSError):
+            claim.release()
+            raise
+    return claim
+
+
+def remove_dm(name, claim):
+    """Remove a device-mapper device and release it"""
+    try_fail_repeat(dmsetup, 'remove', name)
+    claim.release()
+
+
+def _loop_backing_file(loop):
+    """Returns the backing file of a loop device or None if it's detached"""
+    try:
+        with open('/sys/block/%s/loop/backing_file' % loop) as f:
+            backing = f.read().strip()
+    except IOError:
+        return None
+    if backing.endswith(' (deleted)'):
+        backing = backing[:-len(' (deleted)')]
+    return backing
+
+
+def _nbd_connected(nbd):
+    """Check if an NBD device is connected"""
+    return os.path.exists('/sys/block/%s/pid' % nbd)
+
+
+def _dm_devices():
+    """Returns the names of the device-mapper devices of snf-image-creator.
+    Thin volumes and snapshots are listed before the pools they depend on.
+    """
+    names = []
+    for line in str(dmsetup('ls')).splitlines():
+        entry = line.split()
+        if len(entry) and entry[0].startswith(DM_PREFIX):
+            names.append(entry[0])
+    return sorted(names, key=lambda n: n.startswith(DM_PREFIX + 'pool-'))
+
+
+@static_vars(done=False)
+def reap():
+    """Tear down the devices of the snf-image-creator processes that are no
+    longer running. Only the devices with a record that is not locked by a
+    running process are reaped. Returns the names of the devices that were
+    reaped. This is only done the first time it is called in a process, since
+    the devices of the processes started later are never stale.
+    """
+    if reap.done:
+        return []
+    reap.done = True
+
+    reaped = []
+    with AllocationLock():
+        stale = []
+        for record in os.listdir(_lock_dir()):
+            if '.' not in record:
+                continue
+            kind, name = record.split('.', 1)
+            path = os.path.join(LOCK_DIR, record)
+            try:
+                f = open(path, 'r+')
+            except IOError:
+                continue
+            if not _flock(f):
+                f.close()
+                continue
+            stale.append((kind, name, f.read().strip(), path, f))
+
+        try:
+            dm = set(name for kind, name, _, _, _ in stale if kind == 'dm')
+            for name in _dm_devices():
+                if name not in dm:
+                    continue
+                try:
+                    dmsetup('remove', name)
+                    reaped.append(name)
+                except sh.ErrorReturnCode:
+                    pass  # in use
+
+            for kind, name, data, _, _ in stale:
+                # The kernel reports the backing file with the symbolic
+                # links resolved
+                if kind == 'loop' and \
+                        _loop_backing_file(name) == os.path.realpath(data):
+                    try:
+                        losetup('-d', '/dev/%s' % name)
+                        reaped.append(name)
+                    except sh.ErrorReturnCode:
+                        pass
+                elif kind == 'nbd' and _nbd_connected(name):
+                    try:
+                        qemu_nbd('-d', '/dev/%s' % name)
+                        reaped.append(name)
+                    except (sh.ErrorReturnCode, sh.CommandNotFound):
+                        pass
+        finally:
+            for _, _, _, path, f in stale:
+                os.unlink(path)
+                f.close()
+
+    return reaped
+
+
+class QemuNBD(object):
+    """Wrapper class for the qemu-nbd tool"""
+
+    def __init__(self, image):
+        """Initialize an instance"""
+        self.image = image
+        self.device = None
+        self.claim = None
+        self.pattern = re.compile(r'^nbd\d+$')
+
+    @staticmethod
+    def available():
+        """Check if the qemu-nbd command is installed"""
+        try:
+            str(qemu_nbd)
+        except sh.CommandNotFound:
+            return False
+        return True
+
+    def _list_devices(self):
+        """Returns all the NBD block devices"""
+        return set([d for d in os.listdir('/dev/') if self.pattern.match(d)])
+
+    def connect(self, ro=True):
+        """Connect the image to a free NBD device"""
+
+        assert self.available(), "qemu-nbd command not found"
+
+        devs = self._list_devices()
+
+        if len(devs) == 0:  # Is nbd module loaded?
+            modprobe('nbd', 'max_part=16')
+            # Wait a second for /dev to be populated
+            time.sleep(1)
+            devs = self._list_devices()
+            if len(devs) == 0:
+                raise FatalError("/dev/nbd* devices not present!")
+
+        with AllocationLock():
+            # Ignore the nbd block devices that are in use
+            with open('/proc/partitions') as partitions:
+                for line in iter(partitions):
+                    entry = line.split()
+                    if len(entry) != 4:
+                        continue
+                    if entry[3] in devs:
+                        devs.remove(entry[3])
+
+            claim = None
+            for dev in sorted(devs, key=lambda d: int(d[3:])):
+                if _nbd_connected(dev):
+                    continue
+                claim = Claim('nbd', dev)
+                if claim.acquire(os.path.realpath(self.image)):
+                    break
+                claim = None
+
+            if claim is None:
+                raise FatalError("All NBD block devices are busy!")
+
+            device = '/dev/%s' % claim.name
+            args = ['-c', device]
+            if ro:
+                args.append('-r')
+            args.append(self.image)
+
+            try:
+                qemu_nbd(*args)
+            except (sh.ErrorReturnCode, OSError):
+                claim.release()
+                raise
+
+        self.device = device
+        self.claim = claim
+        return device
+
+    def disconnect(self):
+        """Disconnect the image from the connected device"""
+        assert self.device is not None, "No device connected"
+
+        with AllocationLock():
+            qemu_nbd('-d', self.device)
+            self.claim.release()
+        self.device = None
+        self.claim = None
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -167,17 +167,19 @@ def upload_image(session):
         out.append(gauge)
         kamaki.out = out
         try:
-            if 'checksum' not in session:
-                session['checksum'] = image.md5()
+            if 'checksum' not in session or 'hashmap' not in session:
+                digests = image.checksum()
+                session['checksum'] = digests['md5']
+                session['hashmap'] = digests['hashmap']
 
             try:
                 # Upload image file
-                with image.raw_device() as raw:
-                    with open(raw, 'rb') as f:
-                        cloud["uploaded"] = \
-                            kamaki.upload(f, image.size, name, container, None,
-                                          "Calculating block hashes",
-                                          "Uploading missing blocks")
+                with image.reader() as f:
+                    cloud["uploaded"] = \
+                        kamaki.upload(f, image.size, name, container, None,
+                                      "Calculating block hashes",
+                                      "Uploading missing blocks",
+                                      hashmap=session['hashmap'])
                 # Upload md5sum file
                 out.info("Uploading md5sum file ...")
                 md5str = "%s %s\n" % (session['checksum'], name)
@@ -1022,8 +1024,9 @@ def sysprep(session):
                 image.out.append(infobox)
                 try:
                     # The checksum is invalid. We have mounted the image rw
-                    if 'checksum' in session:
-                        del session['checksum']
+                    for key in ('checksum', 'hashmap'):
+                        if key in session:
+                            del session[key]
 
                     # Monitor the metadata changes during syspreps
                     with MetadataMonitor(session, image.os.meta):
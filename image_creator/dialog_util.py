@@ -207,7 +207,8 @@ def extract_image(session):
         if len(name) == 0:
             continue
 
-        files = ["%s%s" % (path, ext) for ext in ('', '.meta', '.md5sum')]
+        files = ["%s%s" % (path, ext)
+                 for ext in ('', '.meta', '.md5sum', '.sha256sum')]
         overwrite = filter(os.path.exists, files)
 
         if len(overwrite) > 0:
@@ -222,11 +223,11 @@ def extract_image(session):
             out = image.out
             out.append(gauge)
             try:
-                if "checksum" not in session:
-                    session['checksum'] = image.md5()
-
-                # Extract image file
-                image.dump(path)
+                # Extract image file. The checksums are computed in the same
+                # pass.
+                digests = image.dump(path)
+                session['checksum'] = digests['md5']
+                session['hashmap'] = digests['hashmap']
 
                 # Extract metadata file
                 out.info("Extracting metadata file ...", False)
@@ -247,6 +248,12 @@ def extract_image(session):
                     f.write(md5str)
                 out.success("done")
 
+                # Extract sha256sum file
+                out.info("Extracting sha256sum file ...", False)
+                with open('%s.sha256sum' % path, 'w') as f:
+                    f.write("%s %s\n" % (digests['sha256'], name))
+                out.success("done")
+
             finally:
                 out.remove(gauge)
         finally:
@@ -463,8 +463,10 @@ def create_image(session, answers):
 
         metadata['DESCRIPTION'] = answers['ImageDescription']
 
-        # MD5
-        session['checksum'] = image.md5()
+        # Checksums
+        digests = image.checksum()
+        session['checksum'] = digests['md5']
+        session['hashmap'] = digests['hashmap']
 
         image.out.info()
         try:
@@ -475,12 +477,12 @@ def create_image(session, answers):
 
             name = "%s-%s.diskdump" % (answers['ImageName'],
                                        time.strftime("%Y%m%d%H%M"))
-            with image.raw_device() as raw:
-                with open(raw, 'rb') as device:
-                    remote = kamaki.upload(device, image.size, name, CONTAINER,
-                                           None,
-                                           "(1/3)  Calculating block hashes",
-                                           "(2/3)  Uploading image blocks")
+            with image.reader() as device:
+                remote = kamaki.upload(device, image.size, name, CONTAINER,
+                                       None,
+                                       "(1/3)  Calculating block hashes",
+                                       "(2/3)  Uploading image blocks",
+                                       hashmap=session['hashmap'])
 
             image.out.info("(3/3)  Uploading md5sum file ...", False)
             md5sumstr = '%s %s\n' % (session['checksum'], name)
@@ -22,16 +22,36 @@ import os
 import tempfile
 import uuid
 import shutil
+import hashlib
 
-from image_creator.util import get_command, try_fail_repeat, free_space, \
-    FatalError, create_snapshot, image_info
-from image_creator.bundle_volume import BundleVolume
+from image_creator.util import LazyCommand, free_space, FatalError, \
+    create_snapshot, image_info, reflink
+from image_creator import devices
 from image_creator.image import Image
+from image_creator.tmpspace import TmpSpace, SpaceMonitor, estimate, \
+    estimate_media
 
-dd = get_command('dd')
-dmsetup = get_command('dmsetup')
-losetup = get_command('losetup')
-blockdev = get_command('blockdev')
+# The minimum and default chunk size of dm-thin pools
+THIN_CHUNK_SIZE = 64 * 1024
+
+# The metadata block size of dm-thin pools and the minimum metadata size
+THIN_METADATA_BLOCK = 4096
+THIN_METADATA_MIN = 2 * 2 ** 20
+
+# How much of a block device is hashed to tell if it changed
+PROBE_FINGERPRINT_SIZE = 2 ** 20
+
+dd = LazyCommand('dd')
+dmsetup = LazyCommand('dmsetup')
+
+
+def _device_size(path):
+    """Returns the size of a block device in bytes"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
 
 
 def get_tmp_dir(default=None):
@@ -64,19 +84,45 @@ class Disk(object):
 
     A Disk instance never alters the source media it is created from.
     Any change is done on a snapshot created by the device-mapper of
-    the Linux kernel.
+    the Linux kernel, or on a reflink copy of the source image file.
     """
 
-    def __init__(self, source, output, tmp=None):
+    def __init__(self, source, output, tmp=None, **kwargs):
         """Create a new Disk instance out of a source media. The source
         media can be an image file, a block device or a directory.
         """
         self._cleanup_jobs = []
         self._images = []
         self._file = None
+        self._pool = None
+        self._thin = None
+        self._snapshot = None
+        self._space = None
+        self._monitor = None
+        self._probes = {}
+        self._devices = set()
         self.source = source
         self.out = output
         self.meta = {}
+
+        # The device-mapper target used for snapshotting raw media:
+        # dm-snapshot or dm-thin
+        self.snapshot_backend = kwargs['snapshot_backend'] \
+            if 'snapshot_backend' in kwargs else 'dm-snapshot'
+        self.chunk_size = kwargs['chunk_size'] if 'chunk_size' in kwargs \
+            else THIN_CHUNK_SIZE
+
+        if self.chunk_size % THIN_CHUNK_SIZE or \
+                not THIN_CHUNK_SIZE <= self.chunk_size <= 2 ** 30:
+            raise FatalError("The chunk size of the snapshot pool must be a "
+                             "multiple of 64KB between 64KB and 1GB")
+
+        # Clean up after the processes that died without doing so
+        reaped = devices.reap()
+        if len(reaped):
+            self.out.warn("Removed stale devices left behind by processes "
+                          "that are no longer running: %s" % ", ".join(reaped))
+
         self.tmp = tempfile.mkdtemp(prefix='.snf_image_creator.',
                                     dir=get_tmp_dir(tmp))
 
@@ -90,14 +136,16 @@ class Disk(object):
         """Setup a loop device and add it to the cleanup list. The loop device
         will be detached when cleanup is called.
         """
-        loop = losetup('-f', '--show', fname)
-        loop = loop.strip()  # remove the new-line char
-        self._add_cleanup(try_fail_repeat, losetup, '-d', loop)
+        loop, claim = devices.attach_loop(fname)
+        self._add_cleanup(devices.detach_loop, loop, claim)
         return loop
 
     def _dir_to_disk(self):
         """Create a disk out of a directory."""
         if self.source == '/':
+            # Only needed for bundling the host
+            from image_creator.bundle_volume import BundleVolume
+
             bundle = BundleVolume(self.out, self.meta)
             image = '%s/%s.raw' % (self.tmp, uuid.uuid4().hex)
 
@@ -160,7 +208,7 @@ class Disk(object):
             return self.file
 
         # Examine media file
-        info = image_info(self.file)
+        info = self.image_info(self.file)
 
         self.out.info("Snapshotting media source ...", False)
 
@@ -171,37 +219,240 @@ class Disk(object):
             self.out.success('done')
             return snapshot
 
-        # Create a device-mapper snapshot for raw image files and block devices
+        # Raw image files on file systems that support reflinks (like btrfs
+        # and XFS) are cloned. The copy is instant and independent.
         mode = os.stat(self.file).st_mode
+        if stat.S_ISREG(mode):
+            clone = "%s/%s.raw" % (self.tmp, uuid.uuid4().hex)
+            if reflink(self.file, clone):
+                self._add_cleanup(os.unlink, clone)
+                # The clone has the format and size of the source, but the
+                # file name fields must describe the clone.
+                info = dict(info, filename=clone)
+                if 'backing-chain' in info:
+                    info['backing-chain'] = \
+                        [dict(info['backing-chain'][0], filename=clone)] + \
+                        info['backing-chain'][1:]
+                self._cache_info(clone, info)
+                self.out.success('done')
+                return clone
+
+        # Create a device-mapper snapshot for raw image files and block devices
         device = self.file if stat.S_ISBLK(mode) else self._losetup(self.file)
-        size = int(blockdev('--getsz', device))
+        if 'virtual-size' in info:
+            # This is what the loop device would report
+            size = info['virtual-size'] // 512
+        else:
+            size = _device_size(device) // 512
+
+        if self.snapshot_backend == 'dm-thin':
+            snapshot = self._thin_snapshot(device, size)
+            self._cache_info(snapshot, {'format': 'raw', 'filename': snapshot,
+                                        'virtual-size': size * 512})
+            self.out.success('done')
+            return snapshot
 
-        cowfd, cow = tempfile.mkstemp(dir=self.tmp)
-        os.close(cowfd)
-        self._add_cleanup(os.unlink, cow)
         # Create cow sparse file
-        dd('if=/dev/null', 'of=%s' % cow, 'bs=512', 'seek=%d' % size)
-        cowdev = self._losetup(cow)
+        cowdev = self._losetup(self._sparse_file(size))
 
         snapshot = 'snf-image-creator-snapshot-%s' % uuid.uuid4().hex
-        tablefd, table = tempfile.mkstemp()
+        self._dmsetup_create(snapshot, "0 %d snapshot %s %s n 8\n" %
+                             (size, device, cowdev))
+        self._snapshot = snapshot
+        path = "/dev/mapper/%s" % snapshot
+        self._cache_info(path, {'format': 'raw', 'filename': path,
+                                'virtual-size': size * 512})
+        self.out.success('done')
+        return path
+
+    def _probe_key(self, path):
+        """Returns the key of a file in the probe cache. The key changes if
+        the file gets modified.
+        """
+        st = os.stat(path)
+        realpath = os.path.realpath(path)
+        if not stat.S_ISBLK(st.st_mode):
+            return (realpath, st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+
+        # The devices this instance created only change through it
+        if realpath in self._devices:
+            return (realpath, st.st_rdev)
+
+        # The inode of a block device does not change when the data on the
+        # device does. Use the size and a fingerprint of the first MB instead.
+        with open(path, 'rb') as f:
+            size = os.lseek(f.fileno(), 0, os.SEEK_END)
+            os.lseek(f.fileno(), 0, os.SEEK_SET)
+            head = hashlib.md5(f.read(PROBE_FINGERPRINT_SIZE)).hexdigest()
+        return (realpath, st.st_rdev, size, head)
+
+    def _cache_info(self, path, info):
+        """Add the information about a file this instance created to the
+        probe cache
+        """
+        if stat.S_ISBLK(os.stat(path).st_mode):
+            self._devices.add(os.path.realpath(path))
+        self._probes[self._probe_key(path)] = info
+
+    def image_info(self, path):
+        """Returns information about an image file, like util.image_info does.
+        The result is cached for as long as the file is not modified.
+        """
+        key = self._probe_key(path)
+        if key not in self._probes:
+            self._probes[key] = image_info(path)
+        return self._probes[key]
+
+    def _sparse_file(self, size):
+        """Create a sparse file of size sectors in the tmp directory and add
+        it to the cleanup list.
+        """
+        fd, path = tempfile.mkstemp(dir=self.tmp)
+        os.close(fd)
+        self._add_cleanup(os.unlink, path)
+        dd('if=/dev/null', 'of=%s' % path, 'bs=512', 'seek=%d' % size)
+        return path
+
+    def _dmsetup_create(self, name, table):
+        """Create a device-mapper device and add it to the cleanup list"""
+        tablefd, tablefile = tempfile.mkstemp()
         try:
             try:
-                os.write(tablefd, "0 %d snapshot %s %s n 8\n" %
-                         (size, device, cowdev))
+                os.write(tablefd, table)
             finally:
                 os.close(tablefd)
 
-            dmsetup('create', snapshot, table)
-            self._add_cleanup(try_fail_repeat, dmsetup, 'remove', snapshot)
+            claim = devices.create_dm(name, tablefile)
+            self._add_cleanup(devices.remove_dm, name, claim)
         finally:
-            os.unlink(table)
-        self.out.success('done')
-        return "/dev/mapper/%s" % snapshot
+            os.unlink(tablefile)
+
+    def _thin_snapshot(self, origin, size):
+        """Create a thin volume of size sectors that has the origin device as
+        external origin. The pool data and metadata are stored in sparse
+        files in the tmp directory. The pool passes discards down to its data
+        device, so that discarded regions free space in the tmp directory.
+        """
+        chunk = self.chunk_size // 512  # in sectors
+        chunks = (size + chunk - 1) // chunk
+
+        # Room for the mappings of all the chunks, like thin_metadata_size
+        # would suggest, plus some slack for the space maps.
+        metasize = max(THIN_METADATA_MIN, 64 * chunks + THIN_METADATA_MIN)
+        metadev = self._losetup(self._sparse_file(metasize // 512))
+        datadev = self._losetup(self._sparse_file(chunks * chunk))
+
+        uid = uuid.uuid4().hex
+        self._pool = 'snf-image-creator-pool-%s' % uid
+        self._dmsetup_create(self._pool, "0 %d thin-pool %s %s %d 0\n" %
+                             (chunks * chunk, metadev, datadev, chunk))
+
+        dmsetup('message', self._pool, '0', 'create_thin 0')
+
+        snapshot = 'snf-image-creator-snapshot-%s' % uid
+        self._dmsetup_create(snapshot, "0 %d thin /dev/mapper/%s 0 %s\n" %
+                             (size, self._pool, origin))
+        self._thin = "/dev/mapper/%s" % snapshot
+        return self._thin
+
+    def snapshot_usage(self):
+        """Returns a dictionary with the used and total data and metadata
+        space of the snapshot pool in bytes, or None if the snapshot is not
+        a thin volume.
+        """
+        if self._pool is None:
+            return None
+
+        # <start> <length> thin-pool <transaction id>
+        # <used metadata blocks>/<total metadata blocks>
+        # <used data blocks>/<total data blocks> ...
+        status = str(dmsetup('status', self._pool)).split()
+        meta_used, meta_total = [int(n) for n in status[4].split('/')]
+        data_used, data_total = [int(n) for n in status[5].split('/')]
+        return {'data_used': data_used * self.chunk_size,
+                'data_total': data_total * self.chunk_size,
+                'metadata_used': meta_used * THIN_METADATA_BLOCK,
+                'metadata_total': meta_total * THIN_METADATA_BLOCK}
+
+    def snapshot_status(self):
+        """Returns a (used, total) tuple with the bytes used and available in
+        the COW store of the snapshot or the data device of the thin pool.
+        If the snapshot is invalid, (None, None) is returned. If the snapshot
+        is not created by the device-mapper, None is returned.
+        """
+        if self._pool is not None:
+            usage = self.snapshot_usage()
+            return usage['data_used'], usage['data_total']
+
+        if self._snapshot is None:
+            return None
+
+        # <start> <length> snapshot <used sectors>/<total sectors> <metadata>
+        status = str(dmsetup('status', self._snapshot)).split()
+        if len(status) < 4 or '/' not in status[3]:
+            return None, None
+        used, total = [int(n) * 512 for n in status[3].split('/')]
+        return used, total
+
+    def _media_size(self):
+        """Returns the size of the source media in bytes"""
+        info = self.image_info(self.file)
+        if 'virtual-size' in info:
+            return info['virtual-size']
+        if stat.S_ISBLK(os.stat(self.file).st_mode):
+            return _device_size(self.file)
+        return os.path.getsize(self.file)
+
+    def reserve_space(self, image=None, wait=False):
+        """Reserve the space in the tmp directory that the system preparation
+        of the image is expected to need and start monitoring the usage of
+        the snapshot. If no image is given, the estimate is based on the size
+        of the source media. Calling this again adjusts the reservation. If
+        the space is not available and wait is True, wait for the other jobs
+        to free it, otherwise fail.
+        """
+        if image is None:
+            size = estimate_media(self._media_size())
+        else:
+            size = estimate(image)
+
+        if self._space is not None:
+            self._space.reserve(size, wait)
+            return
+
+        space = TmpSpace(self.tmp, self.out)
+        space.reserve(size, wait)
+        self._space = space
+        self._add_cleanup(space.release)
+
+        self._monitor = SpaceMonitor(self, self.out)
+        self._monitor.start()
+        self._add_cleanup(self._monitor.stop)
+
+    def report_snapshot_usage(self):
+        """Print how much of the snapshot pool is used, along with the
+        warnings of the space monitor.
+        """
+        if self._monitor is not None:
+            self._monitor.report()
+
+        usage = self.snapshot_usage()
+        if usage is None:
+            return
+
+        MB = 2 ** 20
+        self.out.info("Snapshot pool usage: %d/%d MB of data, %d/%d MB of "
+                      "metadata" % (usage['data_used'] // MB,
+                                    usage['data_total'] // MB,
+                                    usage['metadata_used'] // MB,
+                                    usage['metadata_total'] // MB))
 
     def get_image(self, media, **kwargs):
         """Returns a newly created Image instance."""
-        info = image_info(media)
+        info = self.image_info(media)
+        if media == self._thin:
+            # Let the discards reach the pool
+            kwargs.setdefault('discard', True)
         image = Image(media, self.out, format=info['format'], **kwargs)
         self._images.append(image)
         image.enable()
@@ -18,18 +18,106 @@
 """Module hosting the Image class."""
 
 import os
+import io
 import re
+import errno
+import stat
 import hashlib
-from sendfile import sendfile
+import bisect
+import json
 import threading
+import time
+import subprocess
 
-from image_creator.util import FatalError, QemuNBD, get_command
+from image_creator.util import FatalError, get_command, image_extents, \
+    file_extents, fadvise_dontneed, qemu_img_version
+from image_creator.devices import QemuNBD
 from image_creator.gpt import GPTPartitionTable
+from image_creator.allocation import unused_extents, subtract
+from image_creator.compression import Compressor
+from image_creator.nbd import NBDServer, NBDFile
+from image_creator.checksum import Checksum, BlockHash, \
+    PITHOS_BLOCK_SIZE, PITHOS_BLOCK_HASH
 from image_creator.os_type import os_cls
 
-# Make sure libguestfs runs qemu directly to launch an appliance.
-os.environ['LIBGUESTFS_BACKEND'] = 'direct'
-import guestfs  # noqa pylint: disable=wrong-import-position,wrong-import-order
+# How often the progress of a resumable dump is committed
+CHECKPOINT_INTERVAL = 2 ** 30  # 1GB
+
+# The supported export formats and their file extensions
+EXPORT_FORMATS = {'qcow2': '.qcow2', 'vmdk': '.vmdk'}
+
+# The number of parallel coroutines qemu-img uses when exporting
+EXPORT_COROUTINES = 16
+
+# Alignment of the buffers, offsets and sizes of direct I/O requests
+DIRECT_IO_ALIGNMENT = 4096
+
+# How often the written data are dropped from the page cache when dumping
+# with direct I/O
+DROP_CACHE_INTERVAL = 64 * 2 ** 20  # 64MB
+
+# Make sure libguestfs runs qemu directly to launch an appliance, unless the
+# user asked for a different backend. The libvirt backend is needed for
+# hot-plugging drives to pre-launched appliances. The guestfs module itself is
+# loaded when an image is created, since it takes a while.
+os.environ.setdefault('LIBGUESTFS_BACKEND', 'direct')
+
+
+class PayloadFile(object):
+    """Read-only file object that exposes the first size bytes of another
+    file. Only the regions described by a sorted list of (offset, length)
+    extents are read from the underlying file. The rest read as zeros.
+    """
+
+    def __init__(self, fileobj, size, extents):
+        """Create a new PayloadFile instance"""
+        self.name = fileobj.name
+        self.size = size
+        self._file = fileobj
+        self._extents = extents
+        self._starts = [start for start, _ in extents]
+        self._pos = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Set the file's current position"""
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._pos = max(0, offset)
+
+    def tell(self):
+        """Return the file's current position"""
+        return self._pos
+
+    def read(self, size=-1):
+        """Read at most size bytes from the file"""
+        end = self.size if size < 0 else min(self._pos + size, self.size)
+
+        chunks = []
+        pos = self._pos
+        idx = max(0, bisect.bisect_right(self._starts, pos) - 1)
+        for start, length in self._extents[idx:]:
+            if pos >= end or start >= end:
+                break
+            if start + length <= pos:
+                continue
+            if start > pos:
+                chunks.append('\0' * (start - pos))
+                pos = start
+            self._file.seek(pos)
+            data = self._file.read(min(start + length, end) - pos)
+            if len(data) == 0:
+                break
+            chunks.append(data)
+            pos += len(data)
+
+        if pos < end:
+            chunks.append('\0' * (end - pos))
+            pos = end
+
+        self._pos = max(pos, self._pos)
+        return ''.join(chunks)
 
 
 class Image(object):
@@ -46,10 +134,30 @@ class Image(object):
         self.sysprep_params = \
             kwargs['sysprep_params'] if 'sysprep_params' in kwargs else {}
 
+        # If set, the blocks that the file systems don't use are treated as
+        # zeros and are never read.
+        self.skip_unused = \
+            kwargs['skip_unused'] if 'skip_unused' in kwargs else False
+
+        # If set, the image is read with direct I/O when dumping it or
+        # computing its checksums.
+        self.direct_io = \
+            kwargs['direct_io'] if 'direct_io' in kwargs else False
+
+        # If set, the device supports discards and the freed blocks of the
+        # file systems are trimmed after the system preparation.
+        self.discard = kwargs['discard'] if 'discard' in kwargs else False
+
+        # A launched libguestfs appliance the device gets hot-plugged to,
+        # instead of launching a new one
+        self.appliance = \
+            kwargs['appliance'] if 'appliance' in kwargs else None
+
         self.progress_bar = None
         self.guestfs_device = None
         self.size = 0
 
+        import guestfs
         self.g = guestfs.GuestFS()
         self.guestfs_enabled = False
         self.guestfs_version = self.g.version()
@@ -57,7 +165,7 @@ class Image(object):
         # This is needed if the image format is not raw
         self.nbd = QemuNBD(device)
 
-        if self.nbd.qemu_nbd is None and self.format != 'raw':
+        if self.format != 'raw' and not self.nbd.available():
             raise FatalError("qemu-nbd command is missing, only raw input "
                              "media are supported")
 
@@ -97,7 +205,6 @@ class Image(object):
             self.root = None
             self.ostype = "unsupported"
             self.distro = "unsupported"
-            self.guestfs_device = '/dev/sda'
             self.size = self.g.blockdev_getsize64(self.guestfs_device)
 
             if len(roots) > 1:
@@ -109,8 +216,8 @@ class Image(object):
             return
 
         self.root = roots[0]
-        self.meta['PARTITION_TABLE'] = self.g.part_get_parttype('/dev/sda')
-        self.guestfs_device = '/dev/sda'  # self.g.part_to_dev(self.root)
+        self.meta['PARTITION_TABLE'] = \
+            self.g.part_get_parttype(self.guestfs_device)
         self.size = self.g.blockdev_getsize64(self.guestfs_device)
 
         self.ostype = self.g.inspect_get_type(self.root)
@@ -140,13 +247,22 @@ class Image(object):
             self.out.warn("Guestfs is already enabled")
             return
 
+        if self.appliance is not None and self._attach():
+            return
+
         # Before version 1.18.4 the behavior of kill_subprocess was different
         # and you need to reset the guestfs handler to relaunch a previously
         # shut down QEMU backend
         if self.check_guestfs_version(1, 18, 4) < 0:
+            import guestfs
             self.g = guestfs.GuestFS()
 
-        self.g.add_drive_opts(self.device, readonly=0)
+        # The discard option was added in version 1.23.10
+        if self.discard and self.check_guestfs_version(1, 23, 10) >= 0:
+            self.g.add_drive_opts(self.device, readonly=0,
+                                  discard='besteffort')
+        else:
+            self.g.add_drive_opts(self.device, readonly=0)
 
         # Before version 1.17.14 the recovery process, which is a fork of the
         # original process that called libguestfs, did not close its inherited
@@ -176,6 +292,7 @@ class Image(object):
                 "Please run `libguestfs-test-tool' for more info." % str(e))
 
         self.guestfs_enabled = True
+        self.guestfs_device = '/dev/sda'
         # self.g.delete_event_callback(eh)
         # self.progressbar.success('done')
         # self.progressbar = None
@@ -185,6 +302,31 @@ class Image(object):
 
         self.out.success('done')
 
+    def _attach(self):
+        """Hot-plug the device to the pre-launched appliance. Returns False if
+        this fails, in which case the appliance is not used any more.
+        """
+        self.out.info("Attaching media to a pre-launched helper VM ...", False)
+        discard = self.discard and self.check_guestfs_version(1, 23, 10) >= 0
+        start = time.time()
+        try:
+            self.guestfs_device = self.appliance.attach(self.device, discard)
+        except RuntimeError as e:
+            self.out.warn("failed: %s" % e)
+            if self.g is self.appliance.g:
+                import guestfs
+                self.g = guestfs.GuestFS()
+            self.appliance = None
+            return False
+
+        if self.g is not self.appliance.g:
+            self.g.close()
+            self.g = self.appliance.g
+        self.guestfs_enabled = True
+        self.out.success('done (launched in %.1fs, attached in %.2fs)' %
+                         (self.appliance.launch_time, time.time() - start))
+        return True
+
     def disable_guestfs(self):
         """Disable the guestfs handler"""
 
@@ -192,6 +334,13 @@ class Image(object):
             self.out.warn("Guestfs is already disabled")
             return
 
+        if self.appliance is not None:
+            self.out.info("Detaching media from the helper VM ...", False)
+            self.appliance.detach()
+            self.guestfs_enabled = False
+            self.out.success('done')
+            return
+
         self.out.info("Shutting down helper VM ...", False)
         self.g.sync()
         # guestfs_shutdown which is the preferred way to shutdown the backend
@@ -224,9 +373,14 @@ class Image(object):
 
         return self._os
 
-    def raw_device(self, readonly=True):
+    def raw_device(self, readonly=True, userspace=False):
         """Returns a context manager that exports the raw image device. If
         readonly is true, the block device that is returned is read only.
+
+        If userspace is true, images that are not raw are served read only
+        by qemu-nbd over a UNIX socket instead of being connected to an NBD
+        block device. The path of the socket is returned, which _open_raw
+        knows how to handle.
         """
 
         if self.guestfs_enabled:
@@ -240,18 +394,72 @@ class Image(object):
         class RawImage(object):
             """The RawImage context manager"""
             def __enter__(self):
-                return img.device if img.format == 'raw' else \
-                    img.nbd.connect(readonly)
+                if img.format == 'raw':
+                    return img.device
+                if userspace:
+                    self.server = NBDServer(img.device, img.format)
+                    return self.server.start()
+                return img.nbd.connect(readonly)
 
             def __exit__(self, exc_type, exc_value, traceback):
-                if img.format != 'raw':
+                if img.format != 'raw' and userspace:
+                    self.server.stop()
+                elif img.format != 'raw':
                     img.nbd.disconnect()
 
         return RawImage()
 
+    def reader(self):
+        """Returns a context manager that returns a read-only file object for
+        the image payload, as it is dumped by the dump method. Regions that
+        are known to be empty read as zeros without touching the device.
+        """
+
+        # Self gets overwritten
+        img = self
+
+        class Reader(object):
+            """The Reader context manager"""
+            def __enter__(self):
+                self.raw = img.raw_device(userspace=True)
+                raw = self.raw.__enter__()
+                try:
+                    self.fileobj = img._open_raw(raw, direct_io=False)
+                    return PayloadFile(self.fileobj, img.size,
+                                       img._extents(raw))
+                except (IOError, OSError, RuntimeError, FatalError):
+                    self.raw.__exit__(None, None, None)
+                    raise
+
+            def __exit__(self, exc_type, exc_value, traceback):
+                try:
+                    self.fileobj.close()
+                finally:
+                    self.raw.__exit__(exc_type, exc_value, traceback)
+
+        return Reader()
+
+    def trim(self):
+        """Discard the unused blocks of the mounted file systems"""
+        if not self.discard or not self.g.feature_available(['fstrim']):
+            return
+
+        for mpoint in dict(self.g.mountpoints()).values():
+            try:
+                self.g.fstrim(mpoint)
+            except RuntimeError as e:
+                self.out.warn("Unable to trim `%s': %s" % (mpoint, e))
+
     def destroy(self):
         """Destroy this Image instance."""
 
+        # The appliance is returned to its owner with the device detached
+        if self.appliance is not None:
+            if self.guestfs_enabled:
+                self.appliance.detach()
+                self.guestfs_enabled = False
+            return
+
         # In new guestfs versions, there is a handy shutdown method for this
         try:
             if self.guestfs_enabled:
@@ -569,64 +777,413 @@ class Image(object):
         finally:
             self.os.umount()
 
-    def dump(self, outfile):
-        """Dumps the content of the image into a file.
+    def _extents(self, raw):
+        """Returns a sorted list of (offset, length) tuples with the regions
+        of the raw image device that may contain data.
+        """
+        if self.format != 'raw':
+            # Ask qemu-img about the allocation status of the image file
+            extents = image_extents(self.device)
+        elif stat.S_ISREG(os.stat(raw).st_mode):
+            fd = os.open(raw, os.O_RDONLY)
+            try:
+                extents = file_extents(fd, self.size)
+            finally:
+                os.close(fd)
+        else:
+            extents = None
+
+        if extents is None:
+            extents = [(0, self.size)]
+        else:
+            extents = [(start, min(length, self.size - start))
+                       for start, length in extents if start < self.size]
+
+        if self.skip_unused:
+            extents = subtract(extents, self._unused_extents(raw))
+
+        return extents
+
+    def _unused_extents(self, raw):
+        """Returns a sorted list of (offset, length) tuples with the regions
+        of the raw image device that are not used by any file system.
+
+        The file systems are found with guestfs. If guestfs is not enabled or
+        the media is not supported, no regions are returned and the whole
+        image is considered used.
+        """
+        if self.is_unsupported() or not self.guestfs_enabled:
+            return []
+
+        try:
+            parts = [("%s%d" % (self.guestfs_device, p['part_num']),
+                      p['part_start'], p['part_end'])
+                     for p in self.g.part_list(self.guestfs_device)]
+        except RuntimeError:
+            # No partition table. The device may host a bare file system.
+            parts = [(self.guestfs_device, 0, self.size - 1)]
+
+        partitions = []
+        for device, start, end in parts:
+            try:
+                fstype = self.g.vfs_type(device)
+            except RuntimeError:
+                continue
+            partitions.append((start, end, fstype))
+
+        with self._open_raw(raw, direct_io=False) as f:
+            return unused_extents(f, partitions)
+
+    def _hasher(self, block_size, block_hash):
+        """Returns a new hashing engine for the digests of the image. The
+        buffers of the engine have the size of a hashmap block and are
+        suitably aligned for direct I/O if needed.
+        """
+        return Checksum({'md5': hashlib.md5(), 'sha256': hashlib.sha256(),
+                         'hashmap': BlockHash(block_size, block_hash)},
+                        buffer_size=block_size,
+                        alignment=DIRECT_IO_ALIGNMENT if self.direct_io else 1)
+
+    def _open_raw(self, raw, direct_io=None):
+        """Open the raw image device for reading. If direct I/O is enabled,
+        the page cache is bypassed. Devices exported over a UNIX socket are
+        read with the userspace NBD client.
+        """
+        if stat.S_ISSOCK(os.stat(raw).st_mode):
+            return NBDFile(raw)
+
+        if direct_io is None:
+            direct_io = self.direct_io
+
+        if direct_io:
+            try:
+                fd = os.open(raw, os.O_RDONLY | os.O_DIRECT)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                self.out.warn("Direct I/O is not supported by `%s'" % raw)
+            else:
+                return io.FileIO(fd, 'r')
+
+        return open(raw, 'rb')
+
+    def _blocks(self, raw, src, checksum, detect_zeros=False, offset=0):
+        """Generator that reads the first self.size bytes of the raw device
+        and feeds them to the checksum hashing engine. The data is read in
+        blocks using the buffers of the engine. The blocks never cross a
+        multiple of the buffer size. For each block, a (length, data) tuple
+        is returned. The regions that are known to be empty are not read at
+        all and the returned data is None. If detect_zeros is True, the same
+        applies for read blocks that only contain zeros. If offset is set,
+        reading starts there instead of the beginning of the device.
+        """
+        extents = self._extents(raw)
+        blocksize = checksum.buffer_size
+        align = checksum.alignment
+        zeros = '\0' * blocksize
+
+        for start, length in extents + [(self.size, 0)]:
+            if start < offset:
+                length = max(0, start + length - offset)
+                start = offset
+            while offset < start:
+                size = min(start - offset, blocksize - offset % blocksize)
+                checksum.update(zeros[:size])
+                offset += size
+                yield size, None
+
+            left = length
+            while left > 0:
+                buf = checksum.buffer()
+                size = min(left, blocksize - offset % blocksize)
+                # Keep the requests aligned. Needed for direct I/O.
+                head = offset % align
+                src.seek(offset - head)
+                wanted = (head + size + align - 1) // align * align
+                if src.readinto(buf[:wanted]) < head + size:
+                    checksum.release(buf)
+                    raise FatalError("Unexpected end of file while reading "
+                                     "`%s'" % raw)
+                data = buf[head:head + size]
+                # The buffer won't get reused before the next iteration
+                checksum.update(data, buf)
+                left -= size
+                offset += size
+                if detect_zeros and data == zeros[:size]:
+                    yield size, None
+                else:
+                    yield size, data
+
+    def _load_checkpoint(self, outfile):
+        """Returns the size of the committed part of an interrupted dump of
+        the image to outfile, or 0 if the dump cannot be resumed.
+        """
+        checkpoint = "%s.checkpoint" % outfile
+        if not os.path.exists(checkpoint):
+            return 0
+
+        try:
+            with open(checkpoint) as f:
+                state = json.load(f)
+        except ValueError:
+            state = None
+
+        offset = state.get('offset') if isinstance(state, dict) else None
+        if not isinstance(offset, int) or not os.path.isfile(outfile) or \
+                state.get('size') != self.size or \
+                not 0 <= offset <= self.size:
+            self.out.warn("Checkpoint file `%s' does not match the image. "
+                          "Ignoring it." % checkpoint)
+            return 0
+
+        return offset
+
+    def _save_checkpoint(self, outfile, dst, offset):
+        """Commit the data written to dst and record in the checkpoint file
+        of outfile that the first offset bytes of the image are dumped.
+        """
+        dst.flush()
+        os.fsync(dst.fileno())
+
+        checkpoint = "%s.checkpoint" % outfile
+        with open("%s.tmp" % checkpoint, 'w') as f:
+            json.dump({'size': self.size, 'offset': offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename("%s.tmp" % checkpoint, checkpoint)
+
+    @staticmethod
+    def _rehash(outfile, length, checksum, progressbar):
+        """Feed the first length bytes of a partially dumped outfile to the
+        checksum hashing engine. This is used to restore the digests of the
+        committed part of a resumed dump without reading the image again.
+        """
+        MB = 2 ** 20
+        blocksize = checksum.buffer_size
+        done = 0
+        with open(outfile, 'rb') as f:
+            while done < length:
+                buf = checksum.buffer()
+                size = min(length - done, blocksize)
+                if f.readinto(buf[:size]) < size:
+                    checksum.release(buf)
+                    raise FatalError("Unexpected end of file while reading "
+                                     "`%s'" % outfile)
+                checksum.update(buf[:size], buf)
+                done += size
+                progressbar.goto(done // MB)
+
+    def dump(self, outfile, sparse=False, block_size=PITHOS_BLOCK_SIZE,
+             block_hash=PITHOS_BLOCK_HASH, resumable=False, compression=None):
+        """Dumps the content of the image into a file and returns a dictionary
+        with the digests of the dumped data: the MD5 and SHA-256 checksums
+        and the Pithos+ hashmap for the block_size and block_hash of the
+        target container.
 
         This method will only dump the actual payload, found by reading the
         partition table. Empty space in the end of the device will be ignored.
+        The raw device is read only once. The digests are computed in
+        parallel while the blocks are written to the output file. Regions of
+        the image that are known to be unallocated are not read, zeros are
+        hashed instead.
+
+        If sparse is True, the unallocated and the zero-filled regions of the
+        image are not written. Holes are left in the output file instead.
+
+        If resumable is True, the progress of the dump is periodically
+        committed to a checkpoint file next to the output file. If such a
+        file is found, the dump is resumed: the digests of the committed part
+        are computed by reading it back from the output file and the image
+        is only read from the checkpoint offset onwards.
+
+        If compression is set, the image is compressed in the given format
+        while it is dumped. The digests of the compressed file are returned
+        under the 'compressed' key, along with the ones of the image.
         """
         MB = 2 ** 20
-        blocksize = 2 ** 22  # 4MB
         progr_size = (self.size + MB - 1) // MB  # in MB
-        progressbar = self.out.Progress(progr_size, "Dumping image file", 'mb')
+        checksum = self._hasher(block_size, block_hash)
+        zeros = '\0' * block_size
 
-        with self.raw_device() as raw:
-            with open(raw, 'rb') as src:
-                with open(outfile, "wb") as dst:
-                    left = self.size
-                    offset = 0
-                    progressbar.next()
-                    while left > 0:
-                        length = min(left, blocksize)
-                        sent = sendfile(dst.fileno(), src.fileno(), offset,
-                                        length)
-
-                        # Workaround for python-sendfile API change. In
-                        # python-sendfile 1.2.x (py-sendfile) the returning
-                        # value of sendfile is a tuple, where in version 2.x
-                        # (pysendfile) it is just a single integer.
-                        if isinstance(sent, tuple):
-                            sent = sent[1]
-
-                        offset += sent
-                        left -= sent
-                        progressbar.goto((self.size - left) // MB)
+        if sparse and os.path.exists(outfile) and \
+                not stat.S_ISREG(os.stat(outfile).st_mode):
+            self.out.warn("Output file `%s' is not a regular file. Disabling "
+                          "sparse dumping." % outfile)
+            sparse = False
 
+        if compression is not None and (sparse or resumable):
+            self.out.warn("Sparse and resumable dumping are not supported "
+                          "for compressed output files. Disabling them.")
+            sparse = resumable = False
+
+        committed = 0
+        if resumable:
+            committed = self._load_checkpoint(outfile)
+
+        progressbar = self.out.Progress(progr_size, "Dumping image file", 'mb')
+        try:
+            with self.raw_device(userspace=True) as raw:
+                with self._open_raw(raw) as src:
+                    if compression is not None:
+                        output = Compressor(compression, outfile)
+                    else:
+                        output = open(outfile, "r+b" if committed else "wb")
+                    with output as dst:
+                        progressbar.next()
+                        if committed:
+                            # Drop anything written after the last checkpoint
+                            # and restore the digests of the committed part.
+                            dst.truncate(committed)
+                            self._rehash(outfile, committed, checksum,
+                                         progressbar)
+                            dst.seek(committed)
+                        done = checkpoint = dropped = committed
+                        for length, data in self._blocks(
+                                raw, src, checksum, detect_zeros=sparse,
+                                offset=committed):
+                            if data is not None:
+                                dst.write(data)
+                                done += length
+                            elif sparse:
+                                dst.seek(length, os.SEEK_CUR)
+                                done += length
+                            else:
+                                dst.write(zeros[:length])
+                                done += length
+
+                            progressbar.goto(done // MB)
+                            if resumable and \
+                                    done - checkpoint >= CHECKPOINT_INTERVAL:
+                                self._save_checkpoint(outfile, dst, done)
+                                checkpoint = done
+                            if self.direct_io and compression is None and \
+                                    done - dropped >= DROP_CACHE_INTERVAL:
+                                # Don't let the written data pollute the
+                                # page cache.
+                                dst.flush()
+                                os.fdatasync(dst.fileno())
+                                fadvise_dontneed(dst.fileno(), dropped,
+                                                 done - dropped)
+                                dropped = done
+
+                        # Make sure the file ends in the right place, even
+                        # if the last region of the image is a hole or a
+                        # longer file got resumed.
+                        dst.flush()
+                        if compression is None and os.path.isfile(outfile):
+                            os.ftruncate(dst.fileno(), self.size)
+        except (Exception, KeyboardInterrupt):
+            checksum.cancel()
+            raise
+
+        digests = checksum.finish()
+        if compression is not None:
+            digests['compressed'] = output.digests
+        if resumable and os.path.exists("%s.checkpoint" % outfile):
+            os.unlink("%s.checkpoint" % outfile)
         progressbar.success('image file %s was successfully created' % outfile)
 
-    def md5(self):
-        """Computes the MD5 checksum of the image"""
+        return digests
+
+    def checksum(self, block_size=PITHOS_BLOCK_SIZE,
+                 block_hash=PITHOS_BLOCK_HASH):
+        """Computes the digests of the image and returns them in a dictionary,
+        like the dump method does.
+        """
 
         MB = 2 ** 20
-        blocksize = 2 ** 22  # 4MB
         progr_size = ((self.size + MB - 1) // MB)  # in MB
-        progressbar = self.out.Progress(progr_size, "Calculating md5sum", 'mb')
-        md5 = hashlib.md5()
+        progressbar = self.out.Progress(progr_size, "Calculating checksums",
+                                        'mb')
+        checksum = self._hasher(block_size, block_hash)
+
+        try:
+            with self.raw_device(userspace=True) as raw:
+                with self._open_raw(raw) as src:
+                    done = 0
+                    for length, _ in self._blocks(raw, src, checksum):
+                        done += length
+                        progressbar.goto(done // MB)
+        except (Exception, KeyboardInterrupt):
+            checksum.cancel()
+            raise
+
+        digests = checksum.finish()
+        progressbar.success(digests['md5'])
+
+        return digests
+
+    def md5(self):
+        """Computes the MD5 checksum of the image"""
+        return self.checksum()['md5']
 
-        with self.raw_device() as raw:
-            with open(raw, "rb") as src:
-                left = self.size
-                while left > 0:
-                    length = min(left, blocksize)
-                    data = src.read(length)
-                    md5.update(data)
-                    left -= length
-                    progressbar.goto((self.size - left) // MB)
+    def export(self, outfile, fmt, compressed=False):
+        """Exports the image into a file of a virtual disk format (qcow2 or
+        vmdk) using qemu-img. Like with dump, only the payload is exported.
 
-        checksum = md5.hexdigest()
-        progressbar.success(checksum)
+        The snapshot is read directly, without exporting the raw device.
+        If qemu-img supports them (2.9 or later), it is allowed to use
+        parallel coroutines and out-of-order writes. If compressed is True,
+        the clusters of the file are compressed, which requires in-order
+        writes.
+        """
+        if fmt not in EXPORT_FORMATS:
+            raise FatalError("Unknown export format: `%s'" % fmt)
+
+        if self.guestfs_enabled:
+            self.g.umount_all()
+            self.g.sync()
+
+        def escape(value):
+            """Escape a value of a qemu option string"""
+            return str(value).replace(',', ',,')
+
+        # The raw driver on top of the image limits it to its payload
+        source = "driver=raw,size=%d" % self.size
+        if self.format == 'raw':
+            source += ",file.filename=%s" % escape(self.device)
+        else:
+            source += ",file.driver=%s,file.file.filename=%s" % \
+                (self.format, escape(self.device))
+
+        # Parallel coroutines and out-of-order writes need qemu 2.9
+        parallel = qemu_img_version() >= (2, 9)
+
+        args = ['convert', '-p', '-O', fmt]
+        if parallel:
+            args.extend(['-m', str(EXPORT_COROUTINES)])
+        if compressed and fmt == 'vmdk':
+            args.extend(['-o', 'subformat=streamOptimized'])
+        elif compressed:
+            args.append('-c')
+        elif parallel:
+            args.append('-W')
+        args.extend(['--image-opts', source, outfile])
+
+        progress = self.out.Progress(100, "Exporting image to %s" % fmt,
+                                     'percent')
+        progress.next()
+        try:
+            convert = subprocess.Popen(['qemu-img'] + args, shell=False,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+        except OSError as e:
+            raise FatalError("Unable to run qemu-img: %s" % e)
+
+        # Progress is reported as `(12.34/100%)' followed by a carriage return
+        pattern = re.compile(r'\((\d+(?:\.\d+)?)/100%\)')
+        try:
+            for data in iter(lambda: os.read(convert.stdout.fileno(), 4096),
+                             b''):
+                for match in pattern.findall(data):
+                    progress.goto(int(float(match)))
+        finally:
+            _, err = convert.communicate()
 
-        return checksum
+        if convert.returncode != 0:
+            raise FatalError("Exporting image to %s failed: %s" %
+                             (fmt, err.strip()))
 
+        progress.success('image file %s was successfully created' % outfile)
 
 # vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
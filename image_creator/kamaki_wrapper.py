@@ -20,7 +20,6 @@ The library is used to upload images to and register them with a Synnefo
 deployment.
 """
 
-import sys
 import logging
 
 from os.path import basename
@@ -31,19 +30,29 @@ from kamaki.clients.image import ImageClient
 from kamaki.clients.pithos import PithosClient
 from kamaki.clients.astakos import CachedAstakosClient as AstakosClient
 
+from image_creator.util import FatalError, static_vars
+
 try:
     from kamaki.clients.utils import https
     https.patch_ignore_ssl()
 except ImportError:
     pass
 
-try:
-    logger = logging.getLogger("kamaki.cli.config")
-    logger.setLevel(logging.ERROR)
-    config = Config()
-except Exception as e:
-    sys.stderr.write("Kamaki config error: %s\n" % str(e))
-    sys.exit(1)
+
+@static_vars(config=None)
+def get_config():
+    """Returns the ./kamaki configuration. It is loaded the first time it is
+    needed.
+    """
+    if get_config.config is None:
+        try:
+            logger = logging.getLogger("kamaki.cli.config")
+            logger.setLevel(logging.ERROR)
+            get_config.config = Config()
+        except Exception as e:
+            raise FatalError("Kamaki config error: %s" % str(e))
+    return get_config.config
+
 
 CONTAINER = "images"
 
@@ -54,6 +63,7 @@ class Kamaki(object):
     @staticmethod
     def get_default_cloud_name():
         """Returns the name of the default cloud"""
+        config = get_config()
         clouds = config.keys('cloud')
         default = config.get('global', 'default_cloud')
         if not default:
@@ -63,12 +73,14 @@ class Kamaki(object):
     @staticmethod
     def set_default_cloud(name):
         """Sets a cloud account as default"""
+        config = get_config()
         config.set('global', 'default_cloud', name)
         config.write()
 
     @staticmethod
     def get_clouds():
         """Returns the list of available clouds"""
+        config = get_config()
         names = config.keys('cloud')
 
         clouds = {}
@@ -80,7 +92,7 @@ class Kamaki(object):
     @staticmethod
     def get_cloud_by_name(name):
         """Returns a dictionary with cloud info"""
-        return config.get('cloud', name)
+        return get_config().get('cloud', name)
 
     @staticmethod
     def save_cloud(name, url, token, description=""):
@@ -88,6 +100,7 @@ class Kamaki(object):
         cloud = {'url': url, 'token': token}
         if len(description):
             cloud['description'] = description
+        config = get_config()
         config.set('cloud', name, cloud)
 
         # Make the saved cloud the default one
@@ -97,6 +110,7 @@ class Kamaki(object):
     @staticmethod
     def remove_cloud(name):
         """Deletes an existing cloud from the ./Kamaki configuration file"""
+        config = get_config()
         config.remove_option('cloud', name)
         config.write()
 
@@ -118,7 +132,7 @@ class Kamaki(object):
         """Given a saved cloud name this method returns an Astakos client
         instance
         """
-        cloud = config.get('cloud', cloud_name)
+        cloud = get_config().get('cloud', cloud_name)
         assert cloud, "cloud: `%s' does not exist" % cloud_name
         assert 'url' in cloud, "url attr is missing in %s" % cloud_name
         assert 'token' in cloud, "token attr is missing in %s" % cloud_name
@@ -140,9 +154,78 @@ class Kamaki(object):
             self.account.get_service_endpoints('image')['publicURL'],
             self.account.token)
 
+    def get_block_info(self, container=None):
+        """Returns the block size and the block hash algorithm of a container
+        or None if the container does not exist.
+        """
+
+        if container is None:
+            container = CONTAINER
+
+        try:
+            self.pithos.container = container
+            info = self.pithos.get_container_info()
+        except ClientError as e:
+            if e.status == 404:  # Container not found error
+                return None
+            raise
+        finally:
+            self.pithos.container = CONTAINER
+
+        return (int(info['x-container-block-size']),
+                info['x-container-block-hash'])
+
+    def _upload_hashmap(self, path, file_obj, hashmap, content_type=None,
+                        hash_cb=None, upload_cb=None):
+        """Create an object in the current container of the Pithos+ client
+        from the precomputed hashmap of a file. Only the blocks the service
+        is missing are read from the file and uploaded.
+        """
+        hashes = hashmap['hashes']
+        if hash_cb:
+            hash_gen = hash_cb(len(hashes))
+            for _ in xrange(len(hashes) + 1):
+                hash_gen.next()
+
+        json = {'bytes': hashmap['bytes'], 'hashes': hashes}
+        r = self.pithos.object_put(path, format='json', hashmap=True,
+                                   content_type=content_type, json=json,
+                                   success=(201, 409))
+        if r.status_code == 201:
+            return
+
+        missing = r.json
+        upload_gen = upload_cb(len(missing)) if upload_cb else None
+        if upload_gen:
+            upload_gen.next()
+
+        block_size = hashmap['block_size']
+        index = dict((block, i) for i, block in enumerate(hashes))
+        for block in missing:
+            offset = index[block] * block_size
+            file_obj.seek(offset)
+            data = file_obj.read(min(block_size, hashmap['bytes'] - offset))
+            r = self.pithos.container_post(
+                update=True, content_type='application/octet-stream',
+                content_length=len(data), data=data, format='json')
+            if r.json[0] != block:
+                raise FatalError("Pithos+ computed a different hash for the "
+                                 "block at offset %d" % offset)
+            if upload_gen:
+                upload_gen.next()
+
+        self.pithos.object_put(path, format='json', hashmap=True,
+                               content_type=content_type, json=json,
+                               success=201)
+
     def upload(self, file_obj, size=None, remote_path=None, container=None,
-               content_type=None, hp=None, up=None):
-        """Upload a file to Pithos+"""
+               content_type=None, hp=None, up=None, hashmap=None,
+               block_info=None):
+        """Upload a file to Pithos+. If the Pithos+ hashmap of the file is
+        provided and it was computed with the block size and hash algorithm
+        of the container, the block hashes will not be calculated again. The
+        latter may be passed in block_info, as returned by get_block_info.
+        """
 
         path = basename(file_obj.name) if remote_path is None else remote_path
 
@@ -158,22 +241,36 @@ class Kamaki(object):
         hash_cb = self.out.progress_generator(hp) if hp is not None else None
         upload_cb = self.out.progress_generator(up) if up is not None else None
 
+        if hashmap is not None and block_info is None:
+            block_info = self.get_block_info(container)
+
+        if hashmap is not None and (hashmap['bytes'] != size or (
+                hashmap['block_size'], hashmap['block_hash']) != block_info):
+            hashmap = None
+
         try:
             self.pithos.container = container
-            self.pithos.upload_object(path, file_obj, size=size,
-                                      hash_cb=hash_cb, upload_cb=upload_cb,
-                                      content_type=content_type)
+            if hashmap is not None:
+                self._upload_hashmap(path, file_obj, hashmap,
+                                     content_type=content_type,
+                                     hash_cb=hash_cb, upload_cb=upload_cb)
+            else:
+                self.pithos.upload_object(path, file_obj, size=size,
+                                          hash_cb=hash_cb,
+                                          upload_cb=upload_cb,
+                                          content_type=content_type)
         finally:
             self.pithos.container = CONTAINER
 
         return "pithos://%s/%s/%s" % (self.account.user_info()['id'],
                                       container, path)
 
-    def register(self, name, location, metadata, public=False):
+    def register(self, name, location, metadata, public=False,
+                 disk_format='diskdump'):
         """Register an image with Cyclades"""
 
         is_public = 'true' if public else 'false'
-        params = {'is_public': is_public, 'disk_format': 'diskdump'}
+        params = {'is_public': is_public, 'disk_format': disk_format}
         return self.image.register(name, location, params, metadata)
 
     def share(self, location):
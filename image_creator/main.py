@@ -37,12 +37,17 @@ import locale
 
 from image_creator import __version__ as version
 from image_creator.disk import Disk
-from image_creator.util import FatalError, static_vars, to_shell
+from image_creator.util import FatalError, static_vars, to_shell, \
+    Background
+from image_creator.appliance import launch_appliance, hotplug_supported
 from image_creator.output.cli import SilentOutput, SimpleOutput, \
     OutputWthProgress
 from image_creator.output.composite import CompositeOutput
 from image_creator.output.syslog import SyslogOutput
-from image_creator.kamaki_wrapper import Kamaki, ClientError, CONTAINER
+from image_creator.image import EXPORT_FORMATS
+from image_creator.checksum import PITHOS_BLOCK_SIZE, PITHOS_BLOCK_HASH
+from image_creator.compression import COMPRESSION_FORMATS, \
+    compression_format, decompressed_name
 
 
 @static_vars(enc=locale.getdefaultlocale()[1])
@@ -58,6 +63,45 @@ def get_encoding():
     return get_encoding.enc
 
 
+class ArgumentParser(argparse.ArgumentParser):
+    """Argument parser that resolves relative paths against a working
+    directory and prints to the specified streams instead of the standard
+    ones.
+    """
+
+    def __init__(self, cwd=None, stdout=None, stderr=None, **kwargs):
+        """Create a new ArgumentParser instance"""
+        argparse.ArgumentParser.__init__(self, **kwargs)
+        self.cwd = cwd
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def path(self, name):
+        """Returns a path resolved against the working directory"""
+        if self.cwd is None:
+            return name
+        return os.path.join(self.cwd, name)
+
+    def _stream(self, file):
+        """Returns the stream to print to instead of a standard one"""
+        if file is sys.stderr:
+            return self.stderr or file
+        if file is None or file is sys.stdout:
+            return self.stdout or file
+        return file
+
+    def print_usage(self, file=None):
+        argparse.ArgumentParser.print_usage(self, self._stream(file))
+
+    def print_help(self, file=None):
+        argparse.ArgumentParser.print_help(self, self._stream(file))
+
+    def exit(self, status=0, message=None):
+        if message:
+            self._stream(sys.stderr).write(message)
+        sys.exit(status)
+
+
 class CheckWritableDir(argparse.Action):
     """Check if a directory is writable"""
     # pylint: disable=signature-differs
@@ -106,12 +150,16 @@ class AddKeyValue(argparse.Action):
         setattr(namespace, self.dest, dest)
 
 
-def parse_options():
-    """Parse input parameters"""
+def parse_options(args=None, cwd=None, stdout=None, stderr=None):
+    """Parse input parameters. If args is None, the command line arguments
+    are used. Relative paths are resolved against cwd, if defined, and the
+    parser messages are printed to the stdout and stderr streams, if defined.
+    """
     description = "Command-line tool for creating OS images"
-    parser = argparse.ArgumentParser(version=version, description=description)
+    parser = ArgumentParser(cwd=cwd, stdout=stdout, stderr=stderr,
+                            version=version, description=description)
 
-    parser.add_argument("source", metavar="SOURCE",
+    parser.add_argument("source", metavar="SOURCE", type=parser.path,
                         help="Image file, block device or /")
     parser.add_argument(
         "-a", "--authentication-url", dest="url", default=None,
@@ -132,8 +180,21 @@ def parse_options():
              "when uploading/registering images")
 
     parser.add_argument(
-        "--container", dest="container", default=CONTAINER,
-        help="Upload files to CONTAINER [default: %s]" % CONTAINER)
+        "--compress", dest="compress", default=None, metavar="FORMAT",
+        choices=['none', 'native'] + sorted(COMPRESSION_FORMATS.keys()),
+        help="compress the output file using FORMAT (none, native, %s). "
+             "`native' stands for the compression of the qcow2 and vmdk "
+             "formats. By default the format is detected from the extension "
+             "of the output file" % ", ".join(sorted(COMPRESSION_FORMATS)))
+
+    parser.add_argument(
+        "--container", dest="container", default=None,
+        help="Upload files to CONTAINER [default: images]")
+
+    parser.add_argument(
+        "--direct-io", dest="direct_io", default=False, action="store_true",
+        help="bypass the page cache when reading the image to dump it or "
+             "compute its checksums")
 
     parser.add_argument(
         "--disable-sysprep", dest="disabled_syspreps",
@@ -149,6 +210,13 @@ def parse_options():
         "-f", "--force", dest="force", default=False, action="store_true",
         help="overwrite output files if they exist")
 
+    parser.add_argument(
+        "--format", dest="format", default=None, metavar="FORMAT",
+        choices=['diskdump'] + sorted(EXPORT_FORMATS.keys()),
+        help="write the output file in FORMAT (%s). By default the format is "
+             "detected from the extension of the output file" %
+             ", ".join(['diskdump'] + sorted(EXPORT_FORMATS.keys())))
+
     parser.add_argument(
         "--host-run", dest="host_run", default=[],
         help="mount the media in the host and run a script against the guest "
@@ -156,10 +224,10 @@ def parse_options():
              "working directory will be the guest's root directory. BE "
              "CAREFUL! DO NOT USE ABSOLUTE PATHS INSIDE THE SCRIPT! YOU MAY "
              "HARM YOUR SYSTEM!",
-        metavar="SCRIPT", action="append")
+        metavar="SCRIPT", action="append", type=parser.path)
 
     parser.add_argument(
-        "--install-virtio", dest="virtio", metavar="DIR",
+        "--install-virtio", dest="virtio", metavar="DIR", type=parser.path,
         help="install VirtIO drivers hosted under DIR (Windows only)")
 
     parser.add_argument(
@@ -177,6 +245,7 @@ def parse_options():
 
     parser.add_argument("-o", "--outfile", dest="outfile", default=None,
                         action=CheckWritableDir, metavar="FILE",
+                        type=parser.path,
                         help="dump image to FILE")
 
     parser.add_argument("--print-metadata", dest="print_metadata",
@@ -201,9 +270,36 @@ def parse_options():
                         metavar="IMAGENAME",
                         help="register the image with a cloud as IMAGENAME")
 
+    parser.add_argument(
+        "--resumable", dest="resumable", default=False, action="store_true",
+        help="periodically checkpoint the dumping of the image to FILE and "
+        "resume an interrupted one if a checkpoint is found")
+
     parser.add_argument("-s", "--silent", dest="silent", default=False,
                         help="output only errors", action="store_true")
 
+    parser.add_argument(
+        "--skip-unused-blocks", dest="skip_unused", default=False,
+        help="don't read the blocks that the file systems of the image don't "
+        "use and export them as zeros", action="store_true")
+
+    parser.add_argument(
+        "--snapshot-backend", dest="snapshot_backend", default="dm-snapshot",
+        choices=["dm-snapshot", "dm-thin"], metavar="BACKEND",
+        help="use BACKEND (dm-snapshot or dm-thin) to snapshot raw input "
+             "media. A dm-thin pool releases the space of the discarded "
+             "blocks")
+
+    parser.add_argument(
+        "--snapshot-chunk-size", dest="chunk_size", default=64, type=int,
+        metavar="KB", help="use chunks of KB kilobytes in the dm-thin "
+        "snapshot pool")
+
+    parser.add_argument(
+        "--sparse", dest="sparse", default=False, action="store_true",
+        help="leave holes in the output file for the unallocated and the "
+        "zero-filled regions of the image")
+
     parser.add_argument('--syslog', dest="syslog", default=False,
                         help="log to syslog", action="store_true")
 
@@ -216,13 +312,20 @@ def parse_options():
         help="use this authentication token when uploading/registering images")
 
     parser.add_argument("--tmpdir", dest="tmp", default=None, metavar="DIR",
+                        type=parser.path,
                         help="create large temporary image files under DIR")
 
     parser.add_argument(
         "-u", "--upload", dest="upload", default=None, metavar="FILENAME",
         help="upload the image to the cloud with name FILENAME")
 
-    options = parser.parse_args()
+    parser.add_argument(
+        "--wait-for-space", dest="wait_for_space", default=False,
+        help="if there is not enough temporary space for the snapshot, wait "
+             "for other jobs to free it instead of failing",
+        action="store_true")
+
+    options = parser.parse_args(args)
 
     if not os.path.exists(options.source):
         parser.error("Input media `%s' is not accessible" % options.source)
@@ -241,6 +344,10 @@ def parse_options():
         parser.error("The directory `%s' specified with --tmpdir is not valid"
                      % options.tmp)
 
+    if options.chunk_size % 64 or not 64 <= options.chunk_size <= 2 ** 20:
+        parser.error("The snapshot chunk size must be a multiple of 64 "
+                     "between 64 and 1048576")
+
     # Convert input attributes to unicode
     for opt in ('url', 'cloud', 'container', 'outfile', 'register', 'token',
                 'tmp', 'upload', 'virtio'):
@@ -266,9 +373,36 @@ def parse_options():
                      "`--print-sysprep-params' or `--print-metadata' must be "
                      "set")
 
-    if not options.force and options.outfile is not None and \
+    if options.format is None:
+        options.format = 'diskdump'
+        for fmt, extension in EXPORT_FORMATS.items():
+            if options.outfile is not None and \
+                    options.outfile.endswith(extension):
+                options.format = fmt
+
+    if options.format in EXPORT_FORMATS:
+        if options.compress in COMPRESSION_FORMATS:
+            parser.error("The `%s' format only supports native compression"
+                         % options.format)
+        if options.resumable:
+            parser.error("Resumable dumping is not supported by the `%s' "
+                         "format" % options.format)
+    elif options.compress == 'native':
+        parser.error("The `diskdump' format has no native compression")
+
+    if options.compress is None and options.outfile is not None and \
+            options.format not in EXPORT_FORMATS:
+        options.compress = compression_format(options.outfile)
+    elif options.compress == 'none':
+        options.compress = None
+
+    # Files of an interrupted dump will get overwritten when resuming it
+    resume = options.resumable and options.outfile is not None and \
+        os.path.exists("%s.checkpoint" % options.outfile)
+
+    if not options.force and not resume and options.outfile is not None and \
             os.path.realpath(options.outfile) != '/dev/null':
-        for extension in ('', '.meta', '.md5sum'):
+        for extension in ('', '.meta', '.md5sum', '.sha256sum', '.hashmap'):
             filename = "%s%s" % (options.outfile, extension)
             if os.path.exists(filename):
                 parser.error("Output file `%s' exists (use --force to "
@@ -277,14 +411,16 @@ def parse_options():
     return options
 
 
-def image_creator(options, out):
-    """snf-mkimage main function"""
+def get_kamaki(options, out):
+    """Returns an authenticated Kamaki instance for the cloud account defined
+    in the options or None if no account is defined.
+    """
+    if account_key(options) is None:
+        return None
 
-    if os.geteuid() != 0:
-        raise FatalError("You must run %s as root"
-                         % os.path.basename(sys.argv[0]))
+    from image_creator.kamaki_wrapper import Kamaki, ClientError
 
-    # Check if the authentication info is valid. The earlier the better
+    kamaki = None
     if options.token is not None and options.url is not None:
         try:
             account = Kamaki.create_account(options.url, options.token)
@@ -311,6 +447,36 @@ def image_creator(options, out):
         except ClientError as e:
             raise FatalError("Astakos client: %d %s" % (e.status, e.message))
 
+    return kamaki
+
+
+def account_key(options):
+    """Returns a key that identifies the cloud account defined in the options
+    or None if no account is defined.
+    """
+    if options.token is not None and options.url is not None:
+        return ('token', options.url, options.token)
+    elif options.cloud:
+        return ('cloud', options.cloud)
+    return None
+
+
+def check_remote(options, out, kamaki=None):
+    """Check the cloud account of the options and the remote objects the
+    image will be uploaded to. Returns the Kamaki instance and the block size
+    and hash algorithm of the target container.
+    """
+
+    if kamaki is None:
+        kamaki = get_kamaki(options, out)
+
+    if not options.upload and not options.register and kamaki is None:
+        return kamaki, (PITHOS_BLOCK_SIZE, PITHOS_BLOCK_HASH)
+
+    if options.container is None:
+        from image_creator.kamaki_wrapper import CONTAINER
+        options.container = CONTAINER
+
     if options.upload and not options.force:
         if kamaki.object_exists(options.container, options.upload):
             raise FatalError("Remote storage service object: `%s' exists "
@@ -326,7 +492,51 @@ def image_creator(options, out):
             raise FatalError("Remote storage service object `%s.meta' exists "
                              "(use --force to overwrite it)." % options.upload)
 
-    disk = Disk(options.source, out, options.tmp)
+    # Precompute the Pithos+ hashmap of the image for the target container,
+    # so that the block hashes won't need to get calculated again during the
+    # upload.
+    block_info = None
+    if options.upload:
+        block_info = kamaki.get_block_info(options.container)
+    if block_info is None:
+        block_info = (PITHOS_BLOCK_SIZE, PITHOS_BLOCK_HASH)
+
+    return kamaki, block_info
+
+
+def image_creator(options, out, kamaki=None, appliance=None):
+    """snf-mkimage main function. An already authenticated Kamaki instance
+    may be passed, to be used instead of the account of the options, and a
+    launched libguestfs appliance to attach the media to.
+    """
+
+    if os.geteuid() != 0:
+        raise FatalError("You must run %s as root"
+                         % os.path.basename(sys.argv[0]))
+
+    start = time.time()
+
+    # Check if the authentication info is valid. The earlier the better. This
+    # is done before anything else is started, so that invalid credentials
+    # don't leave snapshots or appliances behind.
+    if kamaki is None:
+        kamaki = get_kamaki(options, out)
+    account_time = time.time() - start
+
+    # The checks of the remote objects and the launch of the libguestfs
+    # appliance run in the background while the media get snapshotted. If the
+    # appliance cannot hot-plug the media, it gets launched after the
+    # snapshot as before.
+    remote = None
+    if options.upload:
+        remote = Background(check_remote, options, out, kamaki)
+    launcher = None
+    if appliance is None and hotplug_supported():
+        launcher = Background(launch_appliance)
+
+    disk = Disk(options.source, out, options.tmp,
+                snapshot_backend=options.snapshot_backend,
+                chunk_size=options.chunk_size * 1024)
 
     # pylint: disable=unused-argument
     def signal_handler(signum, frame):
@@ -335,10 +545,46 @@ def image_creator(options, out):
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
     try:
+        # Make sure there is enough temporary space for the snapshot before
+        # creating it. The reservation is adjusted after the inspection.
+        if options.snapshot:
+            disk.reserve_space(wait=options.wait_for_space)
+
         # There is no need to snapshot the media if it was created by the Disk
         # instance as a temporary object.
         device = disk.file if not options.snapshot else disk.snapshot()
-        image = disk.get_image(device, sysprep_params=options.sysprep_params)
+        snapshot_time = time.time() - start - account_time
+
+        block_info = (PITHOS_BLOCK_SIZE, PITHOS_BLOCK_HASH)
+        if remote is not None:
+            kamaki, block_info = remote.result()
+        if launcher is not None:
+            try:
+                appliance = launcher.result()
+            except RuntimeError as e:
+                out.warn("Launching the helper VM in advance failed: %s" % e)
+
+        inspection = time.time()
+        image = disk.get_image(device, sysprep_params=options.sysprep_params,
+                               skip_unused=options.skip_unused,
+                               direct_io=options.direct_io,
+                               appliance=appliance)
+
+        stages = [("account validation", account_time),
+                  ("snapshot", snapshot_time)]
+        if remote is not None:
+            stages.append(("remote checks", remote.elapsed))
+        if launcher is not None:
+            stages.append(("helper VM launch", launcher.elapsed))
+        stages.append(("inspection", time.time() - inspection))
+        out.info("Startup took %.1fs (%s)" % (
+            time.time() - start,
+            ", ".join("%s: %.1fs" % stage for stage in stages)))
+
+        # Now that the media is inspected, reserve what the system preparation
+        # of the image is expected to need.
+        if options.snapshot:
+            disk.reserve_space(image, wait=options.wait_for_space)
 
         if image.is_unsupported() and not options.allow_unsupported:
             raise FatalError(
@@ -435,56 +681,103 @@ def image_creator(options, out):
 
         if options.sysprep:
             image.os.do_sysprep()
-
-        checksum = image.md5()
+            disk.report_snapshot_usage()
 
         image_meta = {}
         for k, v in image.meta.items():
             image_meta[str(k)] = str(v)
 
         metastring = json.dumps(
-            {'properties': image_meta, 'disk-format': 'diskdump'},
+            {'properties': image_meta, 'disk-format': options.format},
             ensure_ascii=False)
 
         img_properties = json.dumps(image_meta, ensure_ascii=False)
 
+        dump = options.outfile is not None and \
+            os.path.realpath(options.outfile) != '/dev/null'
+
+        # When dumping, the checksums are computed in the same pass
+        block_size, block_hash = block_info
+        compression = options.compress
+        export = dump and options.format in EXPORT_FORMATS
+        digests = outfile_digests = None
+        if export:
+            # qemu-img reads the image by itself and the exported file is not
+            # read back. The raw image is only read again to compute its
+            # digests if it gets uploaded.
+            image.export(options.outfile, options.format,
+                         compressed=compression == 'native')
+        if dump and not export:
+            digests = image.dump(options.outfile, sparse=options.sparse,
+                                 block_size=block_size, block_hash=block_hash,
+                                 resumable=options.resumable,
+                                 compression=compression)
+            outfile_digests = digests.get('compressed')
+        elif not export or options.upload:
+            digests = image.checksum(block_size=block_size,
+                                     block_hash=block_hash)
+
         if options.outfile is not None:
-            if os.path.realpath(options.outfile) == '/dev/null':
+            if not dump:
                 out.warn('Not dumping file to /dev/null')
             else:
-                image.dump(options.outfile)
-
                 out.info('Dumping metadata file ...', False)
                 with open('%s.%s' % (options.outfile, 'meta'), 'w') as f:
                     f.write(metastring)
                 out.success('done')
 
-                out.info('Dumping md5sum file ...', False)
-                with open('%s.%s' % (options.outfile, 'md5sum'), 'w') as f:
-                    f.write('%s %s\n' % (checksum,
-                                         os.path.basename(options.outfile)))
-                out.success('done')
+                if digests is not None:
+                    # For compressed files, the checksums of both the file
+                    # and the raw image are listed. For exported files, only
+                    # the ones of the raw image are.
+                    basename = os.path.basename(options.outfile)
+                    sums = []
+                    if export:
+                        basename = "%s.raw" % os.path.splitext(basename)[0]
+                    elif outfile_digests is not None:
+                        sums.append((outfile_digests, basename))
+                        basename = decompressed_name(basename, compression)
+                    sums.append((digests, basename))
+
+                    out.info('Dumping md5sum file ...', False)
+                    with open('%s.md5sum' % options.outfile, 'w') as f:
+                        for d, name in sums:
+                            f.write('%s %s\n' % (d['md5'], name))
+                    out.success('done')
+
+                    out.info('Dumping sha256sum file ...', False)
+                    with open('%s.sha256sum' % options.outfile, 'w') as f:
+                        for d, name in sums:
+                            f.write('%s %s\n' % (d['sha256'], name))
+                    out.success('done')
+
+                    out.info('Dumping hashmap file ...', False)
+                    with open('%s.hashmap' % options.outfile, 'w') as f:
+                        json.dump(digests['hashmap'], f)
+                    out.success('done')
 
                 out.info('Dumping variant file ...', False)
                 with open('%s.%s' % (options.outfile, 'variant'), 'w') as f:
                     f.write(to_shell(IMG_ID=options.outfile,
-                                     IMG_FORMAT="diskdump",
+                                     IMG_FORMAT=options.format,
                                      IMG_PROPERTIES=img_properties))
                 out.success('done')
 
         out.info()
-        try:
-            if options.upload:
+        if options.upload:
+            # The cloud client library is only needed when uploading
+            from image_creator.kamaki_wrapper import ClientError
+            try:
                 out.info("Uploading image to the storage service:")
-                with image.raw_device() as raw:
-                    with open(raw, 'rb') as f:
-                        remote = kamaki.upload(
-                            f, image.size, options.upload, options.container,
-                            None, "(1/3)  Calculating block hashes",
-                            "(2/3)  Uploading missing blocks")
+                with image.reader() as f:
+                    remote = kamaki.upload(
+                        f, image.size, options.upload, options.container,
+                        None, "(1/3)  Calculating block hashes",
+                        "(2/3)  Uploading missing blocks",
+                        hashmap=digests['hashmap'], block_info=block_info)
 
                 out.info("(3/3)  Uploading md5sum file ...", False)
-                md5sumstr = '%s %s\n' % (checksum,
+                md5sumstr = '%s %s\n' % (digests['md5'],
                                          os.path.basename(options.upload))
                 kamaki.upload(StringIO.StringIO(md5sumstr),
                               size=len(md5sumstr),
@@ -494,38 +787,58 @@ def image_creator(options, out):
                 out.success('done')
                 out.info()
 
-            if options.register:
-                img_type = 'public' if options.public else 'private'
-                out.info('Registering %s image with the compute service ...'
-                         % img_type, False)
-                result = kamaki.register(options.register, remote,
-                                         image.meta, options.public)
-                out.success('done')
-                out.info("Uploading metadata file ...", False)
-                metastring = unicode(json.dumps(result, ensure_ascii=False,
-                                                indent=4))
-                kamaki.upload(StringIO.StringIO(metastring.encode('utf8')),
-                              size=len(metastring),
-                              remote_path="%s.%s" % (options.upload, 'meta'),
-                              container=options.container,
-                              content_type="application/json")
-                out.success('done')
-                if options.public:
-                    out.info("Sharing md5sum file ...", False)
-                    kamaki.share("%s.md5sum" % options.upload)
+                if options.register:
+                    img_type = 'public' if options.public else 'private'
+                    out.info('Registering %s image with the compute '
+                             'service ...' % img_type, False)
+                    # The raw image is uploaded, whatever the format of the
+                    # output file is.
+                    result = kamaki.register(options.register, remote,
+                                             image.meta, options.public,
+                                             disk_format='diskdump')
                     out.success('done')
-                    out.info("Sharing metadata file ...", False)
-                    kamaki.share("%s.meta" % options.upload)
+                    out.info("Uploading metadata file ...", False)
+                    metastring = unicode(json.dumps(
+                        result, ensure_ascii=False, indent=4))
+                    kamaki.upload(
+                        StringIO.StringIO(metastring.encode('utf8')),
+                        size=len(metastring),
+                        remote_path="%s.%s" % (options.upload, 'meta'),
+                        container=options.container,
+                        content_type="application/json")
                     out.success('done')
-                out.result(json.dumps(result, indent=4, ensure_ascii=False))
-                out.info()
-        except ClientError as e:
-            raise FatalError("Service client: %d %s" % (e.status, e.message))
+                    if options.public:
+                        out.info("Sharing md5sum file ...", False)
+                        kamaki.share("%s.md5sum" % options.upload)
+                        out.success('done')
+                        out.info("Sharing metadata file ...", False)
+                        kamaki.share("%s.meta" % options.upload)
+                        out.success('done')
+                    out.result(json.dumps(result, indent=4,
+                                          ensure_ascii=False))
+                    out.info()
+            except ClientError as e:
+                raise FatalError("Service client: %d %s" %
+                                 (e.status, e.message))
 
     finally:
         out.info('cleaning up ...')
         disk.cleanup()
 
+        # Shut down the appliance launched in the background
+        if launcher is not None:
+            try:
+                launched = launcher.result()
+            except Exception:  # pylint: disable=broad-except
+                # Launching failed. There is nothing to shut down.
+                launched = None
+            if launched is not None:
+                try:
+                    launched.close()
+                except Exception as e:  # pylint: disable=broad-except
+                    # Don't hide the exception that may be in flight
+                    out.warn("Shutting down the helper VM failed: %s" % e)
+
     out.success("snf-image-creator exited without errors")
 
     return 0
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2017 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides a userspace client for the NBD protocol. It is used
+to read images served by qemu-nbd over a UNIX socket, without the need for
+the nbd kernel module and the /dev/nbd* devices.
+"""
+
+import os
+import time
+import shutil
+import socket
+import struct
+import tempfile
+import subprocess
+
+import sh
+
+from image_creator.util import FatalError, LazyCommand
+
+# Handshake
+NBD_MAGIC = 'NBDMAGIC'
+NBD_OPTS_MAGIC = 'IHAVEOPT'
+NBD_FLAG_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_NO_ZEROES = 1 << 1
+NBD_FLAG_C_FIXED_NEWSTYLE = 1 << 0
+NBD_FLAG_C_NO_ZEROES = 1 << 1
+NBD_OPT_EXPORT_NAME = 1
+
+# Transmission
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_REPLY_MAGIC = 0x67446698
+NBD_CMD_READ = 0
+NBD_CMD_DISC = 2
+
+REQUEST = struct.Struct('>IHHQQI')
+REPLY = struct.Struct('>IIQ')
+
+# The maximum size of a read request
+NBD_REQUEST_SIZE = 256 * 1024
+
+# The number of connections a NBDFile opens by default
+NBD_CONNECTIONS = 4
+
+
+class NBDConnection(object):
+    """A connection to an NBD server listening on a UNIX socket. Multiple read
+    requests may be sent before their replies are received.
+    """
+
+    def __init__(self, path, export=''):
+        """Connect to the server and negotiate the export"""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+            self.size = self._handshake(export)
+        except FatalError:
+            self.sock.close()
+            raise
+        except (socket.error, struct.error) as e:
+            self.sock.close()
+            raise FatalError("Unable to connect to the NBD server at `%s': %s"
+                             % (path, e))
+        self._handle = 0
+        self._pending = {}
+
+    def _recv_into(self, view):
+        """Fill a memoryview with data from the socket"""
+        while len(view):
+            size = self.sock.recv_into(view)
+            if size == 0:
+                raise FatalError("NBD server closed the connection")
+            view = view[size:]
+
+    def _recv(self, size):
+        """Receive exactly size bytes"""
+        buf = bytearray(size)
+        self._recv_into(memoryview(buf))
+        return str(buf)
+
+    def _handshake(self, export):
+        """Perform the fixed newstyle handshake and return the export size"""
+        magic, opts_magic, flags = struct.unpack('>8s8sH', self._recv(18))
+        if magic != NBD_MAGIC or opts_magic != NBD_OPTS_MAGIC:
+            raise FatalError("Unsupported NBD server handshake")
+
+        client_flags = flags & (NBD_FLAG_C_FIXED_NEWSTYLE |
+                                NBD_FLAG_C_NO_ZEROES)
+        self.sock.sendall(struct.pack('>I', client_flags))
+        self.sock.sendall(struct.pack('>8sII', NBD_OPTS_MAGIC,
+                                      NBD_OPT_EXPORT_NAME, len(export)) +
+                          export)
+
+        size, _ = struct.unpack('>QH', self._recv(10))
+        if not flags & NBD_FLAG_NO_ZEROES:
+            self._recv(124)
+        return size
+
+    def request(self, offset, view):
+        """Send a read request for len(view) bytes at offset. The data will
+        be stored in view when the reply is received.
+        """
+        self._handle += 1
+        self._pending[self._handle] = view
+        self.sock.sendall(REQUEST.pack(NBD_REQUEST_MAGIC, 0, NBD_CMD_READ,
+                                       self._handle, offset, len(view)))
+
+    def receive(self):
+        """Receive the reply of a pending request"""
+        magic, error, handle = REPLY.unpack(self._recv(REPLY.size))
+        if magic != NBD_REPLY_MAGIC or handle not in self._pending:
+            raise FatalError("Invalid NBD reply")
+        view = self._pending.pop(handle)
+        if error != 0:
+            raise FatalError("NBD read failed: %s" % os.strerror(error))
+        self._recv_into(view)
+
+    def pending(self):
+        """Returns the number of requests waiting for a reply"""
+        return len(self._pending)
+
+    def close(self):
+        """Disconnect from the server"""
+        try:
+            if not self._pending:
+                self.sock.sendall(REQUEST.pack(NBD_REQUEST_MAGIC, 0,
+                                               NBD_CMD_DISC, 0, 0, 0))
+        except socket.error:
+            pass
+        finally:
+            self.sock.close()
+
+
+class NBDFile(object):
+    """Read-only file object for an NBD export. Each read is split into
+    requests that are spread over multiple connections to the server and are
+    all sent before waiting for any reply, so that the server processes them
+    in parallel.
+    """
+
+    def __init__(self, path, connections=NBD_CONNECTIONS):
+        """Create a new NBDFile instance"""
+        self.name = path
+        self._conns = []
+        try:
+            for _ in xrange(connections):
+                self._conns.append(NBDConnection(path))
+        except FatalError:
+            self.close()
+            raise
+        self.size = self._conns[0].size
+        self._pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Set the file's current position"""
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._pos = max(0, offset)
+
+    def tell(self):
+        """Return the file's current position"""
+        return self._pos
+
+    def readinto(self, buf):
+        """Read up to len(buf) bytes into buf and return their number"""
+        view = memoryview(buf)
+        size = max(0, min(len(view), self.size - self._pos))
+
+        requests = 0
+        for start in xrange(0, size, NBD_REQUEST_SIZE):
+            length = min(NBD_REQUEST_SIZE, size - start)
+            conn = self._conns[requests % len(self._conns)]
+            conn.request(self._pos + start, view[start:start + length])
+            requests += 1
+
+        for conn in self._conns:
+            while conn.pending():
+                conn.receive()
+
+        self._pos += size
+        return size
+
+    def read(self, size=-1):
+        """Read at most size bytes from the file"""
+        if size < 0:
+            size = self.size - self._pos
+        buf = bytearray(max(0, min(size, self.size - self._pos)))
+        self.readinto(buf)
+        return str(buf)
+
+    def close(self):
+        """Close all the connections"""
+        for conn in self._conns:
+            conn.close()
+        self._conns = []
+
+
+qemu_nbd = LazyCommand('qemu-nbd')
+
+
+class NBDServer(object):
+    """Serves an image file with qemu-nbd over a UNIX socket"""
+
+    def __init__(self, image, fmt, connections=NBD_CONNECTIONS):
+        """Create a new NBDServer instance"""
+        self.image = image
+        self.format = fmt
+        self.connections = connections
+        self.socket = None
+        self._tmpdir = None
+        self._proc = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self, timeout=30):
+        """Start the server and return the path of its socket"""
+        self._tmpdir = tempfile.mkdtemp(prefix='snf-image-creator-nbd-')
+        self.socket = os.path.join(self._tmpdir, 'socket')
+
+        # The output of the server is kept in a file, so that it never blocks
+        # on a full pipe and the errors can be reported
+        log = os.path.join(self._tmpdir, 'log')
+        try:
+            with open(os.devnull, 'w') as devnull, open(log, 'w') as err:
+                self._proc = subprocess.Popen(
+                    [str(qemu_nbd), '--read-only', '--persistent',
+                     # One more for the connection that checks if it's up
+                     '--shared=%d' % (self.connections + 1),
+                     '--format=%s' % self.format,
+                     '--socket=%s' % self.socket, self.image],
+                    stdout=devnull, stderr=err, close_fds=True)
+        except (OSError, sh.CommandNotFound) as e:
+            self.stop()
+            raise FatalError("Unable to run qemu-nbd: %s" % e)
+
+        deadline = time.time() + timeout
+        while not self._listening():
+            if self._proc.poll() is not None or time.time() > deadline:
+                if self._proc.poll() is not None:
+                    with open(log) as f:
+                        err = f.read()
+                else:
+                    err = 'timeout'
+                self.stop()
+                raise FatalError("qemu-nbd failed to serve `%s': %s" %
+                                 (self.image, err.strip()))
+            time.sleep(0.05)
+
+        return self.socket
+
+    def _listening(self):
+        """Check if the server accepts connections"""
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket)
+            return True
+        except socket.error:
+            return False
+        finally:
+            probe.close()
+
+    def stop(self):
+        """Stop the server"""
+        if self._proc is not None:
+            if self._proc.poll() is None:
+                self._proc.terminate()
+            self._proc.wait()
+            self._proc = None
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
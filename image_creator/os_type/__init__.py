@@ -19,8 +19,13 @@
 Systems for image creation.
 """
 
+import os
 import textwrap
 import re
+import tarfile
+import stat
+import tempfile
+import posixpath
 from collections import namedtuple
 from functools import wraps
 
@@ -38,6 +43,23 @@ OSTYPE_ORDER = {
     "minix": 1
 }
 
+# Files larger than this are not kept in memory when prefetching a directory
+PREFETCH_MAX_FILE_SIZE = 2 ** 20
+
+# Commands of the guest that perform guestfs actions on many files at once
+BULK_COMMANDS = {
+    'rm': ['rm', '-f', '--'],
+    'rm_rf': ['rm', '-rf', '--'],
+    'truncate': ['truncate', '-s', '0', '--'],
+}
+
+# Maximum number of files and total length of the paths passed to a command
+BULK_BATCH_FILES = 1000
+BULK_BATCH_SIZE = 64 * 1024
+
+# Augeas flag that stops aug_init from loading all the files it has lenses for
+AUG_NO_LOAD = 32
+
 
 def os_cls(distro, osfamily):
     """Given the distro name and the osfamily, return the appropriate OSBase
@@ -66,6 +88,17 @@ def os_cls(distro, osfamily):
     return getattr(module, classname)
 
 
+def _ftype(mode):
+    """Returns the file type of a stat mode the way readdir reports it"""
+    for check, ftyp in ((stat.S_ISREG, 'r'), (stat.S_ISDIR, 'd'),
+                        (stat.S_ISLNK, 'l'), (stat.S_ISBLK, 'b'),
+                        (stat.S_ISCHR, 'c'), (stat.S_ISFIFO, 'f'),
+                        (stat.S_ISSOCK, 's')):
+        if check(mode):
+            return ftyp
+    return 'u'
+
+
 def add_prefix(target):
     """Decorator that adds a prefix to the result of a function"""
     def wrapper(self, *args):
@@ -83,6 +116,7 @@ def sysprep(message, enabled=True, **kwargs):
         method._sysprep = True
         method._sysprep_enabled = enabled
         method._sysprep_nomount = False
+        method._sysprep_augeas = None
 
         for key, val in kwargs.items():
             setattr(method, "_sysprep_%s" % key, val)
@@ -224,6 +258,123 @@ def del_sysprep_param(name):
     return wrapper
 
 
+class FileSystemView(object):
+    """A view of the file systems of an image that are mounted read-only.
+    Each directory is listed once and the lookups of the files in it are
+    answered from memory, instead of costing a call into the appliance each.
+    When the file systems are mounted read-write, the lookups are passed to
+    guestfs.
+
+    Whole directories may also be prefetched with a single tar_out call, so
+    that the regular files in them are read from memory.
+    """
+
+    def __init__(self, image):
+        """Create a new FileSystemView instance"""
+        self.image = image
+        self.enabled = False
+        self._dirs = {}
+        self._files = {}
+
+    def enable(self, enabled=True):
+        """Enable or disable caching. The cached entries are dropped."""
+        self.enabled = enabled
+        self.invalidate()
+
+    def invalidate(self):
+        """Drop all the cached entries. This needs to be called whenever the
+        file systems are modified.
+        """
+        self._dirs.clear()
+        self._files.clear()
+
+    def prefetch(self, directory, excludes=None):
+        """Fetch the regular files under a directory from the image in one go.
+        The paths that match the glob patterns in excludes are skipped. The
+        patterns are relative to the directory, e.g. `./ssl'.
+        """
+        if not self.enabled:
+            return
+
+        fd, tmp = tempfile.mkstemp(prefix='prefetch-', suffix='.tar')
+        os.close(fd)
+        try:
+            try:
+                self.image.g.tar_out(directory, tmp, excludes=excludes or [])
+            except (RuntimeError, TypeError):
+                # Missing directory or excludes are not supported. The files
+                # will be read one by one.
+                return
+
+            tar = tarfile.open(tmp)
+            try:
+                for member in tar:
+                    if not member.isfile() or \
+                            member.size > PREFETCH_MAX_FILE_SIZE:
+                        continue
+                    path = posixpath.normpath(
+                        posixpath.join(directory, member.name))
+                    self._files[path] = tar.extractfile(member).read()
+            finally:
+                tar.close()
+        finally:
+            os.unlink(tmp)
+
+    def _entries(self, directory):
+        """Returns a dictionary with the file type of each directory entry"""
+        if directory not in self._dirs:
+            try:
+                entries = dict((e['name'], e['ftyp']) for e in
+                               self.image.g.readdir(directory))
+            except RuntimeError:
+                entries = {}
+            self._dirs[directory] = entries
+        return self._dirs[directory]
+
+    def _ftype(self, path):
+        """Returns the file type of a path or None if it does not exist"""
+        directory, name = posixpath.split(posixpath.normpath(path))
+        if name == '':
+            return 'd'
+        return self._entries(directory).get(name)
+
+    def is_file(self, path, followsymlinks=False):
+        """Check if a path is a regular file"""
+        if not self.enabled:
+            return self.image.g.is_file(path, followsymlinks=followsymlinks)
+        if posixpath.normpath(path) in self._files:
+            return True
+        ftype = self._ftype(path)
+        if ftype == 'l' and followsymlinks:
+            return self.image.g.is_file(path, followsymlinks=True)
+        return ftype == 'r'
+
+    def is_dir(self, path, followsymlinks=False):
+        """Check if a path is a directory"""
+        if not self.enabled:
+            return self.image.g.is_dir(path, followsymlinks=followsymlinks)
+        ftype = self._ftype(path)
+        if ftype == 'l' and followsymlinks:
+            return self.image.g.is_dir(path, followsymlinks=True)
+        return ftype == 'd'
+
+    def readdir(self, directory):
+        """Returns the entries of a directory like guestfs readdir does"""
+        if not self.enabled:
+            return self.image.g.readdir(directory)
+        return [{'name': name, 'ftyp': ftype} for name, ftype in
+                self._entries(posixpath.normpath(directory)).items()]
+
+    def cat(self, path):
+        """Returns the content of a file"""
+        if self.enabled:
+            try:
+                return self._files[posixpath.normpath(path)]
+            except KeyError:
+                pass
+        return self.image.g.cat(path)
+
+
 class OSBase(object):
     """Basic operating system class"""
 
@@ -268,6 +419,13 @@ class OSBase(object):
         self._mount_warnings = []
         self._mounted = None
 
+        # Cached view of the file systems that are mounted read-only
+        self.fs = FileSystemView(self.image)
+
+        # Performing actions on many files with commands of the guest may fail
+        # if the guest lacks the commands or has a different architecture
+        self._bulk_support = True
+
         # Many guestfs compilations don't support scrub
         self._scrub_support = True
         try:
@@ -285,6 +443,9 @@ class OSBase(object):
 
         self._cleanup_jobs = {}
 
+        # Augeas session shared by the sysprep tasks
+        self._augeas = False
+
     def _add_cleanup(self, namespace, job, *args):
         """Add a new job in a cleanup list"""
 
@@ -322,10 +483,11 @@ class OSBase(object):
 
         self.out.info('Collecting image metadata ...', False)
 
-        mbr = self.image.g.pread_device('/dev/sda', 512, 0)
+        mbr = self.image.g.pread_device(self.image.guestfs_device, 512, 0)
         self.meta['BOOTSTRAP'] = mbr_bootinfo(mbr)
 
         with self.mount(readonly=True, silent=True):
+            self._prefetch()
             self._do_collect_metadata()
 
         self.out.success('done')
@@ -470,9 +632,17 @@ class OSBase(object):
             del self._sysprep_tasks[task.__name__]
 
         with self.mount():
-            for task in [t for t in enabled if t._sysprep_nomount is False]:
-                cnt += 1
-                exec_sysprep(cnt, size, task)
+            tasks = [t for t in enabled if t._sysprep_nomount is False]
+            self._augeas_init(tasks)
+            try:
+                for task in tasks:
+                    cnt += 1
+                    exec_sysprep(cnt, size, task)
+            finally:
+                self._sysprep_finish()
+
+            # Release the space of the deleted files in the snapshot
+            self.image.trim()
 
         for task in [t for t in enabled if t._sysprep_nomount]:
             cnt += 1
@@ -486,6 +656,44 @@ class OSBase(object):
         device = self.image.shrink()
         self.shrinked = True
 
+    def _augeas_init(self, tasks):
+        """Initialize an Augeas session for the sysprep tasks. Each task
+        declares the files it edits with Augeas and the lenses they are
+        parsed with, so that only those files are loaded.
+        """
+        lenses = {}
+        for task in tasks:
+            for lens, files in (task._sysprep_augeas or {}).items():
+                lenses.setdefault(lens, set()).update(files)
+
+        if not len(lenses):
+            return
+
+        g = self.image.g
+        g.aug_init('/', AUG_NO_LOAD)
+        self._augeas = True
+        g.aug_rm('/augeas/load/*')
+        for lens, files in lenses.items():
+            g.aug_set('/augeas/load/%s/lens' % lens, '%s.lns' % lens)
+            for fname in sorted(files):
+                g.aug_set('/augeas/load/%s/incl[last()+1]' % lens, fname)
+        g.aug_load()
+
+    def _augeas_close(self):
+        """Save the changes made in the Augeas session and close it"""
+        if not self._augeas:
+            return
+
+        try:
+            self.image.g.aug_save()
+        finally:
+            self.image.g.aug_close()
+            self._augeas = False
+
+    def _sysprep_finish(self):
+        """Write back the changes the sysprep tasks made in memory"""
+        self._augeas_close()
+
     @property
     def ismounted(self):
         return self._mounted is not None
@@ -528,6 +736,9 @@ class OSBase(object):
         if mounted:
             success('done')
 
+        # Nothing gets written while the media is mounted read-only
+        self.fs.enable(readonly)
+
         parent = self
 
         class Mount(object):
@@ -542,6 +753,7 @@ class OSBase(object):
                 """umount all"""
                 output("Umounting the media ...", False)
                 parent.image.g.umount_all()
+                parent.fs.enable(False)
                 parent._mounted = None
                 success('done')
 
@@ -598,44 +810,145 @@ class OSBase(object):
         * exclude: Exclude all files that follow this pattern.
 
         * include: Only include files that follow this pattern.
+
+        The rm, rm_rf and truncate guestfs calls are applied to many files at
+        once.
         """
         if not self.image.g.is_dir(directory):
             self.out.warn("Directory: `%s' does not exist!" % directory)
             return
 
-        maxdepth = None if 'maxdepth' not in kwargs else kwargs['maxdepth']
-        if maxdepth == 0:
-            return
-
-        # maxdepth -= 1
-        maxdepth = None if maxdepth is None else maxdepth - 1
-        kwargs['maxdepth'] = maxdepth
+        files = self._find_files(directory, **kwargs)
 
+        name = getattr(action, '__name__', None)
+        if name in BULK_COMMANDS and \
+                getattr(action, '__self__', None) is self.image.g:
+            self._bulk(action, files)
+        else:
+            for path in files:
+                action(path)
+
+    def _list_tree(self, directory):
+        """Returns the entries under a directory as a dictionary that maps
+        each directory to a list of (name, type) tuples in readdir order. The
+        types are the ones readdir reports. The tree is listed with a single
+        find0 call and the types are fetched with one lstatnslist call.
+        Returns None if this is not supported.
+        """
+        fd, tmp = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.image.g.find0(directory, tmp)
+            with open(tmp, 'rb') as f:
+                names = [n for n in f.read().split('\0') if len(n)]
+            stats = self.image.g.lstatnslist(directory, names) \
+                if len(names) else []
+        except (AttributeError, RuntimeError):
+            return None
+        finally:
+            os.unlink(tmp)
+
+        tree = {}
+        for name, st in zip(names, stats):
+            head, tail = posixpath.split(name)
+            parent = "%s/%s" % (directory, head) if head else directory
+            tree.setdefault(parent, []).append((tail,
+                                                _ftype(st['st_mode'])))
+        return tree
+
+    def _find_files(self, directory, **kwargs):
+        """Returns the files under a directory that _foreach_file would
+        perform an action on, in the same order.
+        """
+        maxdepth = None if 'maxdepth' not in kwargs else kwargs['maxdepth']
         exclude = None if 'exclude' not in kwargs else kwargs['exclude']
         include = None if 'include' not in kwargs else kwargs['include']
         ftype = None if 'ftype' not in kwargs else kwargs['ftype']
 
-        def has_ftype(f, ftype):
-            """Returns True if the type of the file is ftype"""
-            return ftype is None and True or f['ftyp'] == ftype
+        if maxdepth == 0:
+            return []
+
+        # A single readdir lists one level. Deeper trees are listed at once
+        # and walked in memory.
+        tree = None
+        if maxdepth is None or maxdepth > 1:
+            tree = self._list_tree(directory)
+
+        def listdir(path):
+            """Returns the (name, type) tuples of a directory"""
+            if tree is not None:
+                return tree.get(path, [])
+            return [(f['name'], f['ftyp']) for f in self.image.g.readdir(path)
+                    if f['name'] not in ('.', '..')]
+
+        def walk(path, depth):
+            """Returns the matching files under path, up to depth levels"""
+            files = []
+            for name, ftyp in listdir(path):
+                full_path = "%s/%s" % (path, name)
+
+                if exclude and re.match(exclude, full_path):
+                    continue
 
-        for f in self.image.g.readdir(directory):
-            if f['name'] in ('.', '..'):
-                continue
+                if include and not re.match(include, full_path):
+                    continue
 
-            full_path = "%s/%s" % (directory, f['name'])
+                if ftyp == 'd' and (depth is None or depth > 1):
+                    files.extend(walk(full_path,
+                                      None if depth is None else depth - 1))
 
-            if exclude and re.match(exclude, full_path):
-                continue
+                if ftype is None or ftyp == ftype:
+                    files.append(full_path)
 
-            if include and not re.match(include, full_path):
-                continue
+            return files
 
-            if has_ftype(f, 'd'):
-                self._foreach_file(full_path, action, **kwargs)
+        return walk(directory, maxdepth)
 
-            if has_ftype(f, ftype):
-                action(full_path)
+    def _bulk(self, action, files):
+        """Perform a guestfs action on many files at once. The files are
+        passed in batches to the equivalent command of the guest. If the
+        command is missing or fails, the action is performed on the files of
+        the batch one by one and the command is not used again.
+        """
+        command = BULK_COMMANDS[action.__name__]
+
+        def batches():
+            """Split the files in batches that fit in a command line"""
+            batch, size = [], 0
+            for path in files:
+                if len(batch) and (len(batch) == BULK_BATCH_FILES or
+                                   size + len(path) > BULK_BATCH_SIZE):
+                    yield batch
+                    batch, size = [], 0
+                batch.append(path)
+                size += len(path) + 1
+            if len(batch):
+                yield batch
+
+        for batch in batches():
+            if self._bulk_support:
+                try:
+                    self.image.g.command(command + batch)
+                    continue
+                except RuntimeError:
+                    self._bulk_support = False
+
+            for path in batch:
+                try:
+                    action(path)
+                except RuntimeError:
+                    # The command may have handled the file before failing
+                    if self.image.g.exists(path) or \
+                            self.image.g.is_symlink(path):
+                        raise
+
+    def _prefetch(self):
+        """Hook for fetching the files that _do_collect_metadata reads through
+        self.fs in one go, before it runs. It does nothing by default, since
+        the metadata collected here do not come from files. The OS classes
+        that read files while collecting metadata override it.
+        """
+        return
 
     def _do_inspect(self):
         """helper method for inspect"""
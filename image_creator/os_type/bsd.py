@@ -29,28 +29,14 @@ class Bsd(Unix):
     def _cleanup_password(self):
         """Remove all passwords and lock all user accounts"""
 
-        if not self.image.g.is_file('/etc/master.passwd'):
+        if not self.accounts.exists('/etc/master.passwd'):
             self.out.warn(
                 "File: `/etc/master.passwd' is missing. Nothing to do!")
             return
 
-        master_passwd = []
-
-        for line in self.image.g.cat('/etc/master.passwd').splitlines():
-
-            # Check for empty or comment lines
-            if len(line.split('#')[0]) == 0:
-                master_passwd.append(line)
-                continue
-
-            fields = line.split(':')
-            if fields[1] not in ('*', '!'):
-                fields[1] = '!'
-
-            master_passwd.append(":".join(fields))
-
-        self.image.g.write(
-            '/etc/master.passwd', "\n".join(master_passwd) + '\n')
+        for entry in self.accounts.entries('/etc/master.passwd'):
+            if entry['passwd'] not in ('*', '!'):
+                entry['passwd'] = '!'
 
         # Make sure no one can login on the system
         self.image.g.rm_rf('/etc/spwd.db')
@@ -107,7 +93,7 @@ class Bsd(Unix):
     def _get_passworded_users(self):
         """Returns a list of non-locked user accounts"""
 
-        if not self.image.g.is_file('/etc/master.passwd'):
+        if not self.accounts.exists('/etc/master.passwd'):
             self.out.warn("Unable to collect user info. "
                           "File: `/etc/master.passwd' is missing!")
             return []
@@ -117,8 +103,8 @@ class Bsd(Unix):
             '^([^:]+):((?:![^:]+)|(?:[^!*][^:]+)|):(?:[^:]*:){7}(?:[^:]*)'
         )
 
-        for line in self.image.g.cat('/etc/master.passwd').splitlines():
-            line = line.split('#')[0]
+        for entry in self.accounts.entries('/etc/master.passwd'):
+            line = str(entry).split('#')[0]
             match = regexp.match(line)
             if not match:
                 continue
@@ -36,10 +36,10 @@ class Freebsd(Bsd):
         sshd_yes = re.compile(r"^sshd_enable=(['\"]?)(YES|TRUE|ON|1)\1$",
                               re.IGNORECASE)
         for rc_conf in ('/etc/rc.conf', '/etc/rc.conf.local'):
-            if not self.image.g.is_file(rc_conf):
+            if not self.fs.is_file(rc_conf):
                 continue
 
-            for line in self.image.g.cat(rc_conf).splitlines():
+            for line in self.fs.cat(rc_conf).splitlines():
                 line = line.split('#')[0].strip()
                 # Be paranoid. Don't stop examining lines after a match. This
                 # is a shell variable and can be overwritten many times. Only
@@ -68,7 +68,8 @@ class Freebsd(Bsd):
 
         # Older libguestfs versions can't handle correct FreeBSD partitions on
         # a GUID Partition Table. We have to do the translation to Linux device
-        # names ourselves
+        # names ourselves. The first disk of the guest is the media device.
+        base = self.image.guestfs_device[-1]
         guid_device = re.compile(r'^/dev/((?:ada)|(?:vtbd))(\d+)p(\d+)$')
 
         mopts = "ufstype=ufs2,%s" % ('ro' if readonly else 'rw')
@@ -77,7 +78,7 @@ class Freebsd(Bsd):
             if match:
                 group2 = int(match.group(2))
                 group3 = int(match.group(3))
-                dev = '/dev/sd%c%d' % (chr(ord('a') + group2), group3)
+                dev = '/dev/sd%c%d' % (chr(ord(base) + group2), group3)
             try:
                 self.image.g.mount_vfs(mopts, 'ufs', dev, mp)
             except RuntimeError as msg:
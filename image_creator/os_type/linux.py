@@ -98,11 +98,11 @@ class Linux(Unix):
 
         files = []
 
-        if self.image.g.is_file('/etc/cloud/cloud.cfg'):
+        if self.fs.is_file('/etc/cloud/cloud.cfg'):
             files.append('/etc/cloud/cloud.cfg')
 
-        if self.image.g.is_dir('/etc/cloud/cloud.cfg.d'):
-            for c in self.image.g.readdir('/etc/cloud/cloud.cfg.d'):
+        if self.fs.is_dir('/etc/cloud/cloud.cfg.d'):
+            for c in self.fs.readdir('/etc/cloud/cloud.cfg.d'):
                 if not (c['ftyp'] == 'r' and c['name'].endswith('.cfg')):
                     continue
                 files.append('/etc/cloud/cloud.cfg.d/%s' % c['name'])
@@ -115,7 +115,7 @@ class Linux(Unix):
 
         cfg = {}
         for c in self.get_cloud_init_config_files():
-            cfg.update(yaml.load(self.image.g.cat(c)))
+            cfg.update(yaml.load(self.fs.cat(c)))
 
         return cfg
 
@@ -124,21 +124,18 @@ class Linux(Unix):
         """Remove all user accounts with id greater than 1000"""
 
         removed_users = {}
+        accounts = self.accounts
 
         # Remove users from /etc/passwd
-        if self.image.g.is_file('/etc/passwd'):
-            passwd = []
+        if accounts.exists('/etc/passwd'):
             metadata_users = self.meta['USERS'].split() \
                 if 'USERS' in self.meta else []
-            for line in self.image.g.cat('/etc/passwd').splitlines():
-                fields = line.split(':')
-                if int(fields[2]) > 1000:
-                    removed_users[fields[0]] = fields
+            for entry in accounts.entries('/etc/passwd'):
+                if int(entry['uid']) > 1000:
+                    removed_users[entry['name']] = entry
                     # remove it from the USERS metadata too
-                    if fields[0] in metadata_users:
-                        metadata_users.remove(fields[0])
-                else:
-                    passwd.append(':'.join(fields))
+                    if entry['name'] in metadata_users:
+                        metadata_users.remove(entry['name'])
 
             self.meta['USERS'] = " ".join(metadata_users)
 
@@ -146,35 +143,27 @@ class Linux(Unix):
             if not len(self.meta['USERS']):
                 del self.meta['USERS']
 
-            self.image.g.write('/etc/passwd', '\n'.join(passwd) + '\n')
+            accounts.remove('/etc/passwd', removed_users.values())
         else:
             self.out.warn("File: `/etc/passwd' is missing. "
                           "No users were deleted")
             return
 
-        if self.image.g.is_file('/etc/shadow'):
+        if accounts.exists('/etc/shadow'):
             # Remove the corresponding /etc/shadow entries
-            shadow = []
-            for line in self.image.g.cat('/etc/shadow').splitlines():
-                fields = line.split(':')
-                if fields[0] not in removed_users:
-                    shadow.append(':'.join(fields))
-            self.image.g.write('/etc/shadow', "\n".join(shadow) + '\n')
+            accounts.remove('/etc/shadow',
+                            [e for e in accounts.entries('/etc/shadow')
+                             if e['name'] in removed_users])
         else:
             self.out.warn("File: `/etc/shadow' is missing.")
 
-        if self.image.g.is_file('/etc/group'):
-            # Remove the corresponding /etc/group entries
-            group = []
-            for line in self.image.g.cat('/etc/group').splitlines():
-                fields = line.split(':')
-                # Remove groups tha have the same name as the removed users
-                if fields[0] not in removed_users:
-                    group.append(':'.join(fields))
-            self.image.g.write('/etc/group', '\n'.join(group) + '\n')
+        # Remove groups tha have the same name as the removed users
+        accounts.remove('/etc/group',
+                        [e for e in accounts.entries('/etc/group')
+                         if e['name'] in removed_users])
 
         # Remove home directories
-        for home in [field[5] for field in removed_users.values()]:
+        for home in [entry['home'] for entry in removed_users.values()]:
             if self.image.g.is_dir(home) and home.startswith('/home/'):
                 self.image.g.rm_rf(home)
 
@@ -215,16 +204,13 @@ class Linux(Unix):
     def _cleanup_passwords(self):
         """Remove all passwords and lock all user accounts"""
 
-        shadow = []
-
-        for line in self.image.g.cat('/etc/shadow').splitlines():
-            fields = line.split(':')
-            if fields[1] not in ('*', '!'):
-                fields[1] = '!'
-
-            shadow.append(":".join(fields))
+        if not self.accounts.exists('/etc/shadow'):
+            self.out.warn("File: `/etc/shadow' is missing. Nothing to do!")
+            return
 
-        self.image.g.write('/etc/shadow', "\n".join(shadow) + '\n')
+        for entry in self.accounts.entries('/etc/shadow'):
+            if entry['passwd'] not in ('*', '!'):
+                entry['passwd'] = '!'
 
         # Remove backup file for /etc/shadow
         self.image.g.rm_rf('/etc/shadow-')
@@ -316,7 +302,9 @@ class Linux(Unix):
 
         self.image.g.write('/etc/fstab', new_fstab)
 
-    @sysprep('Change boot menu timeout to %(bootmenu_timeout)s seconds')
+    @sysprep('Change boot menu timeout to %(bootmenu_timeout)s seconds',
+             augeas={'Shellvars': ['/etc/default/grub'],
+                     'Grub': ['/boot/grub/menu.lst']})
     def _change_bootmenu_timeout(self):
         """Change the boot menu timeout to the one specified by the namesake
         system preparation parameter.
@@ -325,13 +313,8 @@ class Linux(Unix):
         timeout = self.sysprep_params['bootmenu_timeout'].value
 
         if self.image.g.is_file('/etc/default/grub'):
-            self.image.g.aug_init('/', 0)
-            try:
-                self.image.g.aug_set('/files/etc/default/grub/GRUB_TIMEOUT',
-                                     str(timeout))
-            finally:
-                self.image.g.aug_save()
-                self.image.g.aug_close()
+            self.image.g.aug_set('/files/etc/default/grub/GRUB_TIMEOUT',
+                                 str(timeout))
 
         def replace_timeout(remote, regexp, timeout):
             """Replace the timeout value from a config file"""
@@ -353,8 +336,11 @@ class Linux(Unix):
         grub2_config = '/boot/grub/grub.cfg'
 
         if self.image.g.is_file(grub1_config):
-            regexp = re.compile(r'^\s*timeout\s+\d+\s*$')
-            replace_timeout(grub1_config, regexp, timeout)
+            # Other tasks edit this file through the shared Augeas tree too.
+            # Writing it directly would get overwritten when the tree is saved.
+            for path in self.image.g.aug_match('/files%s/timeout' %
+                                               grub1_config):
+                self.image.g.aug_set(path, str(timeout))
         elif self.image.g.is_file(grub2_config):
             regexp = re.compile(r'^\s*set\s+timeout=\d+\s*$')
             replace_timeout(grub2_config, regexp, timeout)
@@ -365,7 +351,8 @@ class Linux(Unix):
                 # In syslinux the timeout unit is 0.1 seconds
                 replace_timeout(syslinux_config, regexp, timeout * 10)
 
-    @sysprep('Replacing fstab & grub non-persistent device references')
+    @sysprep('Replacing fstab & grub non-persistent device references',
+             augeas={'Grub': ['/boot/grub/menu.lst', '/etc/grub.conf']})
     def _use_persistent_block_device_names(self):
         """Scan fstab & grub configuration files and replace all non-persistent
         device references with UUIDs.
@@ -384,38 +371,34 @@ class Linux(Unix):
         self._persistent_syslinux(persistent_root)
 
     @sysprep('Disabling IPv6 privacy extensions',
-             display='Disable IPv6 privacy enxtensions')
+             display='Disable IPv6 privacy enxtensions',
+             augeas={'Sysctl': ['/etc/sysctl.conf', '/etc/sysctl.d/*']})
     def _disable_ipv6_privacy_extensions(self):
         """Disable IPv6 privacy extensions."""
 
         file_path = '/files/etc/sysctl.conf/net.ipv6.conf.%s.use_tempaddr'
         dir_path = '/files/etc/sysctl.d/*/net.ipv6.conf.%s.use_tempaddr'
 
-        self.image.g.aug_init('/', 0)
-        try:
-            default = self.image.g.aug_match(file_path % 'default') + \
-                self.image.g.aug_match(dir_path % 'default')
-
-            all = self.image.g.aug_match(file_path % 'all') + \
-                self.image.g.aug_match(dir_path % 'all')
+        default = self.image.g.aug_match(file_path % 'default') + \
+            self.image.g.aug_match(dir_path % 'default')
 
-            if len(default) == 0:
-                self.image.g.aug_set(file_path % 'default', '0')
-            else:
-                for token in default:
-                    self.image.g.aug_set(token, '0')
+        all = self.image.g.aug_match(file_path % 'all') + \
+            self.image.g.aug_match(dir_path % 'all')
 
-            if len(all) == 0:
-                self.image.g.aug_set(file_path % 'all', '0')
-            else:
-                for token in all:
-                    self.image.g.aug_set(token, '0')
+        if len(default) == 0:
+            self.image.g.aug_set(file_path % 'default', '0')
+        else:
+            for token in default:
+                self.image.g.aug_set(token, '0')
 
-        finally:
-            self.image.g.aug_save()
-            self.image.g.aug_close()
+        if len(all) == 0:
+            self.image.g.aug_set(file_path % 'all', '0')
+        else:
+            for token in all:
+                self.image.g.aug_set(token, '0')
 
-    @sysprep('Disabling predictable network interface naming')
+    @sysprep('Disabling predictable network interface naming',
+             augeas={'Shellvars': ['/etc/default/grub']})
     def _disable_predictable_network_interface_naming(self):
         """Disable predictable network interface naming"""
 
@@ -442,21 +425,16 @@ class Linux(Unix):
             self.image.g.write('/boot/grub/grub.cfg', cfg)
 
         if self.image.g.is_file('/etc/default/grub'):
-            self.image.g.aug_init('/', 0)
             path = '/files/etc/default/grub/GRUB_CMDLINE_LINUX'
-            try:
-                cmdline = ""
-                if self.image.g.aug_match(path):
-                    cmdline = self.image.g.aug_get(path)
-                # This looks a little bit weird but its a good way to append
-                # text to a variable without messing up with the quoting. The
-                # variable could have a value foo or 'foo' or "foo". Appending
-                # ' bar' will lead to a valid result.
-                cmdline = "%s%s" % (cmdline.strip(), "' net.ifnames=0'")
-                self.image.g.aug_set(path, cmdline)
-            finally:
-                self.image.g.aug_save()
-                self.image.g.aug_close()
+            cmdline = ""
+            if self.image.g.aug_match(path):
+                cmdline = self.image.g.aug_get(path)
+            # This looks a little bit weird but its a good way to append
+            # text to a variable without messing up with the quoting. The
+            # variable could have a value foo or 'foo' or "foo". Appending
+            # ' bar' will lead to a valid result.
+            cmdline = "%s%s" % (cmdline.strip(), "' net.ifnames=0'")
+            self.image.g.aug_set(path, cmdline)
 
         for path in self.syslinux.search_paths:
             if self.image.g.is_file(path):
@@ -510,7 +488,7 @@ class Linux(Unix):
         cfg = None
 
         for path in self.syslinux.search_paths:
-            if self.image.g.is_file(path):
+            if self.fs.is_file(path):
                 cfg = path
                 break
 
@@ -552,7 +530,7 @@ class Linux(Unix):
             return os.path.dirname(cfg)
 
         for d in self.syslinux.search_dirs:
-            if self.image.g.is_file(d+relative_path):
+            if self.fs.is_file(d+relative_path):
                 return d
 
         raise FatalError("Unable to find the working directory of extlinux")
@@ -568,20 +546,14 @@ class Linux(Unix):
         else:
             return
 
-        self.image.g.aug_init('/', 0)
-        try:
-            roots = self.image.g.aug_match(
-                '/files%s/title[*]/kernel/root' % grub1)
-            for root in roots:
-                dev = self.image.g.aug_get(root)
-                if not self._is_persistent(dev):
-                    # This is not always correct. Grub may contain root entries
-                    # for other systems, but we only support 1 OS per hard
-                    # disk, so this shouldn't harm.
-                    self.image.g.aug_set(root, new_root)
-        finally:
-            self.image.g.aug_save()
-            self.image.g.aug_close()
+        roots = self.image.g.aug_match('/files%s/title[*]/kernel/root' % grub1)
+        for root in roots:
+            dev = self.image.g.aug_get(root)
+            if not self._is_persistent(dev):
+                # This is not always correct. Grub may contain root entries
+                # for other systems, but we only support 1 OS per hard disk,
+                # so this shouldn't harm.
+                self.image.g.aug_set(root, new_root)
 
     def _persistent_syslinux(self, new_root):
         """Replace non-persistent root device name occurrences with persistent
@@ -776,10 +748,10 @@ class Linux(Unix):
             x2go_installed = False
             desktops = set()
             for path in ('/bin', '/usr/bin', '/usr/local/bin'):
-                if self.image.g.is_file("%s/%s" % (path, X2GO_EXECUTABLE)):
+                if self.fs.is_file("%s/%s" % (path, X2GO_EXECUTABLE)):
                     x2go_installed = True
                 for name, exe in X2GO_DESKTOPSESSIONS.items():
-                    if self.image.g.is_file("%s/%s" % (path, exe)):
+                    if self.fs.is_file("%s/%s" % (path, exe)):
                         desktops.add(name)
 
             if x2go_installed:
@@ -812,13 +784,13 @@ class Linux(Unix):
 
             generator_found = False
             for i in ("/run", "/etc", "/usr/local/lib", "/usr/lib"):
-                if self.image.g.is_file("%s/systemd/system-generators/"
-                                        "cloud-init-generator" % i):
+                if self.fs.is_file("%s/systemd/system-generators/"
+                                   "cloud-init-generator" % i):
                     generator_found = True
                     break
             if generator_found:
                 self.cloud_init = \
-                    not self.image.g.is_file("/etc/cloud/cloud-init.disabled")
+                    not self.fs.is_file("/etc/cloud/cloud-init.disabled")
         if self.cloud_init:
             self._collect_cloud_init_metadata()
 
@@ -827,16 +799,16 @@ class Linux(Unix):
 
         systemd_services = '/etc/systemd/system/multi-user.target.wants'
         exec_start = re.compile(r'^\s*ExecStart=.+bin/%s\s?' % service)
-        if self.image.g.is_dir(systemd_services):
-            for entry in self.image.g.readdir(systemd_services):
+        if self.fs.is_dir(systemd_services):
+            for entry in self.fs.readdir(systemd_services):
                 if entry['ftyp'] not in ('l', 'f'):
                     continue
 
                 service_file = "%s/%s" % (systemd_services, entry['name'])
 
                 # Could be a broken link
-                if self.image.g.is_file(service_file, followsymlinks=True):
-                    for line in self.image.g.cat(service_file).splitlines():
+                if self.fs.is_file(service_file, followsymlinks=True):
+                    for line in self.fs.cat(service_file).splitlines():
                         if exec_start.search(line):
                             return True
                 else:
@@ -846,7 +818,7 @@ class Linux(Unix):
 
         def check_file(path):
             regexp = re.compile(r"[/=\s'\"]%s('\")?\s" % service)
-            for line in self.image.g.cat(path).splitlines():
+            for line in self.fs.cat(path).splitlines():
                 line = line.split('#', 1)[0].strip()
                 if len(line) == 0:
                     continue
@@ -856,7 +828,7 @@ class Linux(Unix):
 
         # Check upstart config files under /etc/init
         # Only examine *.conf files
-        if self.image.g.is_dir('/etc/init'):
+        if self.fs.is_dir('/etc/init'):
             self._foreach_file('/etc/init', check_file, maxdepth=1,
                                include=r'.+\.conf$')
             if len(found):
@@ -866,7 +838,7 @@ class Linux(Unix):
         for conf in ["/etc/%src%d.d" % (d, i) for i in xrange(1, 6)
                      for d in ('', 'rc.d/')]:
             try:
-                for entry in self.image.g.readdir(conf):
+                for entry in self.fs.readdir(conf):
                     if entry['ftyp'] not in ('l', 'f'):
                         continue
                     check_file("%s/%s" % (conf, entry['name']))
@@ -882,7 +854,7 @@ class Linux(Unix):
     def _get_passworded_users(self):
         """Returns a list of non-locked user accounts"""
 
-        if not self.image.g.is_file('/etc/shadow'):
+        if not self.accounts.exists('/etc/shadow'):
             self.out.warn(
                 "Unable to collect user info. File: `/etc/shadow' is missing!")
             return []
@@ -890,8 +862,8 @@ class Linux(Unix):
         users = []
         regexp = re.compile(r'(\S+):((?:!\S+)|(?:[^!*]\S+)|):(?:\S*:){6}')
 
-        for line in self.image.g.cat('/etc/shadow').splitlines():
-            match = regexp.match(line)
+        for entry in self.accounts.entries('/etc/shadow'):
+            match = regexp.match(str(entry))
             if not match:
                 continue
 
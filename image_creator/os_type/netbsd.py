@@ -33,11 +33,11 @@ class Netbsd(Bsd):
         sshd_yes = re.compile(r"\bsshd=(['\"]?)(YES|TRUE|ON|1)\1\b")
 
         for rc_conf in ('/etc/defaults/rc.conf', '/etc/rc.conf'):
-            if not self.image.g.is_file(rc_conf):
+            if not self.fs.is_file(rc_conf):
                 self.out.warn("File: `%s' does not exist!" % rc_conf)
                 continue
 
-            for line in self.image.g.cat(rc_conf).splitlines():
+            for line in self.fs.cat(rc_conf).splitlines():
                 line = line.split('#')[0].strip()
                 if sshd_service.match(line):
                     sshd_enabled = len(sshd_yes.findall(line)) > 0
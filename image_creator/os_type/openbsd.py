@@ -33,11 +33,11 @@ class Openbsd(Bsd):
         sshd_no = re.compile(r"^sshd_flags=(['\"]?)NO\1$")
 
         for rc_conf in ('/etc/rc.conf', '/etc/rc.conf.local'):
-            if not self.image.g.is_file(rc_conf):
+            if not self.fs.is_file(rc_conf):
                 self.out.warn("File: `%s' does not exist!" % rc_conf)
                 continue
 
-            for line in self.image.g.cat(rc_conf).splitlines():
+            for line in self.fs.cat(rc_conf).splitlines():
                 line = line.split('#')[0].strip()
                 if sshd_service.match(line):
                     sshd_enabled = sshd_no.match(line) is None
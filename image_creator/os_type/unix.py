@@ -80,6 +80,22 @@ DESKTOPSESSIONS = {
 }
 X11_EXECUTABLE = 'startx'
 
+# The parts of /etc that are not needed for collecting metadata and may be
+# large. They are not prefetched.
+PREFETCH_EXCLUDES = ['./ssl', './pki', './selinux', './X11', './fonts',
+                     './gconf', './udev', './ca-certificates',
+                     './alternatives', './mime.types', './ld.so.cache']
+
+# The names of the fields of the account files
+ACCOUNT_FIELDS = {
+    '/etc/passwd': ('name', 'passwd', 'uid', 'gid', 'gecos', 'home', 'shell'),
+    '/etc/shadow': ('name', 'passwd', 'lastchg', 'min', 'max', 'warn',
+                    'inactive', 'expire', 'flag'),
+    '/etc/group': ('name', 'passwd', 'gid', 'members'),
+    '/etc/master.passwd': ('name', 'passwd', 'uid', 'gid', 'class', 'change',
+                           'expire', 'gecos', 'home', 'shell'),
+}
+
 SENSITIVE_USERDATA = [
     '.history',
     '.sh_history',
@@ -102,6 +118,96 @@ def check_sensitive_userdata(value):
     return value
 
 
+class AccountEntry(object):
+    """An entry of an account file. The fields are accessed by name."""
+
+    def __init__(self, names, fields):
+        """Create a new AccountEntry instance"""
+        self.names = names
+        self.fields = fields
+
+    def __getitem__(self, name):
+        index = self.names.index(name)
+        return self.fields[index] if index < len(self.fields) else ''
+
+    def __setitem__(self, name, value):
+        index = self.names.index(name)
+        if index >= len(self.fields):
+            self.fields.extend([''] * (index + 1 - len(self.fields)))
+        self.fields[index] = value
+
+    def __str__(self):
+        return ':'.join(self.fields)
+
+
+class AccountDatabase(object):
+    """The account files of an image. Each file is read and parsed once. The
+    entries are modified in memory and save() writes back the files that
+    changed. The system preparation saves them once, after all the tasks
+    have run. A task that needs the changes on disk before that, for example
+    to run a tool in the guest that reads the files, must call save() itself.
+    """
+
+    def __init__(self, fs):
+        """Create a new AccountDatabase instance that reads the files through
+        a FileSystemView.
+        """
+        self.fs = fs
+        self._files = {}
+        self._saved = {}
+
+    def _load(self, path):
+        """Returns the lines of a file or None if the file does not exist.
+        Comments and empty lines are kept as strings.
+        """
+        if path not in self._files:
+            lines = None
+            if self.fs.is_file(path):
+                lines = []
+                for line in self.fs.cat(path).splitlines():
+                    if len(line.split('#')[0].strip()) == 0:
+                        lines.append(line)
+                    else:
+                        names = ACCOUNT_FIELDS[path]
+                        lines.append(AccountEntry(names, line.split(':')))
+            self._files[path] = lines
+            self._saved[path] = self._render(path)
+        return self._files[path]
+
+    def _render(self, path):
+        """Returns the content of a file"""
+        lines = self._files[path]
+        return None if lines is None else \
+            '\n'.join([str(line) for line in lines]) + '\n'
+
+    def exists(self, path):
+        """Check if an account file exists"""
+        return self._load(path) is not None
+
+    def entries(self, path):
+        """Returns the entries of an account file"""
+        return [line for line in self._load(path) or []
+                if isinstance(line, AccountEntry)]
+
+    def remove(self, path, entries):
+        """Remove entries from an account file"""
+        lines = self._load(path)
+        if lines is not None:
+            self._files[path] = [line for line in lines
+                                 if line not in entries]
+
+    def save(self):
+        """Write back the files that changed. Returns their paths."""
+        written = []
+        for path in sorted(self._files):
+            content = self._render(path)
+            if content != self._saved[path]:
+                self.fs.image.g.write(path, content)
+                self._saved[path] = content
+                written.append(path)
+        return written
+
+
 class Unix(OSBase):
     """OS class for Unix"""
     @add_sysprep_param(
@@ -109,8 +215,30 @@ class Unix(OSBase):
         'Files in the home directory of each user that should be removed',
         check=check_sensitive_userdata)
     def __init__(self, image, **kwargs):
+        self._accounts = None
         super(Unix, self).__init__(image, **kwargs)
 
+    @property
+    def accounts(self):
+        """The account database of the mounted media"""
+        if self._accounts is None:
+            self._accounts = AccountDatabase(self.fs)
+        return self._accounts
+
+    def mount(self, readonly=False, silent=False, fatal=True):
+        """Returns a context manager for mounting an image"""
+        # The account files are read again on every mount
+        self._accounts = None
+        return super(Unix, self).mount(readonly, silent, fatal)
+
+    def _sysprep_finish(self):
+        """Write back the changes the sysprep tasks made in memory"""
+        try:
+            if self._accounts is not None:
+                self._accounts.save()
+        finally:
+            super(Unix, self)._sysprep_finish()
+
     def _mountpoints(self):
         """Return mountpoints in the correct order.
         / should be mounted before /boot or /usr, /usr befor /usr/bin ...
@@ -147,6 +275,10 @@ class Unix(OSBase):
 
         return True
 
+    def _prefetch(self):
+        """Prefetch the configuration files under /etc"""
+        self.fs.prefetch('/etc', PREFETCH_EXCLUDES)
+
     def _do_collect_metadata(self):
         super(Unix, self)._do_collect_metadata()
 
@@ -155,7 +287,7 @@ class Unix(OSBase):
 
         paths = ['%s/bin/%s' % (p, X11_EXECUTABLE) for p in bin_prefixes]
         for path in paths:
-            if self.image.g.is_file(path):
+            if self.fs.is_file(path):
                 gui = True
                 break
 
@@ -168,7 +300,7 @@ class Unix(OSBase):
         for exe, session in DESKTOPSESSIONS.items():
             paths = ["%s/bin/%s" % (p, e) for p in bin_prefixes for e in exe]
             for path in paths:
-                if self.image.g.is_file(path):
+                if self.fs.is_file(path):
                     desktop.append(session)
                     break
         if gui and len(desktop) != 0:
@@ -182,10 +314,10 @@ class Unix(OSBase):
             config = {}
             fname = '/etc/ssh/sshd_config'
 
-            if not self.image.g.is_file(fname):
+            if not self.fs.is_file(fname):
                 return {}
 
-            for line in self.image.g.cat(fname).splitlines():
+            for line in self.fs.cat(fname).splitlines():
                 line = line.split('#')[0].strip()
                 if not len(line):
                     continue
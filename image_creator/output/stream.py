@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2017 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module implements the StreamOutput output class, which sends the
+output as a stream of JSON encoded events, one per line, and the replay
+function that feeds such a stream to another output instance.
+"""
+
+import sys
+import json
+import time
+import threading
+
+from image_creator.output import Output
+
+# Minimum interval between two progress updates
+PROGRESS_INTERVAL = 0.2
+
+
+def _text(msg):
+    """Convert a message to unicode"""
+    if not isinstance(msg, basestring):
+        msg = str(msg)
+    if isinstance(msg, str):
+        msg = msg.decode('utf-8', 'replace')
+    return msg
+
+
+class StreamOutput(Output):
+    """Output class that writes events to a file object"""
+
+    def __init__(self, stream):
+        """Create a new StreamOutput instance"""
+        self.stream = stream
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def send(self, event, **kwargs):
+        """Send an event. Errors are ignored, since the reader of the stream
+        may have gone away.
+        """
+        kwargs['event'] = event
+        line = json.dumps(kwargs) + '\n'
+        with self._lock:
+            if self.closed:
+                return
+            try:
+                self.stream.write(line)
+                self.stream.flush()
+            except (IOError, OSError):
+                self.closed = True
+
+    def error(self, msg):
+        """Print an error"""
+        self.send('error', msg=_text(msg))
+
+    def warn(self, msg):
+        """Print a warning"""
+        self.send('warn', msg=_text(msg))
+
+    def success(self, msg):
+        """Print msg after an action is completed"""
+        self.send('success', msg=_text(msg))
+
+    def info(self, msg='', new_line=True):
+        """Print normal program output"""
+        self.send('info', msg=_text(msg), new_line=new_line)
+
+    def result(self, msg=''):
+        """Print a result"""
+        self.send('result', msg=_text(msg))
+
+    def clear(self):
+        """Clear the screen"""
+        self.send('clear')
+
+    class _Progress(object):
+        """Progress bar that sends its updates as events"""
+
+        def __init__(self, size, title, bar_type='default'):
+            self.size = size
+            self.index = 0
+            self.updated = 0
+            # pylint: disable=no-member
+            self.parent.send('progress', size=size, title=_text(title),
+                             bar_type=bar_type)
+
+        def goto(self, dest):
+            """Move progress to a specific position"""
+            self.index = dest
+            now = time.time()
+            if now - self.updated >= PROGRESS_INTERVAL or dest >= self.size:
+                self.updated = now
+                # pylint: disable=no-member
+                self.parent.send('goto', position=dest)
+
+        def next(self):
+            """Move progress a step forward"""
+            self.goto(self.index + 1)
+
+        def success(self, result):
+            """Print a msg after an action is completed successfully"""
+            # pylint: disable=no-member
+            self.parent.send('progress_success', msg=_text(result))
+
+
+def replay(stream, out, start=None):
+    """Feed the events read from a stream to an output instance. If a start
+    function is specified, it gets called with the start event and returns
+    the output instance to use from then on. Returns the exit event or None
+    if the stream ended without one.
+    """
+    progress = None
+    for line in iter(stream.readline, ''):
+        event = json.loads(line)
+        kind = event['event']
+        if kind == 'exit':
+            return event
+        elif kind == 'start' and start is not None:
+            out = start(event)
+        elif kind == 'write':
+            target = sys.stdout if event['stream'] == 'stdout' else sys.stderr
+            target.write(event['data'].encode('utf-8'))
+        elif kind == 'progress':
+            progress = out.Progress(event['size'], event['title'],
+                                    event['bar_type'])
+        elif kind == 'goto' and progress is not None:
+            progress.goto(event['position'])
+        elif kind == 'progress_success' and progress is not None:
+            progress.success(event['msg'])
+            progress = None
+        elif kind == 'info':
+            out.info(event['msg'], event['new_line'])
+        elif kind == 'clear':
+            out.clear()
+        elif kind in ('error', 'warn', 'success', 'result'):
+            getattr(out, kind)(event['msg'])
+    return None
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2017 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module manages the space of the temporary directories. The jobs that
+run on the same host reserve the space their snapshots are expected to need
+before they start modifying them, and the usage of the snapshots is monitored
+while they run.
+"""
+
+import os
+import time
+import errno
+import fcntl
+import threading
+import Queue
+
+from image_creator.util import FatalError, free_space
+
+MB = 2 ** 20
+GB = 2 ** 30
+
+# Rough estimates of the data the system preparation writes to the snapshot
+BASE_WRITES = 256 * MB  # logs, caches, configuration files
+BASE_WRITES_RATIO = 0.02  # of the media size
+SHRINK_WRITES_RATIO = 0.25  # data moved by the file system resize
+VIRTIO_WRITES = 512 * MB  # drivers and driver store copies
+WINDOWS_BOOT_WRITES = 2 * GB  # logs, updates and the page file (+ RAM size)
+
+# The reservations of the jobs are stored in this directory, under the root
+# of the temporary directories.
+RESERVATIONS_DIR = '.snf-image-creator-reservations'
+
+# How often the snapshot usage is checked and when to warn about it
+MONITOR_INTERVAL = 5
+USAGE_WARNING_RATIO = 0.9
+FREE_SPACE_WARNING = GB
+
+
+def estimate(image):
+    """Returns an estimate of the data, in bytes, that the system preparation
+    of an image will write into the temporary directory.
+    """
+    size = image.size
+    need = BASE_WRITES + int(size * BASE_WRITES_RATIO)
+
+    if image.is_unsupported():
+        return min(need, size)
+
+    system = image.os
+    enabled = [t.__name__ for t in system.list_syspreps()
+               if system.sysprep_enabled(t)]
+
+    if '_shrink' in enabled:
+        need += int(size * SHRINK_WRITES_RATIO)
+
+    params = system.sysprep_params
+    if 'virtio' in params and params['virtio'].value:
+        need += VIRTIO_WRITES
+
+    # Windows images are booted during the system preparation
+    if image.ostype == 'windows':
+        need += WINDOWS_BOOT_WRITES
+        if 'mem' in params:
+            need += params['mem'].value * MB
+
+    # A snapshot never needs more than a full copy of the media
+    return min(need, size)
+
+
+def estimate_media(size):
+    """Returns an estimate of the data, in bytes, that the system preparation
+    of a media of the given size may write into the temporary directory,
+    before the media is inspected. This is an upper bound of estimate().
+    """
+    need = BASE_WRITES + VIRTIO_WRITES + \
+        int(size * (BASE_WRITES_RATIO + SHRINK_WRITES_RATIO))
+    return min(need, size)
+
+
+def _used_space(dirname):
+    """Returns the space allocated by the files under a directory"""
+    used = 0
+    for root, _, files in os.walk(dirname):
+        for name in files:
+            try:
+                used += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return used
+
+
+def _alive(pid):
+    """Check if a process is running"""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class TmpSpace(object):
+    """Keeps track of the space reserved by the jobs that use the temporary
+    directories under the same root. A job may only start if its estimated
+    needs fit in the free space, minus the part of the reservations of the
+    other jobs that has not been used yet.
+    """
+
+    def __init__(self, tmpdir, output):
+        """Create a new TmpSpace instance for a job temporary directory"""
+        self.tmpdir = tmpdir
+        self.out = output
+        self.root = os.path.dirname(os.path.abspath(tmpdir))
+        self.dir = os.path.join(self.root, RESERVATIONS_DIR)
+        self._file = os.path.join(self.dir, str(os.getpid()))
+
+    def _lock(self):
+        """Lock the reservations directory. The lock is released when the
+        returned file is closed.
+        """
+        try:
+            os.mkdir(self.dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        lock = open(os.path.join(self.dir, 'lock'), 'a')
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        return lock
+
+    def _reserved(self):
+        """Returns the unused part of the reservations of the other jobs and
+        reaps the ones of the jobs that are no longer running.
+        """
+        reserved = 0
+        for name in os.listdir(self.dir):
+            if not name.isdigit() or int(name) == os.getpid():
+                continue
+            path = os.path.join(self.dir, name)
+            try:
+                with open(path) as f:
+                    size, tmpdir = f.read().split(None, 1)
+            except (IOError, ValueError):
+                continue
+            if not _alive(int(name)):
+                os.unlink(path)
+                continue
+            reserved += max(0, int(size) - _used_space(tmpdir.strip()))
+        return reserved
+
+    def reserve(self, size, wait=False):
+        """Reserve size bytes in the temporary directory. If there is not
+        enough space and wait is True, wait until the other jobs free it,
+        otherwise fail.
+        """
+        waiting = False
+        while True:
+            with self._lock():
+                available = free_space(self.root) - self._reserved()
+                if size <= available:
+                    with open(self._file, 'w') as f:
+                        f.write("%d %s\n" % (size, self.tmpdir))
+                    break
+
+            if not wait:
+                raise FatalError(
+                    "Not enough temporary space under `%s'. About %d MB are "
+                    "needed, but only %d MB are available. Use a different "
+                    "temporary directory or wait for the other jobs to "
+                    "finish." % (self.root, size // MB, max(0, available) //
+                                 MB))
+            if not waiting:
+                self.out.info("Waiting for %d MB of temporary space to become "
+                              "available ..." % (size // MB))
+                waiting = True
+            time.sleep(MONITOR_INTERVAL * 6)
+
+        self.out.info("Reserved %d MB of temporary space under `%s'" %
+                      (size // MB, self.root))
+
+    def release(self):
+        """Drop the reservation of this job"""
+        with self._lock():
+            if os.path.exists(self._file):
+                os.unlink(self._file)
+
+
+class SpaceMonitor(threading.Thread):
+    """Thread that periodically checks the usage of the snapshot and the free
+    space of the temporary directory and warns before they run out. The
+    output classes are not thread-safe, so the warnings are queued and
+    printed by the thread that calls report or stop.
+    """
+
+    def __init__(self, disk, output, interval=MONITOR_INTERVAL):
+        """Create a new SpaceMonitor instance"""
+        super(SpaceMonitor, self).__init__(name="space-monitor")
+        self.daemon = True
+        self.disk = disk
+        self.out = output
+        self.interval = interval
+        self._done = threading.Event()
+        self._warned = set()
+        self._warnings = Queue.Queue()
+
+    def _warn(self, key, msg):
+        """Queue a warning, once"""
+        if key not in self._warned:
+            self._warned.add(key)
+            self._warnings.put(msg)
+
+    def report(self):
+        """Print the queued warnings"""
+        while True:
+            try:
+                self.out.warn(self._warnings.get_nowait())
+            except Queue.Empty:
+                break
+
+    def check(self):
+        """Check the space once"""
+        status = self.disk.snapshot_status()
+        if status is not None:
+            used, total = status
+            if used is None:
+                self._warn('invalid', "The snapshot is invalid. It has "
+                           "probably run out of space!")
+            elif used >= total * USAGE_WARNING_RATIO:
+                self._warn('usage', "The snapshot is %d%% full (%d/%d MB)" %
+                           (used * 100 // total, used // MB, total // MB))
+
+        free = free_space(self.disk.tmp)
+        if free < FREE_SPACE_WARNING:
+            self._warn('free', "Only %d MB of free space left under `%s'" %
+                       (free // MB, self.disk.tmp))
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            try:
+                self.check()
+            except Exception:  # pylint: disable=broad-except
+                pass
+
+    def stop(self):
+        """Stop the monitor and print the warnings it has not reported yet"""
+        self._done.set()
+        self.report()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -22,12 +22,29 @@ the package.
 import sh
 import time
 import os
+import errno
 import re
 import json
 import tempfile
 import subprocess
 import random
 import string
+import ctypes
+import ctypes.util
+import fcntl
+import sys
+import threading
+
+
+# Linux specific whence values for lseek. They are missing from python 2's os
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# Linux value of the posix_fadvise advice
+POSIX_FADV_DONTNEED = 4
+
+# Linux ioctl for cloning files on file systems that support reflinks
+FICLONE = 0x40049409
 
 
 class FatalError(Exception):
@@ -61,12 +78,55 @@ def get_command(command):
         return find_sbin_command(command, e)
 
 
+class LazyCommand(object):
+    """A file system binary command that is looked up the first time it is
+    run, instead of when the module that uses it is loaded.
+    """
+
+    def __init__(self, command):
+        """Create a new LazyCommand instance"""
+        self.command = command
+        self._command = None
+
+    def _get(self):
+        """Returns the sh command"""
+        if self._command is None:
+            self._command = get_command(self.command)
+        return self._command
+
+    def __call__(self, *args, **kwargs):
+        return self._get()(*args, **kwargs)
+
+    def __str__(self):
+        return str(self._get())
+
+
+@static_vars(version=None)
+def qemu_img_version():
+    """Returns the version of qemu-img as a tuple of integers"""
+    if qemu_img_version.version is None:
+        qemu_img = get_command('qemu-img')
+        try:
+            output = str(qemu_img('--version'))
+        except sh.ErrorReturnCode:
+            output = ''
+        match = re.search(r'version\s+(\d+)\.(\d+)(?:\.(\d+))?', output)
+        if match is None:
+            qemu_img_version.version = (0, 0, 0)
+        else:
+            qemu_img_version.version = \
+                tuple(int(v or 0) for v in match.groups())
+    return qemu_img_version.version
+
+
 def image_info(image):
-    """Returns information about an image file"""
+    """Returns information about an image file. The information about the
+    image and all its backing files is listed under the 'backing-chain' key.
+    """
 
     qemu_img = get_command('qemu-img')
     try:
-        info = qemu_img('info', '--output', 'json', image)
+        chain = qemu_img('info', '--output', 'json', '--backing-chain', image)
     except sh.ErrorReturnCode_1:  # pylint: disable=no-member
         # Old version of qemu-img that does not support --output json
         info = qemu_img('info', image)
@@ -75,7 +135,72 @@ def image_info(image):
                 fmt = line.split(':')[1].strip()
                 return {'format': fmt}
         raise FatalError("Unable to determine the image format")
-    return json.loads(str(info))
+
+    chain = json.loads(str(chain))
+    info = dict(chain[0])
+    info['backing-chain'] = chain
+    return info
+
+
+def image_extents(image):
+    """Returns a sorted list of (offset, length) tuples with the regions of an
+    image file that contain data or None if the allocation map of the image
+    cannot be determined. The regions that are not listed read as zeros.
+    """
+
+    qemu_img = get_command('qemu-img')
+    try:
+        mapping = json.loads(str(qemu_img('map', '--output', 'json', image)))
+    except (sh.ErrorReturnCode, ValueError):
+        return None
+
+    extents = []
+    for entry in mapping:
+        if not entry['data'] or entry['zero']:
+            continue
+        if len(extents) and sum(extents[-1]) == entry['start']:
+            extents[-1] = (extents[-1][0], extents[-1][1] + entry['length'])
+        else:
+            extents.append((entry['start'], entry['length']))
+    return extents
+
+
+def file_extents(fd, size):
+    """Returns a sorted list of (offset, length) tuples with the data regions
+    of the first size bytes of a regular file, by using SEEK_DATA and
+    SEEK_HOLE. If the file system does not support them, None is returned.
+    """
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:  # No data after offset
+                    break
+                raise
+            if start >= size:
+                break
+            offset = os.lseek(fd, start, SEEK_HOLE)
+            extents.append((start, min(offset, size) - start))
+    except OSError:
+        return None
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+
+    return extents
+
+
+def fadvise_dontneed(fd, offset, length):
+    """Tell the kernel that a region of a file won't be accessed in the near
+    future, so that its pages get dropped from the page cache.
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    ret = libc.posix_fadvise(fd, ctypes.c_int64(offset),
+                             ctypes.c_int64(length), POSIX_FADV_DONTNEED)
+    if ret != 0:
+        raise OSError(ret, os.strerror(ret))
 
 
 def create_snapshot(source, target_dir):
@@ -133,6 +258,59 @@ def free_space(dirname):
     return stat.f_bavail * stat.f_frsize
 
 
+def reflink(source, target):
+    """Create target as a copy-on-write clone of the source file. Returns
+    False if the file system does not support cloning the file.
+    """
+    with open(source, 'rb') as src:
+        with open(target, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return True
+            except IOError as e:
+                if e.errno not in (errno.EXDEV, errno.EOPNOTSUPP,
+                                   errno.ENOTTY, errno.EINVAL):
+                    raise
+
+    os.unlink(target)
+    return False
+
+
+class Background(threading.Thread):
+    """Run a function in a background thread. The result of the function, or
+    the exception it raised, is returned by the result method.
+    """
+
+    def __init__(self, func, *args):
+        """Create a new Background instance and start the thread"""
+        super(Background, self).__init__(name=func.__name__)
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.elapsed = None
+        self._result = None
+        self._exc_info = None
+        self.start()
+
+    def run(self):
+        start = time.time()
+        try:
+            self._result = self.func(*self.args)
+        except BaseException:  # pylint: disable=broad-except
+            self._exc_info = sys.exc_info()
+        finally:
+            self.elapsed = time.time() - start
+
+    def result(self):
+        """Wait for the function to return and return its result or raise
+        the exception it raised.
+        """
+        self.join()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
 def virtio_versions(virtio_state):
     """Returns the versions of the drivers defined by the virtio state"""
 
@@ -156,66 +334,4 @@ def to_shell(**kwargs):
         "set | grep ^%s_ | sed -e 's/^%s_//'" % (prefix, prefix),
         shell=True)
 
-class QemuNBD(object):
-    """Wrapper class for the qemu-nbd tool"""
-
-    def __init__(self, image):
-        """Initialize an instance"""
-        self.image = image
-        self.device = None
-        self.pattern = re.compile(r'^nbd\d+$')
-        self.modprobe = get_command('modprobe')
-        try:
-            self.qemu_nbd = get_command('qemu-nbd')
-        except sh.CommandNotFound:
-            self.qemu_nbd = None
-
-    def _list_devices(self):
-        """Returns all the NBD block devices"""
-        return set([d for d in os.listdir('/dev/') if self.pattern.match(d)])
-
-    def connect(self, ro=True):
-        """Connect the image to a free NBD device"""
-
-        assert self.qemu_nbd is not None, "qemu-nbd command not found"
-
-        devs = self._list_devices()
-
-        if len(devs) == 0:  # Is nbd module loaded?
-            self.modprobe('nbd', 'max_part=16')
-            # Wait a second for /dev to be populated
-            time.sleep(1)
-            devs = self._list_devices()
-            if len(devs) == 0:
-                raise FatalError("/dev/nbd* devices not present!")
-
-        # Ignore the nbd block devices that are in use
-        with open('/proc/partitions') as partitions:
-            for line in iter(partitions):
-                entry = line.split()
-                if len(entry) != 4:
-                    continue
-                if entry[3] in devs:
-                    devs.remove(entry[3])
-
-        if len(devs) == 0:
-            raise FatalError("All NBD block devices are busy!")
-
-        device = '/dev/%s' % devs.pop()
-        args = ['-c', device]
-        if ro:
-            args.append('-r')
-        args.append(self.image)
-
-        self.qemu_nbd(*args)
-        self.device = device
-        return device
-
-    def disconnect(self):
-        """Disconnect the image from the connected device"""
-        assert self.device is not None, "No device connected"
-
-        self.qemu_nbd('-d', self.device)
-        self.device = None
-
 # vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
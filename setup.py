@@ -41,10 +41,13 @@ setup(
     install_requires=['sh', 'ansicolors', 'progress>=1.0.2', 'kamaki>=0.9',
                       'argparse', 'pyyaml'],
     # Unresolvable dependencies:
-    #   pysendfile|py-sendfile, hivex, guestfs, parted, rsync,
+    #   hivex, guestfs, parted, rsync,
     entry_points={
         'console_scripts': [
                 'snf-mkimage = image_creator.main:main',
+                'snf-mkimage-batch = image_creator.batch:main',
+                'snf-mkimage-daemon = image_creator.daemon:main',
+                'snf-mkimage-client = image_creator.client:main',
                 'snf-image-creator = image_creator.dialog_main:main']
     },
     classifiers=[
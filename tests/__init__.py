@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2017 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for the parts of snf-image-creator that need neither a
+libguestfs appliance nor root privileges. Run them from the top directory
+of the source tree with:
+
+    python -m unittest discover -s tests -t .
+
+If the sh module is not installed, a stub that only provides what the
+modules under test need at import time is used instead.
+"""
+
+import os
+import sys
+
+try:
+    import sh  # pylint: disable=unused-import
+except ImportError:
+    sys.path.append(os.path.join(os.path.dirname(__file__), 'stubs'))
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
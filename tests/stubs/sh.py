@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2017 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Stub of the sh module for running the unit tests without it. Running any
+command fails.
+"""
+
+
+class ErrorReturnCode(Exception):
+    """Raised when a command exits with an error"""
+    pass
+
+
+class CommandNotFound(AttributeError):
+    """Raised when a command cannot be found"""
+    pass
+
+
+def Command(path):  # pylint: disable=invalid-name
+    """Returns a command that cannot be run"""
+    raise CommandNotFound(path)
+
+
+def __getattr__(name):
+    """Look up a command"""
+    raise CommandNotFound(name)
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2017 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the AccountDatabase class of the image_creator.os_type.unix
+module
+"""
+
+import unittest
+
+from image_creator.os_type.unix import AccountDatabase
+
+PASSWD = """\
+# The accounts of the image
+root:x:0:0:root:/root:/bin/bash
+daemon:x:1:1:daemon:/usr/sbin:/usr/sbin/nologin
+
+user:x:1000:1000:User,,,:/home/user:/bin/bash
+"""
+
+SHADOW = """\
+root:$6$salt$hash:17000:0:99999:7:::
+daemon:*:17000:0:99999:7:::
+user:$6$salt$hash:17000:0:99999:7:::
+"""
+
+
+class FakeGuestFS(object):
+    """Records the files written to the image"""
+
+    def __init__(self):
+        self.written = {}
+
+    def write(self, path, content):
+        """Write a file"""
+        self.written[path] = content
+
+
+class FakeImage(object):
+    """An image with a fake libguestfs handle"""
+
+    def __init__(self):
+        self.g = FakeGuestFS()
+
+
+class FakeFileSystemView(object):
+    """A FileSystemView over a dictionary of files"""
+
+    def __init__(self, files):
+        self.files = files
+        self.image = FakeImage()
+        self.reads = []
+
+    def is_file(self, path):
+        """Check if a file exists"""
+        return path in self.files
+
+    def cat(self, path):
+        """Returns the content of a file"""
+        self.reads.append(path)
+        return self.files[path]
+
+
+class TestAccountDatabase(unittest.TestCase):
+    """Tests for the AccountDatabase class"""
+
+    def setUp(self):
+        self.fs = FakeFileSystemView({'/etc/passwd': PASSWD,
+                                      '/etc/shadow': SHADOW})
+        self.db = AccountDatabase(self.fs)
+
+    def test_unchanged(self):
+        """Nothing is written back if nothing changed"""
+        self.assertEqual([e['name'] for e in self.db.entries('/etc/passwd')],
+                         ['root', 'daemon', 'user'])
+        self.assertEqual(len(self.db.entries('/etc/shadow')), 3)
+        self.assertEqual(self.db.save(), [])
+        self.assertEqual(self.fs.image.g.written, {})
+
+    def test_read_once(self):
+        """Each file is read once"""
+        self.db.entries('/etc/passwd')
+        self.db.entries('/etc/passwd')
+        self.db.exists('/etc/passwd')
+        self.assertEqual(self.fs.reads, ['/etc/passwd'])
+
+    def test_missing(self):
+        """Missing files have no entries and are never written"""
+        self.assertFalse(self.db.exists('/etc/master.passwd'))
+        self.assertEqual(self.db.entries('/etc/master.passwd'), [])
+        self.db.remove('/etc/master.passwd', [])
+        self.assertEqual(self.db.save(), [])
+
+    def test_round_trip(self):
+        """Modified entries are written back along with the comments and the
+        empty lines, and only once.
+        """
+        users = dict((e['name'], e) for e in self.db.entries('/etc/shadow'))
+        users['root']['passwd'] = '*'
+        self.db.remove('/etc/passwd', [e for e in
+                                       self.db.entries('/etc/passwd')
+                                       if e['name'] == 'user'])
+
+        self.assertEqual(self.db.save(), ['/etc/passwd', '/etc/shadow'])
+        written = self.fs.image.g.written
+        self.assertEqual(written['/etc/passwd'], PASSWD.replace(
+            "user:x:1000:1000:User,,,:/home/user:/bin/bash\n", ""))
+        self.assertEqual(written['/etc/shadow'], SHADOW.replace(
+            "root:$6$salt$hash:", "root:*:"))
+
+        self.fs.image.g.written = {}
+        self.assertEqual(self.db.save(), [])
+        self.assertEqual(self.fs.image.g.written, {})
+
+    def test_missing_fields(self):
+        """Fields missing from the end of an entry read as empty and are
+        added when they are set.
+        """
+        fs = FakeFileSystemView({'/etc/group': "wheel:x:10\n"})
+        db = AccountDatabase(fs)
+        wheel = db.entries('/etc/group')[0]
+        self.assertEqual(wheel['members'], '')
+        wheel['members'] = 'root'
+        self.assertEqual(db.save(), ['/etc/group'])
+        self.assertEqual(fs.image.g.written['/etc/group'],
+                         "wheel:x:10:root\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2017 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the image_creator.allocation module"""
+
+import io
+import struct
+import unittest
+
+from image_creator.allocation import merge, subtract, ext_holes, \
+    unused_extents, EXT_RO_COMPAT_GDT_CSUM, EXT_RO_COMPAT_METADATA_CSUM, \
+    EXT_BG_BLOCK_UNINIT
+
+KB = 1024
+
+
+def ext_image(ro_compat=0, flags=0):
+    """Returns a file object with a 64KB ext2 file system of one group. The
+    block bitmap marks blocks 1-8 and 33 as used.
+    """
+    image = bytearray(64 * KB)
+
+    # Superblock: 1KB blocks, the first data block is 1
+    sb = 1 * KB
+    struct.pack_into('<11I', image, sb, 16, 64, 0, 0, 0, 1, 0, 0, 8192, 8192,
+                     16)
+    struct.pack_into('<H', image, sb + 0x38, 0xef53)
+    struct.pack_into('<I', image, sb + 0x4c, 1)
+    struct.pack_into('<H', image, sb + 0x58, 128)
+    struct.pack_into('<III', image, sb + 0x5c, 0, 0, ro_compat)
+
+    # Group descriptor: bitmaps in blocks 3 and 4, inode table in 5-6
+    struct.pack_into('<III', image, 2 * KB, 3, 4, 5)
+    struct.pack_into('<H', image, 2 * KB + 0x12, flags)
+
+    image[3 * KB] = 0xff
+    image[3 * KB + 4] = 0x01
+    return io.BytesIO(bytes(image))
+
+
+class TestExtents(unittest.TestCase):
+    """Tests for the extent list helpers"""
+
+    def test_merge(self):
+        """Overlapping and adjacent extents are merged"""
+        self.assertEqual(merge([(10, 5), (0, 10), (30, 5), (32, 10)]),
+                         [(0, 15), (30, 12)])
+
+    def test_subtract(self):
+        """Holes are cut out of the extents"""
+        self.assertEqual(subtract([(0, 100)], [(10, 5), (20, 15), (90, 20)]),
+                         [(0, 10), (15, 5), (35, 55)])
+        self.assertEqual(subtract([(0, 10), (20, 10)], [(5, 20)]),
+                         [(0, 5), (25, 5)])
+
+
+class TestExtHoles(unittest.TestCase):
+    """Tests for reading the block bitmaps of ext file systems"""
+
+    def test_bitmap(self):
+        """The free blocks of the bitmap are reported"""
+        self.assertEqual(ext_holes(ext_image(), 0),
+                         [(9 * KB, 24 * KB), (41 * KB, 23 * KB)])
+
+    def test_offset(self):
+        """The holes are relative to the start of the disk"""
+        image = ext_image().getvalue()
+        disk = io.BytesIO('\xaa' * 4 * KB + image)
+        self.assertEqual(ext_holes(disk, 4 * KB),
+                         [(13 * KB, 24 * KB), (45 * KB, 23 * KB)])
+
+    def test_block_uninit_without_checksums(self):
+        """BLOCK_UNINIT is ignored if the descriptors have no checksums"""
+        self.assertEqual(ext_holes(ext_image(flags=EXT_BG_BLOCK_UNINIT), 0),
+                         ext_holes(ext_image(), 0))
+
+    def test_block_uninit(self):
+        """With gdt_csum or metadata_csum, uninitialized groups are free
+        except for their metadata.
+        """
+        for feature in (EXT_RO_COMPAT_GDT_CSUM, EXT_RO_COMPAT_METADATA_CSUM):
+            image = ext_image(ro_compat=feature, flags=EXT_BG_BLOCK_UNINIT)
+            self.assertEqual(ext_holes(image, 0), [(7 * KB, 57 * KB)])
+
+    def test_not_ext(self):
+        """Other file systems are not recognized"""
+        self.assertEqual(ext_holes(io.BytesIO('\0' * 64 * KB), 0), None)
+
+    def test_unused_extents(self):
+        """The holes of the partitions are collected, but never outside the
+        partitions.
+        """
+        self.assertEqual(
+            unused_extents(ext_image(), [(0, 64 * KB - 1, 'ext2')]),
+            [(9 * KB, 24 * KB), (41 * KB, 23 * KB)])
+        self.assertEqual(
+            unused_extents(ext_image(), [(0, 40 * KB - 1, 'ext2')]),
+            [(9 * KB, 24 * KB)])
+        self.assertEqual(
+            unused_extents(ext_image(), [(0, 64 * KB - 1, 'swap')]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2017 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the image_creator.checksum module"""
+
+import os
+import hashlib
+import tempfile
+import unittest
+
+from image_creator.checksum import Checksum, BlockHash, file_digests
+
+
+def hashmap(data, block_size, block_hash='sha256'):
+    """Returns the hashes of the blocks of data the way Pithos+ does"""
+    return [hashlib.new(block_hash, data[i:i + block_size].rstrip('\0'))
+            .hexdigest() for i in xrange(0, len(data), block_size)]
+
+
+class TestBlockHash(unittest.TestCase):
+    """Tests for the BlockHash class"""
+
+    def check(self, data, block_size, chunk_size):
+        """Feed data in chunks and compare with a plain hashlib pass"""
+        digest = BlockHash(block_size, 'sha256')
+        view = memoryview(data)
+        for i in xrange(0, len(data), chunk_size):
+            digest.update(view[i:i + chunk_size])
+        result = digest.hexdigest()
+        self.assertEqual(result['hashes'], hashmap(data, block_size))
+        self.assertEqual(result['bytes'], len(data))
+        self.assertEqual(result['block_size'], block_size)
+        self.assertEqual(result['block_hash'], 'sha256')
+
+    def test_data(self):
+        """Blocks of random data"""
+        data = os.urandom(100000)
+        for chunk_size in (1000, 4096, 16384, 100000):
+            self.check(data, 16384, chunk_size)
+
+    def test_trailing_zeros(self):
+        """The trailing zeros of a block are not hashed, but zeros followed
+        by data in the same block are.
+        """
+        data = 'a' * 5000 + '\0' * 20000 + 'b' + '\0' * 10000 + \
+            os.urandom(3000) + '\0' * 70000
+        for chunk_size in (999, 4096, 8192, 50000):
+            self.check(data, 8192, chunk_size)
+
+    def test_empty(self):
+        """Empty blocks and streams"""
+        self.check('\0' * 8192 * 3, 8192, 5000)
+        self.assertEqual(BlockHash(8192).hexdigest()['hashes'], [])
+
+
+class TestChecksum(unittest.TestCase):
+    """Tests for the Checksum engine"""
+
+    def test_parity(self):
+        """The digests match the ones of a plain hashlib pass"""
+        data = os.urandom(300000) + '\0' * 100000
+        checksum = Checksum({'md5': hashlib.md5(),
+                             'sha256': hashlib.sha256(),
+                             'hashmap': BlockHash(65536)},
+                            buffer_size=65536)
+        for i in xrange(0, len(data), 65536):
+            buf = checksum.buffer()
+            size = min(65536, len(data) - i)
+            buf[:size] = data[i:i + size]
+            checksum.update(buf[:size], buf)
+        digests = checksum.finish()
+
+        self.assertEqual(digests['md5'], hashlib.md5(data).hexdigest())
+        self.assertEqual(digests['sha256'], hashlib.sha256(data).hexdigest())
+        self.assertEqual(digests['hashmap']['hashes'], hashmap(data, 65536))
+
+    def test_error(self):
+        """Errors of the digests are raised by finish"""
+        class Broken(object):
+            """A digest that fails"""
+            def update(self, data):
+                """Fail"""
+                raise ValueError("broken")
+
+            def hexdigest(self):
+                """Never reached"""
+                return None
+
+        checksum = Checksum({'broken': Broken()}, buffer_size=16)
+        checksum.update('data')
+        self.assertRaises(ValueError, checksum.finish)
+
+    def test_file_digests(self):
+        """The digests of a file"""
+        data = os.urandom(200000)
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, data)
+            os.close(fd)
+            digests = file_digests(path, buffer_size=65536)
+        finally:
+            os.unlink(path)
+
+        self.assertEqual(digests, {'md5': hashlib.md5(data).hexdigest(),
+                                   'sha256': hashlib.sha256(data).hexdigest()})
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011-2017 GRNET S.A.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the NBD client of the image_creator.nbd module. The server side
+of the protocol is played by a thread on the other end of a socket pair.
+"""
+
+import os
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+
+from image_creator.util import FatalError
+from image_creator.nbd import NBDConnection, NBDFile, NBD_MAGIC, \
+    NBD_OPTS_MAGIC, NBD_FLAG_FIXED_NEWSTYLE, NBD_FLAG_NO_ZEROES, \
+    NBD_OPT_EXPORT_NAME, NBD_REQUEST_MAGIC, NBD_REPLY_MAGIC, NBD_CMD_READ, \
+    REQUEST, REPLY
+
+SIZE = 1024 * 1024
+
+
+def recv(sock, size):
+    """Receive exactly size bytes"""
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+class Server(threading.Thread):
+    """A minimal NBD server that serves an export of SIZE bytes. The byte at
+    offset i is chr(i % 251).
+    """
+
+    def __init__(self, sock, flags, magic=NBD_MAGIC):
+        super(Server, self).__init__()
+        self.daemon = True
+        self.sock = sock
+        self.flags = flags
+        self.magic = magic
+        self.export = None
+        self.client_flags = None
+        self.start()
+
+    def run(self):
+        try:
+            self.serve()
+        except (EOFError, socket.error):
+            pass
+        finally:
+            self.sock.close()
+
+    def serve(self):
+        """Negotiate and then reply to read requests"""
+        self.sock.sendall(struct.pack('>8s8sH', self.magic, NBD_OPTS_MAGIC,
+                                      self.flags))
+        self.client_flags = struct.unpack('>I', recv(self.sock, 4))[0]
+        magic, option, length = struct.unpack('>8sII', recv(self.sock, 16))
+        assert magic == NBD_OPTS_MAGIC and option == NBD_OPT_EXPORT_NAME
+        self.export = recv(self.sock, length)
+        self.sock.sendall(struct.pack('>QH', SIZE, 0))
+        if not self.flags & NBD_FLAG_NO_ZEROES:
+            self.sock.sendall('\0' * 124)
+
+        while True:
+            magic, _, cmd, handle, offset, length = \
+                REQUEST.unpack(recv(self.sock, REQUEST.size))
+            assert magic == NBD_REQUEST_MAGIC
+            if cmd != NBD_CMD_READ:
+                return
+            data = ''.join(chr(i % 251) for i in xrange(offset,
+                                                        offset + length))
+            self.sock.sendall(REPLY.pack(NBD_REPLY_MAGIC, 0, handle) + data)
+
+
+def expected(offset, length):
+    """Returns the data the server serves at offset"""
+    return ''.join(chr(i % 251) for i in xrange(offset, offset + length))
+
+
+def connect(flags, magic=NBD_MAGIC):
+    """Returns an NBDConnection that performed the handshake with a server
+    over a socket pair, and the server.
+    """
+    client, server = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    server = Server(server, flags, magic)
+    conn = NBDConnection.__new__(NBDConnection)
+    conn.sock = client
+    conn._handle = 0  # pylint: disable=protected-access
+    conn._pending = {}  # pylint: disable=protected-access
+    try:
+        conn.size = conn._handshake('')  # pylint: disable=protected-access
+    except FatalError:
+        client.close()
+        raise
+    return conn, server
+
+
+class TestNBDConnection(unittest.TestCase):
+    """Tests for the NBDConnection class"""
+
+    def test_handshake(self):
+        """Fixed newstyle handshake without the zero padding"""
+        conn, server = connect(NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES)
+        conn.close()
+        server.join()
+        self.assertEqual(conn.size, SIZE)
+        self.assertEqual(server.export, '')
+        self.assertEqual(server.client_flags,
+                         NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES)
+
+    def test_handshake_zeros(self):
+        """Old servers send the zero padding after the export size"""
+        conn, server = connect(NBD_FLAG_FIXED_NEWSTYLE)
+        try:
+            self.assertEqual(conn.size, SIZE)
+            self.assertEqual(server.client_flags, NBD_FLAG_FIXED_NEWSTYLE)
+
+            # The padding must not be mistaken for a reply
+            buf = bytearray(100)
+            conn.request(1000, memoryview(buf))
+            conn.receive()
+            self.assertEqual(str(buf), expected(1000, 100))
+        finally:
+            conn.close()
+            server.join()
+
+    def test_bad_magic(self):
+        """Servers that don't speak the newstyle protocol are rejected"""
+        self.assertRaises(FatalError, connect, 0, magic='BADMAGIC')
+
+    def test_requests(self):
+        """Multiple requests are sent before the replies are received"""
+        conn, server = connect(NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES)
+        try:
+            buf = bytearray(3000)
+            view = memoryview(buf)
+            conn.request(5000, view[:1000])
+            conn.request(SIZE - 2000, view[1000:])
+            self.assertEqual(conn.pending(), 2)
+            while conn.pending():
+                conn.receive()
+            self.assertEqual(str(buf), expected(5000, 1000) +
+                             expected(SIZE - 2000, 2000))
+        finally:
+            conn.close()
+            server.join()
+
+
+class TestNBDFile(unittest.TestCase):
+    """Tests for the NBDFile class"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'nbd.sock')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.rmdir(self.tmpdir)
+
+    def test_read(self):
+        """Reads are spread over all the connections"""
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(4)
+        servers = []
+
+        def accept():
+            """Serve each connection in its own thread"""
+            for _ in xrange(4):
+                sock, _ = listener.accept()
+                servers.append(Server(sock, NBD_FLAG_FIXED_NEWSTYLE |
+                                      NBD_FLAG_NO_ZEROES))
+        acceptor = threading.Thread(target=accept)
+        acceptor.start()
+        try:
+            with NBDFile(self.path, connections=4) as f:
+                self.assertEqual(f.size, SIZE)
+                f.seek(12345)
+                self.assertEqual(f.read(600000), expected(12345, 600000))
+                self.assertEqual(f.tell(), 612345)
+                f.seek(-10, os.SEEK_END)
+                self.assertEqual(f.read(), expected(SIZE - 10, 10))
+                self.assertEqual(f.read(), '')
+        finally:
+            acceptor.join()
+            listener.close()
+        for server in servers:
+            server.join()
+
+    def test_no_server(self):
+        """Failing to connect raises a FatalError"""
+        self.assertRaises(FatalError, NBDConnection, self.path)
+        self.assertRaises(FatalError, NBDFile, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: set sta sts=4 shiftwidth=4 sw=4 et ai :